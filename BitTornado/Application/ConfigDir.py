@@ -116,11 +116,19 @@ class ConfigDir(object):
         """Add a torrent data file to cache"""
         self.torrentDataBuffer[torrent] = data
         fname = os.path.join(self.dir_datacache, hexlify(torrent).decode())
+        # Replace the old file only once the new one is complete, so that a
+        # crash mid-write leaves the previous data intact
+        tmpname = fname + '.tmp'
         try:
-            with open(fname, 'wb') as f:
+            with open(tmpname, 'wb') as f:
                 f.write(bencode(data))
+            os.replace(tmpname, fname)
             return True
         except (IOError, TypeError, KeyError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
             self.deleteTorrentData(torrent)
             return False
 
@@ -161,7 +169,7 @@ class ConfigDir(object):
 
         for fname in os.listdir(self.dir_datacache):
             path = os.path.join(self.dir_datacache, fname)
-            fname = unhexlify(os.path.basename(fname))
+            fname = unhexlify(os.path.basename(fname).split('.')[0])
             if len(fname) != 20:
                 continue
             names.setdefault(fname, []).append(path)
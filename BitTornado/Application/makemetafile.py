@@ -4,6 +4,7 @@ import threading
 from traceback import print_exc
 from BitTornado.Meta.BTTree import BTTree
 from BitTornado.Meta.Info import MetaInfo
+from BitTornado.Meta.ParallelHasher import ParallelHasher
 
 defaults = [
     ('announce-list', '',
@@ -18,7 +19,10 @@ defaults = [
         "optional specification for filesystem encoding " +
         "(set automatically in recent Python versions)"),
     ('target', '',
-        "optional target file for the torrent")
+        "optional target file for the torrent"),
+    ('workers', 1,
+        "number of threads hashing pieces, shared by all torrents being " +
+        "made (0 = one per processor)")
 ]
 
 ignore = ['core', 'CVS']
@@ -52,8 +56,6 @@ def make_meta_file(loc, url, params=None, flag=None,
     if flag is None:
         flag = threading.Event()
 
-    tree = BTTree(loc, [])
-
     # Extract target from parameters
     if 'target' not in params or params['target'] == '':
         fname, ext = os.path.split(loc)
@@ -63,6 +65,13 @@ def make_meta_file(loc, url, params=None, flag=None,
             target = os.path.join(fname, ext + '.torrent')
         params['target'] = target
 
+    if params.get('workers', 1) != 1:
+        make_meta_files([(loc, params)], url, params['workers'], flag,
+                        progress, progress_percent)
+        return
+
+    tree = BTTree(loc, [])
+
     info = tree.makeInfo(flag=flag, progress=progress,
                          progress_percent=progress_percent, **params)
 
@@ -73,6 +82,59 @@ def make_meta_file(loc, url, params=None, flag=None,
     metainfo.write(params['target'])
 
 
+def make_meta_files(targets, url, workers=0, flag=None,
+                    progress=lambda x: None, progress_percent=True,
+                    filestat=lambda x: None):
+    """Make .torrent files for (location, params) pairs, hashing the pieces
+    of all locations together on a pool of worker threads
+
+    params['target'] gives the .torrent file to write for each location.
+    Files are written, and filestat called with their locations, as their
+    pieces are completed. Locations that cannot be described are reported
+    and skipped. Progress is reported over all locations."""
+    if flag is None:
+        flag = threading.Event()
+
+    hasher = ParallelHasher(workers)
+    try:
+        pending = {}
+        total = 0
+        for loc, params in targets:
+            try:
+                tree = BTTree(loc, [])
+                info = tree.initInfo(**params)
+                files = list(tree.files())
+                for _, path, size in files:
+                    info.add_file_info(size, path)
+            except (IOError, ValueError):
+                filestat(loc)
+                print_exc()
+                continue
+            job = hasher.submit([(floc, size) for floc, _, size in files],
+                                info.hasher.pieceLength)
+            pending[job] = (loc, info, params)
+            total += tree.size
+
+        total = total or 1
+        subtotal = 0
+        for job, nbytes in hasher.completed(list(pending), flag):
+            subtotal += nbytes
+            progress(subtotal / total if progress_percent else nbytes)
+            if job not in pending or not job.done():
+                continue
+            loc, info, params = pending.pop(job)
+            filestat(loc)
+            try:
+                info.add_pieces(job.pieces())
+            except (IOError, ValueError):
+                print_exc()
+                continue
+            MetaInfo(announce=url, info=info, **params).write(
+                params['target'])
+    finally:
+        hasher.close()
+
+
 def completedir(directory, url, params=None, flag=None,
                 progress=lambda x: None, filestat=lambda x: None):
     """Make a .torrent file for each entry in a directory"""
@@ -87,6 +149,22 @@ def completedir(directory, url, params=None, flag=None,
     togen = [os.path.join(directory, fname) for fname in files
              if (fname + ext) not in files and not fname.endswith(ext)]
 
+    if params.get('workers', 1) != 1:
+        targets = []
+        for fname in togen:
+            base = os.path.basename(fname)
+            if base not in ignore and base[0] != '.':
+                subparams = params.copy()
+                if 'target' in params and params['target'] != '':
+                    subparams['target'] = os.path.join(params['target'],
+                                                       base + ext)
+                else:
+                    subparams['target'] = fname + ext
+                targets.append((fname, subparams))
+        make_meta_files(targets, url, params['workers'], flag, progress,
+                        filestat=filestat)
+        return
+
     trees = [BTTree(loc, []) for loc in togen]
 
     def subprog(update, subtotal=[0], total=sum(tree.size for tree in trees),
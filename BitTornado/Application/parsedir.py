@@ -2,9 +2,7 @@
 """
 
 import os
-import hashlib
-from BitTornado.Meta.bencode import bencode
-from BitTornado.Meta.Info import check_info, MetaInfo
+from BitTornado.Meta.Info import LazyMetaInfo
 
 
 def _errfunc(msg):
@@ -160,22 +158,18 @@ def parse_torrent(path, return_metainfo=False):
     """
     fname = os.path.basename(path)
 
-    data = MetaInfo.read(path)
-
-    # Validate and hash info dict
+    # Only the values needed here are decoded; the full metainfo is parsed
+    # if requested
+    data = LazyMetaInfo.read(path)
+    data.check()
     info = data['info']
-    check_info(info)
-    infohash = hashlib.sha1(bencode(info)).digest()
-
-    single = 'length' in info
 
     torrentinfo = {
         'path': path,
         'file': fname,
         'name': info.get('name', fname),
-        'numfiles': 1 if single else len(info['files']),
-        'length': info['length'] if single else sum(
-            li['length'] for li in info['files'] if 'length' in li)
+        'numfiles': data.numfiles,
+        'length': data.length
     }
 
     for key in ('failure reason', 'warning message', 'announce-list'):
@@ -183,6 +177,6 @@ def parse_torrent(path, return_metainfo=False):
             torrentinfo[key] = data[key]
 
     if return_metainfo:
-        torrentinfo['metainfo'] = data
+        torrentinfo['metainfo'] = data.materialize()
 
-    return torrentinfo, infohash
+    return torrentinfo, data.infohash
@@ -8,7 +8,7 @@ import random
 import urllib
 import base64
 import threading
-from BitTornado.Meta.bencode import bdecode
+from BitTornado.Meta.bencode import fast_bdecode
 from ..Types import TypedDict, TypedList, QueryDict, Port, Infohash, PeerID, \
     IPv4, IPv6
 from BitTornado.Network.Stream import SharedStream
@@ -394,13 +394,13 @@ class HTTPAnnouncer(Announcer):
         response, raw = self.send_query(query)
 
         if response.status == 200:
-            ret = Response(bdecode(raw))
+            ret = Response(fast_bdecode(raw))
             if 'trackerid' in ret:
                 self.trackerid = ret['trackerid']
             return ret
 
         try:
-            return Response(bdecode(raw))
+            return Response(fast_bdecode(raw))
         except ValueError:
             raise IOError(('http error', response.status, response.reason))
 
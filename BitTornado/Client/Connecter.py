@@ -1,4 +1,5 @@
 from ..Types import Bitfield
+from BitTornado.Network.SocketHandler import FileSlice
 from BitTornado.clock import clock
 
 DEBUG1 = False
@@ -27,9 +28,11 @@ class Connection(object):
         self.connecter = connecter      # Connecter
         self.ccount = ccount            # Connecter.ccount (at time of init)
         self.got_anything = False       # Bool (set once)
-        self.next_upload = None         # Connection (linked-list)
+        self.queued = False             # Bool (waiting to send)
+        self.upload_bucket = connecter.ratelimiter.peer_bucket(
+            connecter.config['max_peer_upload_rate'])   # TokenBucket
         self.outqueue = []              # [bytes]
-        self.partial_message = None     # bytes
+        self.partial_message = None     # [bytes, piece or FileSlice...]
         self.download = None            # Downloader.SingleDownload
         self.upload = None              # Uploader.Upload
         self.send_choke_queued = False  # Bool (togglable)
@@ -40,6 +43,7 @@ class Connection(object):
         self.get_readable_id = connection.get_readable_id
         self.is_locally_initiated = connection.is_locally_initiated
         self.is_encrypted = connection.is_encrypted
+        self.can_sendfile = connection.can_sendfile
 
     def get_ip(self, real=False):
         return self.connection.get_ip(real)
@@ -120,21 +124,46 @@ class Connection(object):
             if s is None:
                 return 0
             index, begin, piece = s
-            self.partial_message = b''.join((
-                (len(piece) + 9).to_bytes(4, 'big'), PIECE,
-                index.to_bytes(4, 'big'), begin.to_bytes(4, 'big'),
-                piece.tostring()))
+            if isinstance(piece, list):
+                # (file, offset, length) regions, sent straight from disk
+                piece = [FileSlice(*region) for region in piece]
+                length = sum(len(fslice) for fslice in piece)
+            else:
+                if not isinstance(piece, (bytes, memoryview)):
+                    # Read buffers are reused once released, so keep a copy
+                    piece = bytes(piece)
+                length = len(piece)
+                # Sent in parts as the rate limiter allows, without copying
+                piece = [memoryview(piece)]
+            header = b''.join((
+                (length + 9).to_bytes(4, 'big'), PIECE,
+                index.to_bytes(4, 'big'), begin.to_bytes(4, 'big')))
+            self.partial_message = [header] + piece
             if DEBUG1:
                 print((self.ccount, 'sending chunk', index, begin,
-                       begin + len(piece)))
-
-        if nbytes < len(self.partial_message):
-            self.connection.send_message_raw(self.partial_message[:nbytes])
-            self.partial_message = self.partial_message[nbytes:]
-            return nbytes
-
-        q = [self.partial_message]
+                       begin + length))
+
+        return self._send_parts(nbytes)
+
+    def _send_parts(self, nbytes):
+        """Send up to nbytes of a partial message held as a list of parts,
+        passing on views of the parts rather than joining them"""
+        parts = self.partial_message
+        sent = 0
+        while parts and sent < nbytes:
+            part = parts.pop(0)
+            if len(part) > nbytes - sent:
+                parts.insert(0, part[nbytes - sent:])
+                part = part[:nbytes - sent]
+            self.connection.send_message_raw(part)
+            sent += len(part)
+        if parts:
+            return sent
         self.partial_message = None
+        return sent + self._send_queued([])
+
+    def _send_queued(self, q):
+        """Send q followed by messages held back while a piece was sent"""
         if self.send_choke_queued:
             self.send_choke_queued = False
             self.outqueue.append(b'\x00\x00\x00\x01' + CHOKE)
@@ -143,7 +172,8 @@ class Connection(object):
         q.extend(self.outqueue)
         self.outqueue = []
         q = b''.join(q)
-        self.connection.send_message_raw(q)
+        if q:
+            self.connection.send_message_raw(q)
         return len(q)
 
     def get_upload(self):
@@ -178,7 +208,7 @@ class Connecter(object):
         self.totalup = totalup          # Measure(max_rate_period,
                                         #         upload_rate_fudge)
         self.config = config            # {flag: value}
-        self.ratelimiter = ratelimiter  # RateLimiter
+        self.ratelimiter = ratelimiter  # RateClass
         self.sched = sched              # RawServer.add_task
         self.rate_capped = False
         self.connections = {}           # {Encrypter.Connection: Connection}
@@ -210,8 +240,8 @@ class Connecter(object):
 
     def connection_flushed(self, connection):
         conn = self.connections[connection]
-        if conn.next_upload is None and (conn.partial_message is not None or
-                                         len(conn.upload.buffer) > 0):
+        if not conn.queued and (conn.partial_message is not None or
+                                len(conn.upload.buffer) > 0):
             self.ratelimiter.queue(conn)
 
     def got_piece(self, i):
@@ -1,9 +1,13 @@
 import random
 from .CurrentRateMeasure import Measure
+from .RateLimiter import TokenBucket, DOWNLOAD_BURST
 from ..Types import Bitfield
 from BitTornado.clock import clock
 
 EXPIRE_TIME = 60 * 60
+# Round trips of data to keep requested from a peer, so that the pipe fills
+# faster than the rate measured from it grows
+RTT_DEPTH = 2
 
 
 class PerIPStats:
@@ -61,33 +65,71 @@ class SingleDownload:
         self.last2 = -1000
         self.example_interest = None
         self.backlog = 2
+        # Lowest time from sending a request to its piece arriving, and the
+        # request being timed
+        self.rtt = None
+        self.timed = None
+        self.bucket = TokenBucket(downloader.bucket, DOWNLOAD_BURST)
+        self.bucket.set_rate(downloader.peer_download_rate)
+        self.held = False       # Whether held back by the rate limits
         self.ip = connection.get_ip()
         self.guard = BadDataGuard(self)
 
     def _backlog(self, just_unchoked):
-        self.backlog = min(
-            2 + int(4 * self.measure.get_rate() / self.downloader.chunksize),
-            2 * just_unchoked + self.downloader.queue_limit())
-        if self.backlog > 50:
-            self.backlog = int(max(50, self.backlog * 0.075))
+        rate = self.measure.get_rate()
+        backlog = 2 + int(4 * rate / self.downloader.chunksize)
+        if backlog > 50:
+            backlog = int(max(50, backlog * 0.075))
+        if self.rtt is not None:
+            # Keep the bandwidth-delay product requested, however long the
+            # round trip
+            backlog = max(backlog, 2 + int(RTT_DEPTH * rate * self.rtt /
+                                           self.downloader.chunksize))
+        self.backlog = min(backlog, self.downloader.backlog,
+                           2 * just_unchoked +
+                           self.downloader.queue_limit(self.bucket))
         return self.backlog
 
+    def _sent(self, request):
+        """Time a request just sent, unless one is being timed already"""
+        if self.timed is None:
+            self.timed = (request, clock())
+
+    def _cancelled(self, request):
+        """Stop timing a request no longer expected"""
+        if self.timed is not None and self.timed[0] == request:
+            self.timed = None
+
+    def _got_rtt(self, rtt):
+        # Queueing behind our own requests and the peer's other uploads
+        # only adds to a round trip, and would deepen the pipe further if
+        # counted, so the lowest is kept
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+
     def disconnected(self):
         self.downloader.lost_peer(self)
         if self.have.complete:
             self.downloader.picker.lost_seed()
         else:
-            for i, have in enumerate(self.have):
-                if have:
-                    self.downloader.picker.lost_have(i)
+            self.downloader.picker.lost_bitfield(self.have)
         if self.have.complete and self.downloader.storage.is_endgame():
             self.downloader.add_disconnected_seed(
                 self.connection.get_readable_id())
         self._letgo()
         self.guard.download = None
 
+    def admit(self):
+        """Request as far as the rate limits allow, once they have woken
+        this download from being held back"""
+        if self.held:
+            self.held = False
+            if not self.choked:
+                self._request_more()
+
     def _letgo(self):
-        self.downloader.queued_out.discard(self)
+        self.held = False
+        self.timed = None
         if not self.active_requests:
             return
         if self.downloader.endgamemode:
@@ -95,7 +137,7 @@ class SingleDownload:
             return
         lost = set()
         for index, begin, length in self.active_requests:
-            self.downloader.storage.request_lost(index, begin, length)
+            self.downloader.request_lost(index, begin, length)
             lost.add(index)
         self.active_requests = []
         if self.downloader.paused:
@@ -149,8 +191,13 @@ class SingleDownload:
         except ValueError:
             self.downloader.discarded += length
             return False
+        if self.timed is not None and self.timed[0] == (index, begin, length):
+            self._got_rtt(clock() - self.timed[1])
+            self.timed = None
         if self.downloader.endgamemode:
             self.downloader.all_requests.remove((index, begin, length))
+        elif (index, begin, length) in self.downloader.duplicates:
+            self.downloader.cancel_duplicates((index, begin, length), self)
         self.last = clock()
         self.last2 = clock()
         self.measure.update_rate(length)
@@ -174,6 +221,7 @@ class SingleDownload:
                                                          length))
                             except ValueError:
                                 continue
+                            d._cancelled((index, begin, length))
                             d.connection.send_cancel(index, begin, length)
                             d.fix_download_endgame()
                     else:
@@ -191,8 +239,10 @@ class SingleDownload:
             return
         if len(self.active_requests) >= self._backlog(new_unchoke):
             if not (self.active_requests or self.backlog):
-                self.downloader.queued_out.add(self)
+                self.downloader.queue_out(self)
             return
+        if self.downloader.picker.deadlines:
+            self._request_urgent()
         lost_interests = []
         while len(self.active_requests) < self.backlog:
             interest = self.downloader.picker.next(
@@ -208,7 +258,8 @@ class SingleDownload:
                 self.downloader.picker.requested(interest)
                 self.active_requests.append((interest, begin, length))
                 self.connection.send_request(interest, begin, length)
-                self.downloader.chunk_requested(length)
+                self._sent((interest, begin, length))
+                self.downloader.chunk_requested(length, self.bucket)
                 if not self.downloader.storage.do_I_have_requests(interest):
                     loop = False
                     lost_interests.append(interest)
@@ -237,12 +288,37 @@ class SingleDownload:
         if self.downloader.storage.is_endgame():
             self.downloader.start_endgame()
 
+    def _request_urgent(self):
+        """Duplicate the requests other peers have outstanding for pieces
+        near their deadlines, as endgame mode does for every piece"""
+        downloader = self.downloader
+        for index in downloader.picker.near_deadline():
+            # Pieces with blocks left to request are picked as usual
+            if not self.have[index] or \
+                    downloader.storage.do_I_have_requests(index):
+                continue
+            for d in downloader.downloads:
+                if d is self:
+                    continue
+                for request in d.active_requests:
+                    if len(self.active_requests) >= self.backlog:
+                        return
+                    if request[0] != index or request in self.active_requests:
+                        continue
+                    self.send_interested()
+                    self.active_requests.append(request)
+                    downloader.duplicates[request] = \
+                        downloader.duplicates.get(request, 1) + 1
+                    self.connection.send_request(*request)
+                    self._sent(request)
+                    downloader.chunk_requested(request[2], self.bucket)
+
     def fix_download_endgame(self, new_unchoke=False):
         if self.downloader.paused:
             return
         if len(self.active_requests) >= self._backlog(new_unchoke):
             if not (self.active_requests or self.backlog) and not self.choked:
-                self.downloader.queued_out.add(self)
+                self.downloader.queue_out(self)
             return
         want = [a for a in self.downloader.all_requests
                 if self.have[a[0]] and a not in self.active_requests]
@@ -258,7 +334,8 @@ class SingleDownload:
         self.active_requests.extend(want)
         for piece, begin, length in want:
             self.connection.send_request(piece, begin, length)
-            self.downloader.chunk_requested(length)
+            self._sent((piece, begin, length))
+            self.downloader.chunk_requested(length, self.bucket)
 
     def got_have(self, index):
         if index == self.downloader.numpieces - 1:
@@ -318,9 +395,7 @@ class SingleDownload:
         if have.complete:
             self.downloader.picker.got_seed()
         else:
-            for i, havethis in enumerate(have):
-                if havethis:
-                    self.downloader.picker.got_have(i)
+            self.downloader.picker.got_bitfield(have)
         if self.downloader.endgamemode and not self.downloader.paused:
             for piece, _, _ in self.downloader.all_requests:
                 if self.have[piece]:
@@ -345,7 +420,7 @@ class SingleDownload:
 class Downloader:
     def __init__(self, storage, picker, backlog, max_rate_period,
                  numpieces, chunksize, measurefunc, snub_time,
-                 kickbans_ok, kickfunc, banfunc):
+                 kickbans_ok, kickfunc, banfunc, rate_class=None):
         self.storage = storage
         self.picker = picker
         self.backlog = backlog
@@ -370,40 +445,53 @@ class Downloader:
         self.endgamemode = False
         self.endgame_queued_pieces = []
         self.all_requests = []
+        # Requests held by several downloads outside endgame mode, and by
+        # how many
+        self.duplicates = {}
         self.discarded = 0
-#        self.download_rate = 25000  # 25K/s test rate
-        self.download_rate = 0
-        self.bytes_requested = 0
-        self.last_time = clock()
-        self.queued_out = set()
-        self.requeueing = False
+        # Requests are charged to the bucket limiting the torrent's download
+        # rate, and to those it is nested in, through each peer's own. The
+        # rate class wakes downloads held back by them in turn with other
+        # torrents; without one, downloads are not to be rate limited
+        self.rate_class = rate_class
+        if rate_class is None:
+            self.bucket = TokenBucket(burst=DOWNLOAD_BURST)
+        else:
+            self.bucket = rate_class.down
+        self.peer_download_rate = 0
         self.paused = False
 
     def set_download_rate(self, rate):
-        self.download_rate = rate * 1000
-        self.bytes_requested = 0
+        self.bucket.set_rate(rate * 1000)
 
-    def queue_limit(self):
-        if not self.download_rate:
+    def set_peer_download_rate(self, rate):
+        self.peer_download_rate = rate * 1000
+        for d in self.downloads:
+            d.bucket.set_rate(self.peer_download_rate)
+
+    def queue_limit(self, bucket=None):
+        """Number of requests the rate limits allow, a bucket in credit
+        allowing one more than it covers"""
+        if bucket is None:
+            bucket = self.bucket
+        credit = bucket.credit(clock())
+        if credit is None:
             return 10e10    # that's a big queue!
-        t = clock()
-        self.bytes_requested -= (t - self.last_time) * self.download_rate
-        self.last_time = t
-        if not self.requeueing and self.queued_out and \
-                self.bytes_requested < 0:
-            self.requeueing = True
-            q = list(self.queued_out)
-            random.shuffle(q)
-            self.queued_out = set()
-            for d in q:
-                d._request_more()
-            self.requeueing = False
-        if -self.bytes_requested > 5 * self.download_rate:
-            self.bytes_requested = -5 * self.download_rate
-        return max(int(-self.bytes_requested / self.chunksize), 0)
-
-    def chunk_requested(self, size):
-        self.bytes_requested += size
+        # Owing less than a byte is not owing, as for TokenBucket.in_debt,
+        # so a download the rate class wakes may always request
+        if credit <= -1:
+            return 0
+        return int(max(credit, 0) / self.chunksize) + 1
+
+    def queue_out(self, download):
+        """Hold back a download the rate limits allow no requests, for the
+        rate class to wake in turn"""
+        if not download.held:
+            download.held = True
+            self.rate_class.queue_download(download)
+
+    def chunk_requested(self, size, bucket=None):
+        (self.bucket if bucket is None else bucket).spend(size)
 
     external_data_received = chunk_requested
 
@@ -439,6 +527,39 @@ class Downloader:
             d.example_interest = index
             d.send_interested()
 
+    def request_lost(self, index, begin, length):
+        """Return a request to storage, unless another download holds a
+        duplicate of it"""
+        request = (index, begin, length)
+        count = self.duplicates.get(request)
+        if count is None:
+            self.storage.request_lost(index, begin, length)
+        elif count > 2:
+            self.duplicates[request] = count - 1
+        else:
+            del self.duplicates[request]
+
+    def cancel_duplicates(self, request, download):
+        """Cancel the duplicates of a request download has received"""
+        del self.duplicates[request]
+        cancelled = [d for d in self.downloads
+                     if d is not download and request in d.active_requests]
+        for d in cancelled:
+            d.active_requests.remove(request)
+            d._cancelled(request)
+            d.connection.send_cancel(*request)
+        for d in cancelled:
+            d._request_more()
+
+    def check_deadlines(self):
+        """Request pieces as their deadlines near from peers unchoking us,
+        though nothing else has happened"""
+        if self.endgamemode or self.paused:
+            return
+        for d in self.downloads:
+            if not d.choked:
+                d._request_more()
+
     def has_downloaders(self):
         return len(self.downloads)
 
@@ -536,10 +657,12 @@ class Downloader:
                     hit = True
                     d.connection.send_cancel(index, nb, nl)
                     if not self.endgamemode:
-                        self.storage.request_lost(index, nb, nl)
+                        self.request_lost(index, nb, nl)
             if hit:
                 d.active_requests = [r for r in d.active_requests
                                      if r[0] not in pieces]
+                if d.timed is not None and d.timed[0][0] in pieces:
+                    d.timed = None
                 d._request_more()
             if not self.endgamemode and d.choked:
                 d._check_interests()
@@ -573,8 +696,12 @@ class Downloader:
             if d.active_requests:
                 assert d.interested and not d.choked
             for request in d.active_requests:
-                assert request not in self.all_requests
+                if request in self.all_requests:
+                    assert request in self.duplicates
+                    continue
                 self.all_requests.append(request)
+        # Endgame mode duplicates every request
+        self.duplicates = {}
         for d in self.downloads:
             d.fix_download_endgame()
 
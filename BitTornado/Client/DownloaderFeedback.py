@@ -62,6 +62,8 @@ class DownloaderFeedback:
             else:
                 a['completed'] = 1.0
             a['speed'] = d.connection.download.peermeasure.get_rate()
+            a['backlog'] = d.backlog
+            a['rtt'] = d.rtt
 
             l.append(a)
 
@@ -83,6 +85,8 @@ class DownloaderFeedback:
                 a['dtotal'] = dl.measure.get_total()
                 a['completed'] = 1.0
                 a['speed'] = None
+                a['backlog'] = None
+                a['rtt'] = None
 
                 l.append(a)
 
@@ -1,8 +1,22 @@
 import random
+from collections import Counter
 from BitTornado.clock import clock
+from ..Types import Bitfield
 
 
 class PiecePicker:
+    """Choose pieces to request, rarest first within priority levels
+
+    Pieces wanted are kept in levels of interests by priority and the
+    number of peers having them, each level a set of bits packed as in a
+    Bitfield, so the pieces a peer has at a level are found by intersecting
+    bitfields, not testing pieces one by one, and a peer's whole bitfield
+    moves its pieces between levels at once. Pieces bumped after failing a
+    hash check are left out of the bits, so they are tried after the rest
+    of their level.
+
+    Pieces given deadlines, as for streaming, are picked before any other,
+    soonest due first."""
     def __init__(self, numpieces,
                  rarest_first_cutoff=1, rarest_first_priority_cutoff=3,
                  priority_step=20):
@@ -27,17 +41,20 @@ class PiecePicker:
         self.seed_time = None
         self.superseed = False
         self.seeds_connected = 0
+        self.deadlines = {}
+        self.stream_pieces = []
+        self.urgency = 0
         self._init_interests()
 
     def _init_interests(self):
-        self.interests = [[] for _ in range(self.priority_step)]
+        self.level_bits = [bytearray((self.numpieces + 7) // 8)
+                           for _ in range(self.priority_step)]
+        self.level_bits.append(Bitfield(self.numpieces, val=True).bits)
+        # Integers of level_bits, as intersected, until a level changes
+        self.level_ints = [None] * len(self.level_bits)
+        self.level_sizes = [0] * self.priority_step + [self.numpieces]
+        self.bumped = set()
         self.level_in_interests = [self.priority_step] * self.numpieces
-        interests = list(range(self.numpieces))
-        random.shuffle(interests)
-        self.pos_in_interests = [0] * self.numpieces
-        for i in range(self.numpieces):
-            self.pos_in_interests[interests[i]] = i
-        self.interests.append(interests)
 
     def got_have(self, piece):
         self.totalcount += 1
@@ -61,10 +78,9 @@ class PiecePicker:
             self.level_in_interests[piece] += 1
         elif self.has[piece] or self.priority[piece] == -1:
             return
-        if numint == len(self.interests) - 1:
-            self.interests.append([])
-        self._shift_over(piece, self.interests[numint],
-                         self.interests[numint + 1])
+        if numint == len(self.level_bits) - 1:
+            self._add_level()
+        self._shift_over(piece, numint, numint + 1)
 
     def lost_have(self, piece):
         self.totalcount -= 1
@@ -83,29 +99,116 @@ class PiecePicker:
             self.level_in_interests[piece] -= 1
         elif self.has[piece] or self.priority[piece] == -1:
             return
-        self._shift_over(piece, self.interests[numint],
-                         self.interests[numint - 1])
+        self._shift_over(piece, numint, numint - 1)
+
+    def got_bitfield(self, have):
+        """Count every piece of a peer's Bitfield, as got_have would"""
+        self._count_bitfield(have, 1)
+
+    def lost_bitfield(self, have):
+        """Uncount every piece of a peer's Bitfield, as lost_have would"""
+        self._count_bitfield(have, -1)
+
+    @staticmethod
+    def _shift_counts(counts, numbers, delta):
+        """Move the pieces counted at each number to number + delta"""
+        for number, count in numbers.items():
+            counts[number] -= count
+            if number + delta == len(counts):
+                counts.append(0)
+            counts[number + delta] += count
+
+    def _count_bitfield(self, have, delta):
+        pieces = list(have.indices())
+        if not pieces:
+            return
+        numhaves = self.numhaves
+        levels = self.level_in_interests
+        has = self.has
+        if self.superseed:
+            moving = pieces
+        elif not self.done:
+            priority = self.priority
+            moving = [piece for piece in pieces
+                      if not has[piece] and priority[piece] != -1]
+        else:
+            moving = []
+        before = [numhaves[piece] for piece in pieces]
+        moved = Counter([levels[piece] for piece in moving])
+        if self.superseed or not self.done:
+            for piece in pieces:
+                numhaves[piece] += delta
+                levels[piece] += delta
+        else:
+            for piece in pieces:
+                numhaves[piece] += delta
+        self.totalcount += delta * len(pieces)
+        self._shift_counts(self.crosscount, Counter(before), delta)
+        if not self.done:
+            self._shift_counts(self.crosscount2, Counter(
+                [numint + has[piece]
+                 for numint, piece in zip(before, pieces)]), delta)
+        if self.superseed and delta > 0:
+            for piece in pieces:
+                self.seed_got_haves[piece] += 1
+        if not moved:
+            return
+        while len(self.level_bits) <= max(moved) + delta:
+            self._add_level()
+        for level, count in moved.items():
+            self.level_sizes[level] -= count
+            self.level_sizes[level + delta] += count
+
+        # Every piece the peer has at a level moves, so the bits of each
+        # level are recomputed over whole integers
+        have_bits = int(have)
+        old = {level: self._level_int(level)
+               for level in set(moved).union(level + delta
+                                             for level in moved)}
+        for level, bits in old.items():
+            new = bits & ~have_bits
+            if level - delta in moved:
+                new |= old[level - delta] & have_bits
+            self.level_bits[level][:] = new.to_bytes(
+                len(self.level_bits[level]), 'big')
+            self.level_ints[level] = new
+        for piece in self.bumped.intersection(moving):
+            self.bumped.remove(piece)
+            self._set_level_bit(levels[piece], piece)
 
-    def _shift_over(self, piece, l1, l2):
+    def _add_level(self):
+        self.level_bits.append(bytearray((self.numpieces + 7) // 8))
+        self.level_ints.append(None)
+        self.level_sizes.append(0)
+
+    def _set_level_bit(self, level, piece):
+        self.level_bits[level][piece >> 3] |= 0x80 >> (piece & 7)
+        self.level_ints[level] = None
+
+    def _clear_level_bit(self, level, piece):
+        self.level_bits[level][piece >> 3] &= ~(0x80 >> (piece & 7)) & 0xff
+        self.level_ints[level] = None
+
+    def _level_int(self, level):
+        value = self.level_ints[level]
+        if value is None:
+            value = self.level_ints[level] = \
+                int.from_bytes(self.level_bits[level], 'big')
+        return value
+
+    def _shift_over(self, piece, level1, level2):
         assert self.superseed or not self.has[piece] and \
             self.priority[piece] >= 0
-        parray = self.pos_in_interests
-        p = parray[piece]
-        assert l1[p] == piece
-        q = l1[-1]
-        l1[p] = q
-        parray[q] = p
-        del l1[-1]
-        newp = random.randrange(len(l2) + 1)
-        if newp == len(l2):
-            parray[piece] = len(l2)
-            l2.append(piece)
+        pos, mask = piece >> 3, 0x80 >> (piece & 7)
+        if piece in self.bumped:
+            self.bumped.remove(piece)
         else:
-            old = l2[newp]
-            parray[old] = len(l2)
-            l2.append(old)
-            l2[newp] = piece
-            parray[piece] = newp
+            self.level_bits[level1][pos] &= ~mask & 0xff
+            self.level_ints[level1] = None
+        self.level_bits[level2][pos] |= mask
+        self.level_ints[level2] = None
+        self.level_sizes[level1] -= 1
+        self.level_sizes[level2] += 1
 
     def got_seed(self):
         self.seeds_connected += 1
@@ -118,8 +221,9 @@ class PiecePicker:
         self.numhaves = [i - 1 for i in self.numhaves]
         if self.superseed or not self.done:
             self.level_in_interests = [i - 1 for i in self.level_in_interests]
-            if self.interests:
-                del self.interests[0]
+            del self.level_bits[0]
+            del self.level_ints[0]
+            del self.level_sizes[0]
         del self.crosscount[0]
         if not self.done:
             del self.crosscount2[0]
@@ -132,14 +236,31 @@ class PiecePicker:
     def requested(self, piece):
         self.started.add(piece)
 
+    def set_deadlines(self, deadlines, urgency=0):
+        """Pick pieces by deadline, a clock() time for each, before rarest
+        first; those due within urgency seconds are near_deadline"""
+        self.deadlines = {piece: when for piece, when in deadlines.items()
+                          if not self.has[piece]}
+        self.stream_pieces = sorted(self.deadlines, key=self.deadlines.get)
+        self.urgency = urgency
+
+    def near_deadline(self):
+        """Pieces with deadlines due within the urgency, soonest first"""
+        due = clock() + self.urgency
+        pieces = []
+        for piece in self.stream_pieces:
+            if self.deadlines[piece] > due:
+                break
+            pieces.append(piece)
+        return pieces
+
     def _remove_from_interests(self, piece, keep_partial=False):
-        l = self.interests[self.level_in_interests[piece]]
-        p = self.pos_in_interests[piece]
-        assert l[p] == piece
-        q = l[-1]
-        l[p] = q
-        self.pos_in_interests[q] = p
-        del l[-1]
+        level = self.level_in_interests[piece]
+        if piece in self.bumped:
+            self.bumped.remove(piece)
+        else:
+            self._clear_level_bit(level, piece)
+        self.level_sizes[level] -= 1
         try:
             self.started.remove(piece)
             if keep_partial:
@@ -161,8 +282,15 @@ class PiecePicker:
                 self.crosscount2.append(0)
             self.crosscount2[numhaves + 1] += 1
         self._remove_from_interests(piece)
+        if piece in self.deadlines:
+            del self.deadlines[piece]
+            self.stream_pieces.remove(piece)
 
     def next(self, haves, wantfunc, complete_first=False):
+        for piece in self.stream_pieces:
+            if haves[piece] and self.priority[piece] >= 0 and \
+                    wantfunc(piece):
+                return piece
         cutoff = self.numgot < self.rarest_first_cutoff
         complete_first = (complete_first or cutoff) and not haves.complete
         best = None
@@ -173,35 +301,58 @@ class PiecePicker:
                     best = i
                     bestnum = self.level_in_interests[i]
         if best is not None:
-            if complete_first or cutoff and len(self.interests) > self.cutoff:
+            if complete_first or cutoff and len(self.level_bits) > self.cutoff:
                 return best
+        nlevels = len(self.level_bits)
         if haves.complete:
-            r = [(0, min(bestnum, len(self.interests)))]
-        elif cutoff and len(self.interests) > self.cutoff:
-            r = [(self.cutoff, min(bestnum, len(self.interests))),
-                 (0, self.cutoff)]
+            r = [(0, min(bestnum, nlevels))]
+        elif cutoff and nlevels > self.cutoff:
+            r = [(self.cutoff, min(bestnum, nlevels)), (0, self.cutoff)]
         else:
-            r = [(0, min(bestnum, len(self.interests)))]
+            r = [(0, min(bestnum, nlevels))]
+        have_bits = None if haves.complete else int(haves)
         for lo, hi in r:
             for i in range(lo, hi):
-                for j in self.interests[i]:
-                    if haves[j] and wantfunc(j):
+                if not self.level_sizes[i]:
+                    continue
+                candidates = self._level_int(i)
+                if have_bits is not None:
+                    candidates &= have_bits
+                piece = self._pick(candidates, wantfunc)
+                if piece is not None:
+                    return piece
+                for j in self.bumped:
+                    if self.level_in_interests[j] == i and haves[j] and \
+                            wantfunc(j):
                         return j
         if best is not None:
             return best
         return None
 
+    def _pick(self, candidates, wantfunc=None):
+        """Return a wanted piece among candidates, bits as in the integer
+        of a Bitfield, or None
+
+        Candidates are tried from a random piece onward, wrapping around,
+        so peers choosing from the same level spread over its pieces."""
+        width = len(self.level_bits[0]) * 8
+        while candidates:
+            start = random.randrange(self.numpieces)
+            onward = candidates & ((1 << (width - start)) - 1)
+            piece = width - (onward or candidates).bit_length()
+            if wantfunc is None or wantfunc(piece):
+                return piece
+            candidates ^= 1 << (width - 1 - piece)
+        return None
+
     def am_I_complete(self):
         return self.done
 
     def bump(self, piece):
-        l = self.interests[self.level_in_interests[piece]]
-        pos = self.pos_in_interests[piece]
-        del l[pos]
-        l.append(piece)
-        for i in range(pos, len(l)):
-            self.pos_in_interests[l[i]] = i
         self.started.discard(piece)
+        if piece not in self.bumped:
+            self._clear_level_bit(self.level_in_interests[piece], piece)
+            self.bumped.add(piece)
 
     def set_priority(self, piece, p):
         if self.superseed:
@@ -221,20 +372,10 @@ class PiecePicker:
             self.level_in_interests[piece] = level
             if self.has[piece]:
                 return True
-            while len(self.interests) < level + 1:
-                self.interests.append([])
-            l2 = self.interests[level]
-            parray = self.pos_in_interests
-            newp = random.randrange(len(l2) + 1)
-            if newp == len(l2):
-                parray[piece] = len(l2)
-                l2.append(piece)
-            else:
-                old = l2[newp]
-                parray[old] = len(l2)
-                l2.append(old)
-                l2[newp] = piece
-                parray[piece] = newp
+            while len(self.level_bits) < level + 1:
+                self._add_level()
+            self._set_level_bit(level, piece)
+            self.level_sizes[level] += 1
             if piece in self.removed_partials:
                 self.removed_partials.remove(piece)
                 self.started.add(piece)
@@ -245,9 +386,9 @@ class PiecePicker:
         self.level_in_interests[piece] = newint
         if self.has[piece]:
             return False
-        while len(self.interests) < newint + 1:
-            self.interests.append([])
-        self._shift_over(piece, self.interests[numint], self.interests[newint])
+        while len(self.level_bits) < newint + 1:
+            self._add_level()
+        self._shift_over(piece, numint, newint)
         return False
 
     def is_blocked(self, piece):
@@ -291,20 +432,21 @@ class PiecePicker:
                 # probably another stealthed seed
                 if connection.upload.skipped_count >= 3:
                     return -1   # signal to close it
-        for tier in self.interests:
-            for piece in tier:
-                if not connection.download.have[piece]:
-                    seedint = self.level_in_interests[piece]
-                    # tweak it up one, so you don't duplicate effort
-                    self.level_in_interests[piece] += 1
-                    if seedint == len(self.interests) - 1:
-                        self.interests.append([])
-                    self._shift_over(piece, self.interests[seedint],
-                                     self.interests[seedint + 1])
-                    self.seed_got_haves[piece] = 0       # reset this
-                    self.seed_connections[connection] = piece
-                    connection.upload.seed_have_list.append(piece)
-                    return piece
+        have_bits = int(connection.download.have)
+        for seedint, size in enumerate(self.level_sizes):
+            if not size:
+                continue
+            piece = self._pick(self._level_int(seedint) & ~have_bits)
+            if piece is not None:
+                # tweak it up one, so you don't duplicate effort
+                self.level_in_interests[piece] += 1
+                if seedint == len(self.level_bits) - 1:
+                    self._add_level()
+                self._shift_over(piece, seedint, seedint + 1)
+                self.seed_got_haves[piece] = 0       # reset this
+                self.seed_connections[connection] = piece
+                connection.upload.seed_have_list.append(piece)
+                return piece
         return -1       # something screwy; terminate connection
 
     def lost_peer(self, connection):
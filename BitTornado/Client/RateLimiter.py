@@ -1,4 +1,5 @@
 import math
+from collections import deque
 from BitTornado.clock import clock
 from .CurrentRateMeasure import Measure
 
@@ -18,19 +19,163 @@ UP_DELAY_FIRST = 5
 UP_DELAY_NEXT = 2
 SLOTS_STARTING = 6
 SLOTS_FACTOR = 1.66 / 1000
+# Seconds of their rate buckets may save up while idle
+UPLOAD_BURST = 0.5
+DOWNLOAD_BURST = 5.0
+# Seconds of their rate buckets may owe, after sends not limited here
+MAX_DEBT = 3.0
+
+
+class TokenBucket(object):
+    """Bytes allowed at rate per second, through this bucket and each above
+    it, as the global, torrent and peer limits are nested. A bucket with
+    credit allows a send even if it goes into debt, which later sends wait
+    out; a rate of 0 is unlimited."""
+    def __init__(self, parent=None, burst=UPLOAD_BURST):
+        self.parent = parent
+        self.burst = burst
+        self.set_rate(0)
+
+    def set_rate(self, rate):
+        """Set the rate in bytes per second, discarding credit and debt"""
+        self.rate = rate
+        self.tokens = 0.0
+        self.last = clock()
+
+    def _refill(self, t):
+        self.tokens = min(self.tokens + (t - self.last) * self.rate,
+                          self.rate * self.burst)
+        self.last = t
+
+    def credit(self, t):
+        """Bytes allowed by the most limiting bucket, None if unlimited"""
+        credit = None
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                bucket._refill(t)
+                if credit is None or bucket.tokens < credit:
+                    credit = bucket.tokens
+            bucket = bucket.parent
+        return credit
+
+    def in_debt(self, t):
+        # Owing less than a byte, as rounding may leave, is not owing
+        credit = self.credit(t)
+        return credit is not None and credit <= -1
+
+    def delay(self, t):
+        """Seconds until no bucket is in debt"""
+        delay = 0
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                bucket._refill(t)
+                if bucket.tokens < 0:
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+    def spend(self, amount):
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                bucket.tokens = max(bucket.tokens - amount,
+                                    -bucket.rate * MAX_DEBT)
+            bucket = bucket.parent
+
+
+class RateClass(object):
+    """Limits shared by the connections of a torrent, given to its Connecter
+    and Uploads in place of the RateLimiter it belongs to, and to its
+    Downloader. Classes of a priority take turns sending, a unit each, and
+    letting a download held back by the download limits request again, when
+    none of a higher priority has anything to send or request."""
+    def __init__(self, limiter, priority):
+        self.limiter = limiter
+        self.priority = priority
+        self.up = TokenBucket(limiter.up)
+        self.down = TokenBucket(limiter.down, DOWNLOAD_BURST)
+        self.queued = deque()       # Connections with data to send
+        self.turn = limiter.turns[priority]
+        self.in_turn = False        # Whether in self.turn
+        self.held = False           # Whether waiting out debt
+        # Downloads held back, and as above for taking turns to wake them
+        self.held_downloads = deque()
+        self.down_turn = limiter.down_turns[priority]
+        self.down_in_turn = False
+        self.down_held = False
+
+    def set_upload_rate(self, rate):
+        self.up.set_rate(rate * 1000)
+
+    def set_download_rate(self, rate):
+        self.down.set_rate(rate * 1000)
+
+    def peer_bucket(self, rate):
+        """Bucket limiting uploads to one peer to rate kB/s"""
+        bucket = TokenBucket(self.up)
+        bucket.set_rate(rate * 1000)
+        return bucket
+
+    def queue(self, conn):
+        self.limiter.queue(conn, self)
+
+    def queue_download(self, download):
+        self.limiter.queue_download(download, self)
+
+    def adjust_sent(self, bytes):
+        self.up.spend(bytes)
+        self.limiter.measure.update_rate(bytes)
+
+    def ping(self, delay):
+        self.limiter.ping(delay)
 
 
 class RateLimiter:
+    """Sends uploads for connections in units, within upload rates set
+    globally here, for each RateClass and for each peer. Each send takes
+    the first class of the highest priority with any, and the first
+    connection of that class, and puts both back at the end of their
+    queues. Downloads held back by the download rates are woken alike, one
+    at a time, to request as far as the rates then allow."""
     def __init__(self, sched, unitsize, slotsfunc=lambda x: None):
         self.sched = sched
-        self.last = None
         self.unitsize = unitsize
         self.slotsfunc = slotsfunc
         self.measure = Measure(MAX_RATE_PERIOD)
         self.autoadjust = False
+        self.up = TokenBucket()
+        self.down = TokenBucket(burst=DOWNLOAD_BURST)
         self.upload_rate = MAX_RATE * 1000
+        self.turns = {}             # {priority: deque of RateClass}
+        self.priorities = []        # [deque of RateClass], highest first
+        self.sending = False
+        self.scheduled = False
+        self.down_turns = {}        # As turns, for held back downloads
+        self.down_priorities = []
+        self.admitting = False
+        self.admit_scheduled = False
         self.slots = SLOTS_STARTING    # garbage if not automatic
 
+    @property
+    def upload_rate(self):
+        return self.up.rate
+
+    @upload_rate.setter
+    def upload_rate(self, rate):
+        self.up.set_rate(rate)
+
+    def add_class(self, priority=0):
+        """Make a RateClass for a torrent's connections"""
+        if priority not in self.turns:
+            self.turns[priority] = deque()
+            self.down_turns[priority] = deque()
+            order = sorted(self.turns, reverse=True)
+            self.priorities = [self.turns[p] for p in order]
+            self.down_priorities = [self.down_turns[p] for p in order]
+        return RateClass(self, priority)
+
     def set_upload_rate(self, rate):
         # rate = -1 # test automatic
         if rate < 0:
@@ -47,50 +192,159 @@ class RateLimiter:
         if not rate:
             rate = MAX_RATE
         self.upload_rate = rate * 1000
-        self.lasttime = clock()
-        self.bytes_sent = 0
 
-    def queue(self, conn):
-        assert conn.next_upload is None
-        if self.last is None:
-            self.last = conn
-            conn.next_upload = conn
-            self.try_send(True)
-        else:
-            conn.next_upload = self.last.next_upload
-            self.last.next_upload = conn
-            self.last = conn
+    def set_download_rate(self, rate):
+        self.down.set_rate(rate * 1000)
+
+    def queue(self, conn, rate_class):
+        assert not conn.queued
+        conn.queued = True
+        rate_class.queued.append(conn)
+        self._take_turns(rate_class)
+        if not self.scheduled:
+            self.try_send()
+
+    def _take_turns(self, rate_class):
+        if not (rate_class.in_turn or rate_class.held):
+            rate_class.in_turn = True
+            rate_class.turn.append(rate_class)
+
+    def _resume(self):
+        self.scheduled = False
+        self.try_send()
 
-    def try_send(self, check_time=False):
+    def _release_class(self, rate_class):
+        rate_class.held = False
+        if rate_class.queued:
+            self._take_turns(rate_class)
+            if not self.scheduled:
+                self.try_send()
+
+    def _release_connection(self, conn, rate_class):
+        rate_class.queued.append(conn)
+        self._take_turns(rate_class)
+        if not self.scheduled:
+            self.try_send()
+
+    def try_send(self):
+        if self.sending:
+            return
+        self.sending = True
         t = clock()
-        self.bytes_sent -= (t - self.lasttime) * self.upload_rate
-        self.lasttime = t
-        if check_time:
-            self.bytes_sent = max(self.bytes_sent, 0)
-        cur = self.last.next_upload
-        while self.bytes_sent <= 0:
-            bytes = cur.send_partial(self.unitsize)
-            self.bytes_sent += bytes
-            self.measure.update_rate(bytes)
-            if bytes == 0 or cur.backlogged():
-                if self.last is cur:
-                    self.last = None
-                    cur.next_upload = None
+        while True:
+            if self.up.in_debt(t):
+                self.scheduled = True
+                self.sched(self._resume, self.up.delay(t))
+                break
+            for turn in self.priorities:
+                if turn:
                     break
-                else:
-                    self.last.next_upload = cur.next_upload
-                    cur.next_upload = None
-                    cur = self.last.next_upload
             else:
-                self.last = cur
-                cur = cur.next_upload
-        else:
-            self.sched(self.try_send, self.bytes_sent / self.upload_rate)
+                break
+            rate_class = turn.popleft()
+            rate_class.in_turn = False
+            if rate_class.up.in_debt(t):
+                rate_class.held = True
+                self.sched(lambda c=rate_class: self._release_class(c),
+                           rate_class.up.delay(t))
+                continue
+            conn = rate_class.queued.popleft()
+            if conn.upload_bucket.in_debt(t):
+                # Still queued, to be sent for once out of debt, and the
+                # class keeps its turn
+                self.sched(lambda c=conn, r=rate_class:
+                           self._release_connection(c, r),
+                           conn.upload_bucket.delay(t))
+                if rate_class.queued:
+                    rate_class.in_turn = True
+                    turn.appendleft(rate_class)
+                continue
+            bytes = conn.send_partial(self.unitsize)
+            conn.upload_bucket.spend(bytes)
+            self.measure.update_rate(bytes)
+            if bytes == 0 or conn.backlogged():
+                conn.queued = False
+            else:
+                rate_class.queued.append(conn)
+            if rate_class.queued:
+                self._take_turns(rate_class)
+        self.sending = False
 
     def adjust_sent(self, bytes):
-        self.bytes_sent = min(self.bytes_sent + bytes, self.upload_rate * 3)
+        self.up.spend(bytes)
         self.measure.update_rate(bytes)
 
+    def queue_download(self, download, rate_class):
+        """Hold back a download until the download rates allow it to
+        request, when download.admit() is called"""
+        rate_class.held_downloads.append(download)
+        self._take_download_turns(rate_class)
+        if not self.admit_scheduled:
+            self.admit()
+
+    def _take_download_turns(self, rate_class):
+        if not (rate_class.down_in_turn or rate_class.down_held):
+            rate_class.down_in_turn = True
+            rate_class.down_turn.append(rate_class)
+
+    def _resume_admit(self):
+        self.admit_scheduled = False
+        self.admit()
+
+    def _release_download_class(self, rate_class):
+        rate_class.down_held = False
+        if rate_class.held_downloads:
+            self._take_download_turns(rate_class)
+            if not self.admit_scheduled:
+                self.admit()
+
+    def _release_download(self, download, rate_class):
+        rate_class.held_downloads.append(download)
+        self._take_download_turns(rate_class)
+        if not self.admit_scheduled:
+            self.admit()
+
+    def admit(self):
+        """Wake held back downloads, in turn as uploads are sent, while the
+        download rates allow"""
+        if self.admitting:
+            return
+        self.admitting = True
+        t = clock()
+        while True:
+            if self.down.in_debt(t):
+                self.admit_scheduled = True
+                self.sched(self._resume_admit, self.down.delay(t))
+                break
+            for turn in self.down_priorities:
+                if turn:
+                    break
+            else:
+                break
+            rate_class = turn.popleft()
+            rate_class.down_in_turn = False
+            if rate_class.down.in_debt(t):
+                rate_class.down_held = True
+                self.sched(lambda c=rate_class:
+                           self._release_download_class(c),
+                           rate_class.down.delay(t))
+                continue
+            download = rate_class.held_downloads.popleft()
+            if download.bucket.in_debt(t):
+                self.sched(lambda d=download, r=rate_class:
+                           self._release_download(d, r),
+                           download.bucket.delay(t))
+                if rate_class.held_downloads:
+                    rate_class.down_in_turn = True
+                    turn.appendleft(rate_class)
+                continue
+            # Requesting spends from the buckets, or holds the download
+            # back again
+            download.admit()
+            if rate_class.held_downloads:
+                self._take_download_turns(rate_class)
+        self.admitting = False
+
     def ping(self, delay):
         if DEBUG:
             print(delay)
@@ -114,8 +368,6 @@ class RateLimiter:
             self.slotsfunc(self.slots)
             if DEBUG:
                 print('adjust down to ', self.upload_rate)
-            self.lasttime = clock()
-            self.bytes_sent = 0
             self.autoadjustup = UP_DELAY_FIRST
         else:   # not flooded
             if self.upload_rate == MAX_RATE:
@@ -128,6 +380,4 @@ class RateLimiter:
             self.slotsfunc(self.slots)
             if DEBUG:
                 print('adjust up to ', self.upload_rate)
-            self.lasttime = clock()
-            self.bytes_sent = 0
             self.autoadjustup = UP_DELAY_NEXT
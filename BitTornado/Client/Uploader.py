@@ -12,6 +12,7 @@ class Upload:
         self.picker = picker
         self.config = config
         self.max_slice_length = config['max_slice_length']
+        self.sendfile = config.get('sendfile', False)
         self.choked = True
         self.cleared = True
         self.interested = False
@@ -59,6 +60,12 @@ class Upload:
         if self.choked or not self.buffer:
             return None
         index, begin, length = self.buffer.pop(0)
+        if self.sendfile and self.connection.can_sendfile():
+            regions = self.storage.get_piece_regions(index, begin, length)
+            if regions is not None:
+                self.measure.update_rate(length)
+                self.totalup.update_rate(length)
+                return (index, begin, regions)
         if self.config['buffer_reads']:
             if index != self.piecedl:
                 if self.piecebuf:
@@ -91,7 +98,7 @@ class Upload:
             return
         if not self.cleared:
             self.buffer.append((index, begin, length))
-        if not self.choked and self.connection.next_upload is None:
+        if not self.choked and not self.connection.queued:
                 self.ratelimiter.queue(self.connection)
 
     def got_cancel(self, index, begin, length):
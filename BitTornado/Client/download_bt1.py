@@ -27,6 +27,7 @@ from BitTornado.Application.ConfigDir import ConfigDir
 from BitTornado.Meta.bencode import bdecode
 from BitTornado.Application.parseargs import parseargs, formatDefinitions
 from BitTornado.Network.BTcrypto import CRYPTO_OK
+from BitTornado.clock import clock
 
 defaults = [
     ('max_uploads', 7,
@@ -37,8 +38,9 @@ defaults = [
         "How many bytes to query for per request."),
     ('upload_unit_size', 1460,
         "when limiting upload rate, how many bytes to send at a time"),
-    ('request_backlog', 10,
-        "maximum number of requests to keep in a single pipe at once."),
+    ('request_backlog', 500,
+        "maximum number of requests to keep in a single pipe at once, "
+        "however long the peer's round trip."),
     ('max_message_length', 2 ** 23,
         "maximum length prefix encoding you'll accept over the wire - "
         "larger values get the connection dropped."),
@@ -85,6 +87,9 @@ defaults = [
     ('ipv6_enabled', 0, 'allow the client to connect to peers via IPv6'),
     ('ipv6_binds_v4', autodetect_socket_style(),
         "set if an IPv6 server socket won't also field IPv4 connections"),
+    ('poll_backend', '',
+        "socket event backend: 'poll', 'select' or 'selectors' "
+        "(blank = best available of poll or select)"),
     ('upnp_nat_access', 1,
         'attempt to autoconfigure a UPnP router to forward a server port '
         '(0 = disabled, 1 = mode 1 [fast], 2 = mode 2 [slow])'),
@@ -107,16 +112,37 @@ defaults = [
         'number of peers at which to stop initiating new connections'),
     ('check_hashes', 1,
         'whether to check hashes on disk'),
+    ('check_workers', 0,
+        'number of threads to use when checking existing data '
+        '(0 = one per processor)'),
     ('max_upload_rate', 0,
         'maximum kB/s to upload at (0 = no limit, -1 = automatic)'),
     ('max_download_rate', 0,
         'maximum kB/s to download at (0 = no limit)'),
+    ('max_torrent_upload_rate', 0,
+        'maximum kB/s to upload each torrent at, within max_upload_rate '
+        '(0 = no limit)'),
+    ('max_torrent_download_rate', 0,
+        'maximum kB/s to download each torrent at, within max_download_rate '
+        '(0 = no limit)'),
+    ('max_peer_upload_rate', 0,
+        'maximum kB/s to upload to any one peer at (0 = no limit)'),
+    ('max_peer_download_rate', 0,
+        'maximum kB/s to download from any one peer at (0 = no limit)'),
+    ('rate_priority', 0,
+        'priority of uploads of this torrent over those of others sharing '
+        'the upload rate; torrents from private trackers get one more'),
     ('alloc_type', 'normal',
         'allocation type (may be normal, background, pre-allocate or sparse)'),
     ('alloc_rate', 2.0,
         'rate (in MiB/s) to allocate space at using background allocation'),
     ('buffer_reads', 1,
         'whether to buffer disk reads'),
+    ('mmap_reads', 0,
+        'whether to serve uploads from memory-mapped files'),
+    ('sendfile', 0,
+        'whether to send uploads to unencrypted peers directly from disk, '
+        'where supported'),
     ('write_buffer_size', 4,
         'the maximum amount of space to use for buffering disk writes '
         '(in megabytes, 0 = disabled)'),
@@ -162,8 +188,20 @@ defaults = [
         "whether to lock access to files being read"),
     ('auto_flush', 0,
         "minutes between automatic flushes to disk (0 = disabled)"),
+    ('resume_interval', 0,
+        "minutes between saving fast resume data while running, so that a "
+        "restart after a crash only rechecks modified files "
+        "(0 = save on shutdown only)"),
     ('dedicated_seed_id', '',
         "code to send to tracker identifying as a dedicated seed"),
+    ('stream_rate', 1000,
+        "kB/s at which a streamed torrent is assumed read past its cursor, "
+        "to set the deadlines of pieces ahead of it"),
+    ('stream_window', 30,
+        "seconds of reading ahead of a streaming cursor to download in order"),
+    ('stream_urgency', 5,
+        "seconds before its deadline at which a streamed piece is requested "
+        "from several peers at once"),
 ]
 
 argslistheader = 'Arguments are:\n\n'
@@ -251,6 +289,8 @@ class BT1Download:
         self.spewflag = threading.Event()
         self.superseedflag = threading.Event()
         self.whenpaused = None
+        self.cursor = None
+        self.stream_ticking = False
         self.finflag = threading.Event()
         self.rerequest = None
         self.tcp_ack_fudge = config['tcp_ack_fudge']
@@ -455,7 +495,7 @@ class BT1Download:
     def _received_raw_data(self, x):
         if self.tcp_ack_fudge:
             x = int(x * self.tcp_ack_fudge)
-            self.ratelimiter.adjust_sent(x)
+            self.rate_class.adjust_sent(x)
 
     def _received_data(self, x):
         self.downmeasure.update_rate(x)
@@ -502,6 +542,14 @@ class BT1Download:
                                            self.config['upload_unit_size'],
                                            self.setConns)
             self.ratelimiter.set_upload_rate(self.config['max_upload_rate'])
+            self.ratelimiter.set_download_rate(
+                self.config['max_download_rate'])
+        priority = self.config['rate_priority']
+        if self.metainfo['info'].get('private'):
+            priority += 1
+        self.rate_class = self.ratelimiter.add_class(priority)
+        self.rate_class.set_upload_rate(
+            self.config['max_torrent_upload_rate'])
 
         self.ratemeasure = RateMeasure()
         self.ratemeasure_datarejected = self.ratemeasure.data_rejected
@@ -511,11 +559,14 @@ class BT1Download:
             self.config['max_rate_period'], self.len_pieces,
             self.config['download_slice_size'], self._received_data,
             self.config['snub_time'], self.config['auto_kick'],
-            self._kick_peer, self._ban_peer)
-        self.downloader.set_download_rate(self.config['max_download_rate'])
+            self._kick_peer, self._ban_peer, self.rate_class)
+        self.downloader.set_download_rate(
+            self.config['max_torrent_download_rate'])
+        self.downloader.set_peer_download_rate(
+            self.config['max_peer_download_rate'])
         self.connecter = Connecter(
             self._make_upload, self.downloader, self.choker, self.len_pieces,
-            self.upmeasure, self.config, self.ratelimiter,
+            self.upmeasure, self.config, self.rate_class,
             self.rawserver.add_task)
         self.encoder = Encoder(
             self.connecter, self.rawserver, self.myid,
@@ -540,6 +591,9 @@ class BT1Download:
 
             # erase old data once you've started modifying it
             self.appdataobj.deleteTorrentData(self.infohash)
+            if self.config['resume_interval']:
+                self.rawserver.add_task(self._save_resume,
+                                        self.config['resume_interval'] * 60)
 
         if self.config['super_seeder']:
             self.set_super_seed()
@@ -624,6 +678,16 @@ class BT1Download:
     def getPortHandler(self):
         return self.encoder
 
+    def _save_resume(self):
+        if self.doneflag.is_set() or self.failed:
+            return
+        self.rawserver.add_task(self._save_resume,
+                                self.config['resume_interval'] * 60)
+        # Resume data describes the files as they are on disk
+        self.storagewrapper.sync()
+        self.appdataobj.writeTorrentData(
+            self.infohash, {'resume data': self.fileselector.pickle()})
+
     def shutdown(self, torrentdata={}):
         if self.checking or self.started:
             self.storagewrapper.sync()
@@ -682,6 +746,97 @@ class BT1Download:
                     self.rerequest.announce(0)
                 self.rawserver.add_task(r)
 
+    def set_cursor(self, offset, rate=None):
+        """Stream from offset bytes into the torrent, read at rate kB/s
+        (stream_rate if not given): pieces ahead are downloaded in order,
+        each by the time it is due to be read"""
+        def s(self=self, offset=offset, rate=rate):
+            self._set_cursor(offset, rate)
+        self.rawserver.add_task(s)
+
+    def clear_cursor(self):
+        """Stop streaming, going back to rarest first"""
+        def s(self=self):
+            self.cursor = None
+            if self.started:
+                self.picker.set_deadlines({})
+        self.rawserver.add_task(s)
+
+    def _set_cursor(self, offset, rate=None):
+        if not self.started or self.doneflag.is_set():
+            return
+        rate = (rate or self.config['stream_rate']) * 1024.0
+        self.cursor = (offset, rate, clock())
+        self._set_deadlines()
+        # A tick still scheduled after the cursor was cleared carries on
+        if not self.stream_ticking:
+            self.stream_ticking = True
+            self.rawserver.add_task(self._stream_tick, 1)
+
+    def _set_deadlines(self):
+        offset, rate, since = self.cursor
+        now = clock()
+        # The cursor moves on as the torrent is read
+        offset += int((now - since) * rate)
+        piece_length = self.storagewrapper.piece_size
+        first = min(offset // piece_length, self.len_pieces - 1)
+        window = max(int(rate * self.config['stream_window']) //
+                     piece_length, 1)
+        self.picker.set_deadlines(
+            {i: now + max(i * piece_length - offset, 0) / rate
+             for i in range(first, min(first + window, self.len_pieces))},
+            self.config['stream_urgency'])
+        self.downloader.check_deadlines()
+
+    def _stream_tick(self):
+        if self.cursor is None or self.doneflag.is_set():
+            self.stream_ticking = False
+            return
+        self._set_deadlines()
+        if not self.picker.deadlines and self.finflag.is_set():
+            self.cursor = None
+            self.stream_ticking = False
+            return
+        self.rawserver.add_task(self._stream_tick, 1)
+
+    def get_available(self, offset):
+        """Number of bytes downloaded in a row from offset, as may be
+        served to a reader"""
+        if not self.storagewrapper:
+            return 0
+        piece_length = self.storagewrapper.piece_size
+        total = self.storage.get_total_length()
+        end = offset - offset % piece_length
+        while end < total and \
+                self.storagewrapper.do_I_have(end // piece_length):
+            end += piece_length
+        return max(min(end, total) - offset, 0)
+
+    def read(self, offset, amount):
+        """Read up to amount bytes from offset into the torrent, as far as
+        they have been downloaded
+
+        Reading may hash-check pieces, so this must be called on the
+        RawServer thread; other threads use request_read."""
+        amount = min(amount, self.get_available(offset))
+        piece_length = self.storagewrapper.piece_size
+        data = bytearray()
+        while len(data) < amount:
+            index, begin = divmod(offset + len(data), piece_length)
+            chunk = self.storagewrapper.get_piece(
+                index, begin, min(piece_length - begin, amount - len(data)))
+            if chunk is None:
+                break
+            data += chunk
+        return bytes(data)
+
+    def request_read(self, offset, amount, callback):
+        """Read as read does, from any thread, passing the data to
+        callback on the RawServer thread"""
+        def r(self=self, offset=offset, amount=amount):
+            callback(self.read(offset, amount))
+        self.rawserver.add_task(r)
+
     def am_I_finished(self):
         return self.finflag.is_set()
 
@@ -137,7 +137,8 @@ class LaunchMany:
             self.rawserver = RawServer(
                 self.doneflag, config['timeout_check_interval'],
                 config['timeout'], ipv6_enable=config['ipv6_enabled'],
-                failfunc=self.failed, errorfunc=self.exchandler)
+                failfunc=self.failed, errorfunc=self.exchandler,
+                poll_backend=config['poll_backend'])
 
             upnp_type = UPnP_test(config['upnp_nat_access'])
             while True:
@@ -159,6 +160,7 @@ class LaunchMany:
             self.ratelimiter = RateLimiter(self.rawserver.add_task,
                                            config['upload_unit_size'])
             self.ratelimiter.set_upload_rate(config['max_upload_rate'])
+            self.ratelimiter.set_download_rate(config['max_download_rate'])
 
             self.handler = MultiHandler(self.rawserver, self.doneflag, config)
             random.seed(createPeerID())
@@ -5,7 +5,7 @@ BitTornado makemetafile.py behaviors.
 """
 
 import os
-from .Info import Info, MetaInfo
+from .Info import Info, MetaInfo, read_chunks
 
 
 class BTTree(object):
@@ -55,6 +55,8 @@ class BTTree(object):
 
     def initInfo(self, **params):
         """Determine name of file and instantiate an Info structure"""
+        if not self.size:
+            raise ValueError('{} holds no data to describe'.format(self.loc))
         if self.path == []:
             name = os.path.basename(self.loc)
         else:
@@ -74,19 +76,13 @@ class BTTree(object):
     def addFileToInfos(self, infos):
         """Add file information and data hash to a sequence of Info
         structures"""
-        with open(self.loc, 'rb') as fhandle:
-            pos = 0
-            piece_length = 0
+        with open(self.loc, 'rb', buffering=0) as fhandle:
             for info in infos:
-                piece_length = max(piece_length, info.hasher.pieceLength)
                 info.add_file_info(self.size, self.path)
 
-            while pos < self.size:
-                nbytes = min(piece_length, self.size - pos)
-                buf = fhandle.read(nbytes)
-                pos += nbytes
+            for chunk in read_chunks(fhandle, self.size):
                 for info in infos:
-                    info.add_data(buf)
+                    info.add_data(chunk)
 
     def updateInfo(self, info):
         """Add a sub-BTTree to an Info structure
@@ -100,6 +96,15 @@ class BTTree(object):
             for sub in self.subs:
                 sub.updateInfo(info)
 
+    def files(self):
+        """Generate (location, path, size) for each file in the tree, in the
+        order updateInfo hashes them"""
+        if not os.path.isdir(self.loc) and self.subs == []:
+            yield self.loc, self.path, self.size
+        else:
+            for sub in self.subs:
+                yield from sub.files()
+
     #pylint: disable=W0102
     def buildMetaTree(self, tracker, target, infos=[], **params):
         """Construct a directory structure such that, for every path in
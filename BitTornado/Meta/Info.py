@@ -9,7 +9,11 @@ import re
 import time
 import hashlib
 from ..Types import TypedDict, TypedList, SplitList
-from .bencode import BencodedFile
+from .bencode import BencodedFile, fast_bdecode
+
+
+# Files are hashed in chunks of this many bytes
+READSIZE = 1 << 22
 
 
 def get_piece_len(size):
@@ -41,13 +45,13 @@ def check_type(obj, types, errmsg='', pred=lambda x: False):
     if not isinstance(obj, types) or pred(obj):
         raise ValueError(errmsg)
 
+
 VALID_NAME = re.compile(r'^[^/\\.~][^/\\]*$')
 
 
 def check_info(info):
     """Validate torrent metainfo dictionary"""
 
-    valid_name = re.compile(r'^[^/\\.~][^/\\]*$')
     berr = 'bad metainfo - '
     check_type(info, dict, berr + 'not a dictionary')
 
@@ -59,7 +63,7 @@ def check_info(info):
 
     name = info.get('name')
     check_type(name, str, berr + 'bad name')
-    if not valid_name.match(name):
+    if not VALID_NAME.match(name):
         raise ValueError('name %s disallowed for security reasons' % name)
 
     if ('files' in info) == ('length' in info):
@@ -84,7 +88,7 @@ def check_info(info):
 
             for directory in path:
                 check_type(directory, str, berr + 'bad path dir')
-                if not valid_name.match(directory):
+                if not VALID_NAME.match(directory):
                     raise ValueError('path {} disallowed for security reasons'
                                      ''.format(directory))
 
@@ -94,6 +98,22 @@ def check_info(info):
             paths[tpath] = True
 
 
+def read_chunks(fhandle, size, bufsize=READSIZE):
+    """Generate successive chunks of size bytes of an unbuffered file
+
+    Chunks are memoryviews of one buffer, which is refilled for each chunk,
+    so each must be used before the next is requested."""
+    buf = bytearray(min(bufsize, size))
+    with memoryview(buf) as view:
+        while size:
+            nbytes = fhandle.readinto(view[:min(size, len(buf))])
+            if not nbytes:
+                raise IOError('{} is shorter than expected'
+                              ''.format(fhandle.name))
+            size -= nbytes
+            yield view[:nbytes]
+
+
 class PieceHasher(object):
     """Wrapper for SHA1 hash with a maximum length"""
     def __init__(self, pieceLength, hashtype=hashlib.sha1):
@@ -111,39 +131,25 @@ class PieceHasher(object):
     def update(self, data, progress=lambda x: None):
         """Add data to PieceHasher, splitting pieces if necessary.
 
-        Progress function that accepts a number of (new) bytes hashed
-        is optional
+        Data may be any bytes-like object, such as a memoryview or mmap, and
+        is hashed in place. Progress function that accepts a number of (new)
+        bytes hashed is optional
         """
-        tofinish = self.pieceLength - self.done    # bytes to finish a piece
-
-        # Split data based on the number of bytes to finish the current piece
-        # If data is less than needed, remainder will be empty
-        init, remainder = data[:tofinish], data[tofinish:]
-
-        # Hash initial segment
-        self._hash.update(init)
-        progress(len(init))
-        self.done += len(init)
-
-        # Hash remainder, if present
-        if remainder:
-            toHash = len(remainder)
-
-            # Create a new hash for each piece of data present
-            hashes = [self._hashtype(remainder[i:i + self.pieceLength])
-                      for i in range(0, toHash, self.pieceLength)]
-            progress(toHash)
-
-            self.done = toHash % self.pieceLength
-
-            self.pieces.append(self._hash.digest())
-            self._hash = hashes[-1]
-            self.pieces.extend(piece.digest() for piece in hashes[:-1])
-
-        # If the piece is finished, reinitialize
-        if self.done == self.pieceLength:
-            self.pieces.append(self._hash.digest())
-            self.resetHash()
+        with memoryview(data) as view, view.cast('B') as octets:
+            length = len(octets)
+            pos = 0
+            while pos < length:
+                # Hash up to the end of the current piece
+                nbytes = min(self.pieceLength - self.done, length - pos)
+                self._hash.update(octets[pos:pos + nbytes])
+                self.done += nbytes
+                pos += nbytes
+
+                # If the piece is finished, reinitialize
+                if self.done == self.pieceLength:
+                    self.pieces.append(self._hash.digest())
+                    self.resetHash()
+        progress(length)
 
     def __nonzero__(self):
         """Evaluate to true if any data has been hashed"""
@@ -353,6 +359,18 @@ class Info(TypedDict):   # pylint: disable=R0904
         """
         self.hasher.update(data, self.progress)
 
+    def add_pieces(self, pieces):
+        """Append digests of pieces hashed elsewhere.
+
+        Parameters
+            bytes[] pieces  - digests of consecutive pieces, following any
+                            previously added data, which must end on a
+                            piece boundary
+        """
+        if self.hasher.done:
+            raise ValueError('Pieces must start on a piece boundary')
+        self.hasher.pieces.extend(pieces)
+
     def resume(self, location):
         """Rehash last piece to prepare PieceHasher to accept more data
 
@@ -378,9 +396,10 @@ class Info(TypedDict):   # pylint: disable=R0904
 
         for entry in rehash:
             path = os.path.join(location, *entry['path'])
-            with open(path, 'rb') as tohash:
+            with open(path, 'rb', buffering=0) as tohash:
                 tohash.seek(seek)
-                self.hasher.update(tohash.read())
+                for chunk in read_chunks(tohash, entry['length'] - seek):
+                    self.hasher.update(chunk)
                 seek = 0
 
         if self.hasher.digest != validator:
@@ -420,3 +439,144 @@ class MetaInfo(TypedDict, BencodedFile):
             del self['httpseeds']
         if self.get('comment') == '':
             del self['comment']
+
+
+class LazyDict(object):
+    """Read-only view of a bencoded dictionary, whose values are decoded when
+    first requested
+
+    Construction only locates the values, so large values that are never
+    requested cost no more than a scan of their framing."""
+    def __init__(self, ctext, pos=0):
+        self.ctext = ctext
+        self.start = pos
+        try:
+            self.spans, self.end = fast_bdecode.spans(ctext, pos)
+        except IndexError:
+            raise ValueError('bad bencoded data')
+        self.decoded = {}
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, key):
+        if key not in self.decoded:
+            start, end = self.spans[key]
+            try:
+                value, pos = fast_bdecode.decode(self.ctext, start)
+            except IndexError:
+                raise ValueError('bad bencoded data')
+            if pos != end:
+                raise ValueError('bad bencoded data')
+            self.decoded[key] = value
+        return self.decoded[key]
+
+    def keys(self):
+        """Return iterator over keys"""
+        return iter(self.spans)
+
+    def get(self, key, default=None):
+        """Return value associated with key, or default, if absent"""
+        if key not in self.spans:
+            return default
+        return self[key]
+
+    def raw(self, key):
+        """Return the bencoded value associated with key"""
+        start, end = self.spans[key]
+        return self.ctext[start:end]
+
+    def size(self, key):
+        """Return the length of the string associated with key, without
+        decoding it"""
+        start, end = self.spans[key]
+        colon = self.ctext.find(b':', start, end)
+        if colon < 0:
+            raise ValueError('not a string')
+        return end - colon - 1
+
+
+class LazyMetaInfo(LazyDict):
+    """Metainfo file contents, decoded as needed
+
+    The infohash is taken from the raw info dictionary, and top-level and
+    info values are decoded on access (the 'info' key gives a LazyDict).
+    check() applies the checks of check_info that do not need file paths;
+    materialize() parses and fully checks the whole file into a MetaInfo.
+    """
+    def __init__(self, ctext):
+        super(LazyMetaInfo, self).__init__(ctext)
+        if 'info' not in self.spans:
+            raise ValueError('bad metainfo - no info dictionary')
+        self.info = LazyDict(ctext, self.spans['info'][0])
+        self.infohash = hashlib.sha1(
+            ctext[self.info.start:self.info.end]).digest()
+
+    @classmethod
+    def read(cls, fname):
+        """Scan a metainfo file"""
+        with open(fname, 'rb') as handle:
+            return cls(handle.read())
+
+    def __getitem__(self, key):
+        if key == 'info':
+            return self.info
+        return super(LazyMetaInfo, self).__getitem__(key)
+
+    @property
+    def numfiles(self):
+        """Number of files described by the torrent"""
+        if 'length' in self.info:
+            return 1
+        return len(self.info['files'])
+
+    @property
+    def length(self):
+        """Total size of the files described by the torrent"""
+        if 'length' in self.info:
+            return self.info['length']
+        return sum(finfo['length'] for finfo in self.info['files']
+                   if 'length' in finfo)
+
+    def check(self):
+        """Validate the info dictionary, except for file paths"""
+        info = self.info
+        berr = 'bad metainfo - '
+        if 'pieces' not in info or info.size('pieces') % 20 != 0:
+            raise ValueError(berr + 'bad pieces key')
+
+        check_type(info.get('piece length'), int,
+                   berr + 'illegal piece length', lambda x: x <= 0)
+
+        name = info.get('name')
+        check_type(name, str, berr + 'bad name')
+        if not VALID_NAME.match(name):
+            raise ValueError('name %s disallowed for security reasons' % name)
+
+        if ('files' in info) == ('length' in info):
+            raise ValueError('single/multiple file mix')
+
+        if 'length' in info:
+            check_type(info['length'], int, berr + 'bad length',
+                       lambda x: x < 0)
+        else:
+            check_type(info['files'], list)
+            for finfo in info['files']:
+                check_type(finfo, dict, berr + 'bad file value')
+                check_type(finfo.get('length'), int, berr + 'bad length',
+                           lambda x: x < 0)
+
+    def materialize(self):
+        """Parse and check the complete metainfo"""
+        try:
+            metainfo = MetaInfo(fast_bdecode(self.ctext))
+        except TypeError as e:
+            raise ValueError('bad metainfo - {}'.format(e))
+        check_info(metainfo['info'])
+        return metainfo
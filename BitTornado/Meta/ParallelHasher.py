@@ -0,0 +1,140 @@
+"""Hash the pieces of new torrents on a pool of worker threads
+
+The data of a torrent, its files taken in order, is divided at piece
+boundaries into jobs of about JOBSIZE bytes. Each job is read with a few
+large reads into a buffer held by the worker thread and hashed there.
+hashlib releases the GIL while hashing, so jobs from one large file, or from
+many torrents, are hashed on as many cores as there are workers.
+
+Example:
+
+hasher = ParallelHasher(workers=4)
+job = hasher.submit([(loc, size), ...], piece_length)
+for job, nbytes in hasher.completed([job]):
+    ...
+pieces = job.pieces()
+hasher.close()
+"""
+
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Pieces are read and hashed in jobs of up to this many bytes (or one piece,
+# if larger)
+JOBSIZE = 1 << 24
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def piece_jobs(files, piece_length, jobsize=JOBSIZE):
+    """Divide the concatenated contents of files into runs of whole pieces
+
+    files is a sequence of (location, size) pairs. Generates
+    ([(location, offset, length), ...], total length) for each run; only
+    the last run may end with a partial piece."""
+    jobsize = max(piece_length, jobsize - jobsize % piece_length)
+    segments = []
+    length = 0
+    for loc, size in files:
+        offset = 0
+        while offset < size:
+            nbytes = min(size - offset, jobsize - length)
+            segments.append((loc, offset, nbytes))
+            offset += nbytes
+            length += nbytes
+            if length == jobsize:
+                yield segments, length
+                segments = []
+                length = 0
+    if length:
+        yield segments, length
+
+
+class HashJob(object):
+    """Piece digests of one set of files, hashed in parts by a
+    ParallelHasher"""
+    def __init__(self, parts):
+        # [(future, nbytes), ...] in file order
+        self.parts = parts
+
+    def done(self):
+        """True if every part has been hashed (or has failed)"""
+        return all(future.done() for future, _ in self.parts)
+
+    def pieces(self):
+        """Return the list of piece digests, in order, waiting if necessary
+
+        Re-raises any error met reading the files."""
+        digests = []
+        for future, _ in self.parts:
+            digests.extend(future.result())
+        return digests
+
+    def cancel(self):
+        for future, _ in self.parts:
+            future.cancel()
+
+
+class ParallelHasher(object):
+    """Hash the pieces of sets of files on a pool of worker threads"""
+    def __init__(self, workers=0, jobsize=JOBSIZE, hashtype=hashlib.sha1):
+        self.workers = workers if workers > 0 else default_workers()
+        self.jobsize = jobsize
+        self.hashtype = hashtype
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def _buffer(self):
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            buf = self.local.buf = bytearray(self.jobsize)
+        return buf
+
+    def _hash_job(self, segments, length, piece_length):
+        buf = self._buffer()
+        if len(buf) < length:
+            buf = self.local.buf = bytearray(length)
+        view = memoryview(buf)
+        pos = 0
+        for loc, offset, nbytes in segments:
+            with open(loc, 'rb', buffering=0) as fhandle:
+                fhandle.seek(offset)
+                while nbytes:
+                    nread = fhandle.readinto(view[pos:pos + nbytes])
+                    if not nread:
+                        raise IOError('{} is shorter than expected'
+                                      ''.format(loc))
+                    pos += nread
+                    nbytes -= nread
+        return [self.hashtype(view[start:min(start + piece_length,
+                                             length)]).digest()
+                for start in range(0, length, piece_length)]
+
+    def submit(self, files, piece_length):
+        """Start hashing the concatenated contents of files, a sequence of
+        (location, size) pairs, in pieces of piece_length bytes"""
+        return HashJob([(self.pool.submit(self._hash_job, segments, length,
+                                          piece_length), length)
+                        for segments, length in
+                        piece_jobs(files, piece_length, self.jobsize)])
+
+    def completed(self, jobs, flag=None):
+        """Generate (job, nbytes) as each part of the given jobs finishes
+
+        If flag is set, outstanding parts are cancelled and generation
+        stops."""
+        owners = {future: (job, nbytes)
+                  for job in jobs for future, nbytes in job.parts}
+        for future in as_completed(owners):
+            if flag is not None and flag.is_set():
+                for job in jobs:
+                    job.cancel()
+                return
+            yield owners[future]
+
+    def close(self):
+        self.pool.shutdown(wait=False)
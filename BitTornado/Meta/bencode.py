@@ -21,51 +21,123 @@ class Bencached(object):
         return cls(bencode(data))
 
 
+# Sorted key orders remembered per dictionary shape, before starting over
+KEY_ORDER_CACHE = 1024
+
+
 class BTEncoder(object):
     """Encode a data structure into a string for use in BitTorrent applications
-    """
+
+    Encodings are appended to a bytearray, which may be supplied by the
+    caller with encode(). Dictionaries built with the same keys in the same
+    order share one sorted key order, so repeatedly encoded responses are
+    not sorted each time."""
+    def __init__(self):
+        self.key_orders = {}
+        self.encoders = dict(self.encode_func)
 
     def __call__(self, data):
         """Encode a data structure into a string."""
-        ctext = []
+        ctext = bytearray()
         self.encode(data, ctext)
-        return b''.join(ctext)
+        return bytes(ctext)
 
     def encode(self, data, ctext):
-        """Determine type of data and encode into appropriate string"""
+        """Determine type of data and append its encoding to a bytearray"""
+        try:
+            encoder = self.encoders[data.__class__]
+        except KeyError:
+            encoder = self.encoders[data.__class__] = self.lookup(data)
+        encoder(self, data, ctext)
+
+    def lookup(self, data):
+        """Find the encoding function for a subclass of a bencodable type"""
         if isinstance(data, int):
-            ctext.append('i{:d}e'.format(data).encode('utf-8'))
-        elif isinstance(data, (str, bytes)):
-            # A string is encoded as nbytes:contents
-            if isinstance(data, str):
-                data = data.encode('utf-8')
-            ctext.extend((str(len(data)).encode('utf-8'), b':', data))
+            return BTEncoder.encode_int
+        elif isinstance(data, str):
+            return BTEncoder.encode_str
+        elif isinstance(data, (bytes, memoryview)):
+            return BTEncoder.encode_bytes
         elif isinstance(data, Bencached):
-            assert data.marker == BENCACHED_MARKER
-            ctext.append(data.bencoded)
+            return BTEncoder.encode_bencached
         elif isinstance(data, collections.Sequence):
-            # A list takes the form lXe where X is the concatenation of the
-            # encodings of all elements in the list.
-            ctext.append(b'l')
-            for element in data:
-                self.encode(element, ctext)
-            ctext.append(b'e')
+            return BTEncoder.encode_list
         elif isinstance(data, collections.Mapping):
-            # A dictionary is encoded as dXe where X is the concatenation of
-            # the encodings of all key,value pairs in the dictionary, sorted by
-            # key. Key, value pairs are themselves concatenations of the
-            # encodings of keys and values, where keys are assumed to be
-            # strings.
-            ctext.append(b'd')
-            ilist = data.items()
-            for key, data in sorted(ilist):
+            return BTEncoder.encode_dict
+        raise TypeError('Unknown type for bencode: ' + str(type(data)))
+
+    def encode_int(self, data, ctext):
+        """An integer with ASCII representation X is encoded as iXe"""
+        ctext += b'i%de' % data
+
+    def encode_str(self, data, ctext):
+        """A string is encoded in UTF-8 as nbytes:contents"""
+        self.encode_bytes(data.encode('utf-8'), ctext)
+
+    def encode_bytes(self, data, ctext):
+        """A bytestring is encoded as nbytes:contents"""
+        ctext += b'%d:' % len(data)
+        ctext += data
+
+    def encode_bencached(self, data, ctext):
+        """Cached ciphertext is copied as is"""
+        assert data.marker == BENCACHED_MARKER
+        ctext += data.bencoded
+
+    def encode_list(self, data, ctext):
+        """A list takes the form lXe where X is the concatenation of the
+        encodings of all elements in the list.
+
+        Lists of bytestrings of one length, such as compact peer addresses,
+        are joined in one step."""
+        if data and data[0].__class__ is bytes:
+            size = len(data[0])
+            if all(elt.__class__ is bytes and len(elt) == size
+                   for elt in data):
+                prefix = b'%d:' % size
+                ctext += b'l' + prefix
+                ctext += prefix.join(data)
+                ctext += b'e'
+                return
+        ctext += b'l'
+        for element in data:
+            self.encode(element, ctext)
+        ctext += b'e'
+
+    def encode_dict(self, data, ctext):
+        """A dictionary is encoded as dXe where X is the concatenation of the
+        encodings of all key,value pairs in the dictionary, sorted by key.
+        Key, value pairs are themselves concatenations of the encodings of
+        keys and values, where keys are assumed to be strings."""
+        shape = tuple(data.keys())
+        try:
+            keys = self.key_orders[shape]
+        except KeyError:
+            for key in shape:
                 if not isinstance(key, (str, bytes)):
                     raise TypeError("Dictionary keys must be (byte)strings")
-                self.encode(key, ctext)
-                self.encode(data, ctext)
-            ctext.append(b'e')
-        else:
-            raise TypeError('Unknown type for bencode: ' + str(type(data)))
+            keys = sorted(shape)
+            if len(self.key_orders) >= KEY_ORDER_CACHE:
+                self.key_orders.clear()
+            self.key_orders[shape] = keys
+        ctext += b'd'
+        encode = self.encode
+        for key in keys:
+            encode(key, ctext)
+            encode(data[key], ctext)
+        ctext += b'e'
+
+    encode_func = {
+        int: encode_int,
+        bool: encode_int,
+        str: encode_str,
+        bytes: encode_bytes,
+        memoryview: encode_bytes,
+        list: encode_list,
+        tuple: encode_list,
+        dict: encode_dict,
+        Bencached: encode_bencached,
+    }
 
 
 #pylint: disable=R0201
@@ -177,6 +249,188 @@ class BTDecoder(object):
     }
 
 
+# Keys whose string values are binary and are never decoded as text
+BINARY_KEYS = frozenset(('pieces', 'peers', 'peers6', 'crypto_flags'))
+
+
+class FastDecoder(object):
+    """Iterative decoder for large or numerous bencoded documents
+
+    Produces the same structures as BTDecoder, except that strings stored
+    under any of binary_keys are returned without trial UTF-8 decoding: as
+    bytes or, with views=True, as memoryview slices of the ciphertext, so
+    that nothing is copied out of a memory-mapped file until used. Nesting
+    depth is not limited by the recursion limit."""
+    def __init__(self, binary_keys=BINARY_KEYS, views=False):
+        self.binary_keys = frozenset(binary_keys)
+        self.views = views
+
+    def __call__(self, ctext, sloppy=False, stacklevel=1):
+        """Decode a string encoded with bencode, such as the contents of a
+        .torrent file"""
+        try:
+            data, length = self.decode(ctext)
+        except (IndexError, ValueError):
+            raise ValueError("bad bencoded data")
+        if not sloppy and length != len(ctext):
+            warnings.warn("bad bencoded data", stacklevel=stacklevel + 1)
+        return data
+
+    def decode(self, ctext, pos=0):
+        """Decode the value starting at a given position
+
+        Returns (parsed value, next token start position)
+        """
+        find = ctext.find
+        end = len(ctext)
+        raw = memoryview(ctext) if self.views else ctext
+        binary_keys = self.binary_keys
+        # The innermost open container is held in container, with key the
+        # dictionary key awaiting a value (None if awaiting a key) and
+        # lastkey the previous raw key; enclosing containers are stacked
+        stack = []
+        container = key = lastkey = None
+        while True:
+            token = ctext[pos]
+            if key is None and container.__class__ is dict:
+                if token == 0x65:                           # e
+                    value = container
+                    container, key, lastkey = stack.pop()
+                    pos += 1
+                else:
+                    if not 0x30 <= token <= 0x39:
+                        raise ValueError
+                    colon = find(b':', pos)
+                    if colon < 0 or token == 0x30 and colon != pos + 1:
+                        raise ValueError
+                    start = colon + 1
+                    pos = start + int(ctext[pos:colon])
+                    if pos > end:
+                        raise ValueError
+                    rawkey = ctext[start:pos]
+                    if rawkey <= lastkey:
+                        raise ValueError
+                    lastkey = rawkey
+                    try:
+                        key = rawkey.decode('utf-8')
+                    except UnicodeDecodeError:
+                        key = rawkey
+                    continue
+            elif token == 0x69:                             # i
+                newpos = find(b'e', pos + 1)
+                if newpos < 0 or ctext[pos + 1:pos + 3] == b'-0' or \
+                        ctext[pos + 1] == 0x30 and newpos != pos + 2:
+                    raise ValueError
+                value = int(ctext[pos + 1:newpos])
+                pos = newpos + 1
+            elif 0x30 <= token <= 0x39:                     # 0-9
+                colon = find(b':', pos)
+                if colon < 0 or token == 0x30 and colon != pos + 1:
+                    raise ValueError
+                start = colon + 1
+                pos = start + int(ctext[pos:colon])
+                if pos > end:
+                    raise ValueError
+                if key in binary_keys:
+                    value = raw[start:pos]
+                else:
+                    value = ctext[start:pos]
+                    try:
+                        value = value.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            elif token == 0x6c:                             # l
+                stack.append((container, key, lastkey))
+                container, key = [], None
+                pos += 1
+                continue
+            elif token == 0x64:                             # d
+                stack.append((container, key, lastkey))
+                container, key, lastkey = {}, None, b''
+                pos += 1
+                continue
+            elif token == 0x65 and container.__class__ is list:   # e
+                value = container
+                container, key, lastkey = stack.pop()
+                pos += 1
+            else:
+                raise ValueError
+
+            if container is None:
+                return (value, pos)
+            if key is None:
+                container.append(value)
+            else:
+                container[key] = value
+                key = None
+
+    def skip(self, ctext, pos=0):
+        """Find the end of the value starting at a given position without
+        decoding it
+
+        Strings are stepped over by their lengths, so only the framing of
+        the value is checked. Returns the next token start position
+        """
+        find = ctext.find
+        end = len(ctext)
+        depth = 0
+        while True:
+            token = ctext[pos]
+            if token == 0x69:                               # i
+                newpos = find(b'e', pos + 1)
+                if newpos < 0:
+                    raise ValueError
+                int(ctext[pos + 1:newpos])
+                pos = newpos + 1
+            elif 0x30 <= token <= 0x39:                     # 0-9
+                colon = find(b':', pos)
+                if colon < 0:
+                    raise ValueError
+                pos = colon + 1 + int(ctext[pos:colon])
+                if pos > end:
+                    raise ValueError
+            elif token == 0x6c or token == 0x64:            # l, d
+                depth += 1
+                pos += 1
+                continue
+            elif token == 0x65 and depth:                   # e
+                depth -= 1
+                pos += 1
+            else:
+                raise ValueError
+            if not depth:
+                return pos
+
+    def spans(self, ctext, pos=0):
+        """Locate the values of the dictionary starting at a given position
+
+        Returns ({key: (value start, value end)}, next token start position)
+        """
+        if ctext[pos] != 0x64:
+            raise ValueError
+        spans = {}
+        lastkey = b''
+        pos += 1
+        while ctext[pos] != 0x65:
+            colon = ctext.find(b':', pos)
+            if colon < 0:
+                raise ValueError
+            start = colon + 1
+            pos = start + int(ctext[pos:colon])
+            rawkey = ctext[start:pos]
+            if pos > len(ctext) or rawkey <= lastkey:
+                raise ValueError
+            lastkey = rawkey
+            try:
+                key = rawkey.decode('utf-8')
+            except UnicodeDecodeError:
+                key = rawkey
+            start = pos
+            pos = self.skip(ctext, pos)
+            spans[key] = (start, pos)
+        return (spans, pos + 1)
+
+
 class BencodedFile(object):
     """Enable reading of bencoded files into bencodable objects, and writing
     bencodable objects into bencoded files.
@@ -185,8 +439,10 @@ class BencodedFile(object):
     (byte)strings or integers, or subclasses of these, and all dictionary keys
     are (byte)strings or subclasses."""
     def write(self, fname):
+        ctext = bytearray()
+        bencode.encode(self, ctext)
         with open(fname, 'wb') as handle:
-            handle.write(bencode(self))
+            handle.write(ctext)
 
     @classmethod
     def read(klass, fname, *args, **kwargs):
@@ -194,9 +450,10 @@ class BencodedFile(object):
         with open(fname, 'rb') as handle:
             # Using memory maps allows Python to handle some standard errors
             mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
-            return klass(bdecode(mm, sloppy=sloppy, stacklevel=2), *args,
-                         **kwargs)
+            return klass(fast_bdecode(mm, sloppy=sloppy, stacklevel=2),
+                         *args, **kwargs)
 
 #pylint: disable=C0103
 bencode = BTEncoder()
 bdecode = BTDecoder()
+fast_bdecode = FastDecoder()
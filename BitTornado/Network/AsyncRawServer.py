@@ -0,0 +1,405 @@
+"""asyncio implementation of the RawServer interface
+
+AsyncRawServer schedules tasks and drives connections on an asyncio event
+loop (including drop-in loops such as uvloop), while presenting the same
+interface as RawServer to Encrypter, Connecter and HTTPHandler. Connection
+objects mirror SingleSocket, and handlers receive the usual
+external_connection_made, data_came_in, connection_flushed and
+connection_lost calls.
+
+Example:
+
+rawserver = AsyncRawServer(doneflag, 60, 300, loop=uvloop.new_event_loop())
+rawserver.find_and_bind(6881, 6889)
+rawserver.listen_forever(handler)
+
+or, from a coroutine already running on the loop:
+
+await rawserver.serve(handler)
+"""
+
+import random
+import socket
+import asyncio
+import threading
+from io import StringIO
+from traceback import print_exc
+from .RawServer import Task, READSIZE
+from .SocketHandler import SocketHandler
+from BitTornado.clock import clock
+
+# Seconds between checks of the done flag, which may be set from any thread
+DONEFLAG_INTERVAL = 0.5
+
+
+class AsyncSingleSocket(asyncio.Protocol):
+    """SingleSocket-compatible connection carried by an asyncio transport"""
+    def __init__(self, rawserver, handler, ip=None, incoming=False):
+        self.rawserver = rawserver
+        self.handler = handler
+        self.incoming = incoming
+        self.transport = None
+        self.connector = None
+        self.buffer = []        # writes made before the connection completes
+        self.last_hit = clock()
+        self.connected = False
+        self.closed = False
+        self.ip = 'unknown' if ip is None else ip
+
+    ### asyncio.Protocol callbacks ###
+
+    def connection_made(self, transport):
+        if self.closed:
+            transport.abort()
+            return
+        server = self.rawserver
+        if self.incoming and len(server.connections) >= server.max_connects:
+            self.closed = True
+            transport.abort()
+            return
+        self.transport = transport
+        self.connected = True
+        # Pause as soon as anything is buffered, so that resume_writing marks
+        # the moment the buffer empties
+        transport.set_write_buffer_limits(high=0)
+        self.get_ip(True)
+        if self.incoming:
+            server.connections.add(self)
+            server.call(self.handler.external_connection_made, self)
+        elif self.buffer:
+            buffered, self.buffer = self.buffer, []
+            transport.writelines(buffered)
+            if transport.get_write_buffer_size() == 0:
+                server.call(self.handler.connection_flushed, self)
+
+    def data_received(self, data):
+        self.last_hit = clock()
+        self.rawserver.call(self.handler.data_came_in, self, data)
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        if not self.closed:
+            self.rawserver.call(self.handler.connection_flushed, self)
+
+    def connection_lost(self, exc):
+        if not self.closed:
+            self.closed = True
+            self.connected = False
+            self.rawserver.connections.discard(self)
+            self.rawserver.call(self.handler.connection_lost, self)
+
+    ### SingleSocket interface ###
+
+    def get_ip(self, real=False):
+        if real and self.transport is not None:
+            peer = self.transport.get_extra_info('peername')
+            if peer:
+                self.ip = peer[0]
+        return self.ip
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+        self.connected = False
+        self.buffer = []
+        self.rawserver.connections.discard(self)
+        if self.transport is not None:
+            self.transport.abort()
+        elif self.connector is not None:
+            self.connector.cancel()
+
+    def shutdown(self, val):
+        if self.transport is not None and \
+                val in (socket.SHUT_WR, socket.SHUT_RDWR) and \
+                self.transport.can_write_eof():
+            self.transport.write_eof()
+
+    def is_flushed(self):
+        if self.transport is None:
+            return not self.buffer
+        return self.transport.get_write_buffer_size() == 0
+
+    def can_sendfile(self):
+        return False
+
+    def write(self, s):
+        assert not self.closed
+        if self.transport is None:
+            self.buffer.append(s)
+        else:
+            self.transport.write(s)
+
+    def set_handler(self, handler):
+        self.handler = handler
+
+
+class AsyncDatagramSocket(asyncio.DatagramProtocol):
+    """DatagramSocket-compatible UDP socket carried by an asyncio transport"""
+    def __init__(self, rawserver, handler):
+        self.rawserver = rawserver
+        self.handler = handler
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.rawserver.call(self.handler.datagram_received, self, data, addr)
+
+    def error_received(self, exc):
+        pass
+
+    def sendto(self, data, addr):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+
+class AsyncRawServer(object):
+    def __init__(self, doneflag, timeout_check_interval, timeout, noisy=True,
+                 ipv6_enable=True, failfunc=lambda x: None, errorfunc=None,
+                 excflag=threading.Event(), loop=None):
+        self.timeout_check_interval = max(timeout_check_interval, 0)
+        self.timeout = timeout
+        self.ipv6_enable = ipv6_enable
+        self.doneflag = doneflag
+        self.noisy = noisy
+        self.failfunc = failfunc
+        self.errorfunc = errorfunc
+        self.exccount = 0
+        self.excflag = excflag
+        self.finished = threading.Event()
+        self.handler = None
+        self.connections = set()
+        self.max_connects = 1000
+        self.tasks = {}         # {tid: set(Task)}
+        self.listeners = []
+        self.stopped = None
+        self.loop_thread = None
+
+        self.owns_loop = loop is None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        self.loop = loop
+
+        # Listening sockets are opened (and UPnP forwarded) by a SocketHandler
+        # and then handed to the loop. The pure-Python select poller only
+        # records the sockets and is never polled.
+        self.sockethandler = SocketHandler(timeout, ipv6_enable, READSIZE,
+                                           'select')
+        self.bind = self.sockethandler.bind
+        self.bind_udp = self.sockethandler.bind_udp
+        self.find_and_bind = self.sockethandler.find_and_bind
+        self.get_stats = self.sockethandler.get_stats
+
+        self.add_task(self.scan_for_timeouts, timeout_check_interval)
+
+    def get_exception_flag(self):
+        return self.excflag
+
+    def _in_loop_thread(self):
+        return self.loop_thread is None or \
+            self.loop_thread == threading.get_ident()
+
+    def add_task(self, func, delay=0, tid=None):
+        """Schedule func to be called after delay seconds
+
+        Returns a Task that may be cancelled; tasks sharing a tid may be
+        cancelled together with kill_tasks. May be called from any thread."""
+        assert float(delay) >= 0
+        task = Task(func, delay, tid)
+        if self._in_loop_thread():
+            self._schedule(task)
+        else:
+            self.loop.call_soon_threadsafe(self._schedule, task)
+        return task
+
+    def _schedule(self, task):
+        if task.cancelled:
+            return
+        if task.tid is not None:
+            self.tasks.setdefault(task.tid, set()).add(task)
+        self.loop.call_later(task.delay, self._run_task, task)
+
+    def _run_task(self, task):
+        if task.tid is not None:
+            tasks = self.tasks.get(task.tid)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self.tasks[task.tid]
+        if task.cancelled or self.is_stopping():
+            return
+        self.call(task.func, noisy=self.noisy)
+
+    def kill_tasks(self, tid):
+        if self._in_loop_thread():
+            self._kill_tasks(tid)
+        else:
+            self.loop.call_soon_threadsafe(self._kill_tasks, tid)
+
+    def _kill_tasks(self, tid):
+        for task in self.tasks.pop(tid, ()):
+            task.cancel()
+
+    def call(self, func, *args, noisy=True):
+        """Call a task or handler method, reporting any exception"""
+        try:
+            func(*args)
+        except (SystemError, MemoryError) as e:
+            self.failfunc(str(e))
+            self.stop()
+        except KeyboardInterrupt:
+            self.stop()
+        except Exception:
+            if noisy:
+                self.exception()
+        if self.exccount > 10:
+            self.stop()
+
+    def scan_for_timeouts(self):
+        self.add_task(self.scan_for_timeouts, self.timeout_check_interval)
+        t = clock() - self.timeout
+        for conn in list(self.connections):
+            if conn.last_hit < t and not conn.closed:
+                conn.close()
+                self.call(conn.handler.connection_lost, conn)
+
+    def start_connection_raw(self, dns, socktype=socket.AF_INET,
+                             handler=None):
+        if handler is None:
+            handler = self.handler
+        sock = socket.socket(socktype, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        conn = AsyncSingleSocket(self, handler, dns[0])
+        self.connections.add(conn)
+        conn.connector = self.loop.create_task(self._connect(conn, sock, dns))
+        return conn
+
+    def start_connection(self, dns, handler=None, randomize=False):
+        if handler is None:
+            handler = self.handler
+
+        if self.ipv6_enable:
+            socktype = socket.AF_UNSPEC
+        else:
+            socktype = socket.AF_INET
+        try:
+            addrinfos = socket.getaddrinfo(dns[0], int(dns[1]),
+                                           socktype, socket.SOCK_STREAM)
+        except OSError:
+            raise
+        except Exception as e:
+            raise OSError(str(e))
+        if randomize:
+            random.shuffle(addrinfos)
+        for addrinfo in addrinfos:
+            try:
+                return self.start_connection_raw(addrinfo[4], addrinfo[0],
+                                                 handler)
+            except OSError:
+                pass
+        raise OSError('unable to connect')
+
+    def adopt_connection(self, sock, handler=None):
+        """Handle an already connected stream socket, such as one of a
+        socket pair"""
+        if handler is None:
+            handler = self.handler
+        sock.setblocking(False)
+        conn = AsyncSingleSocket(self, handler)
+        self.connections.add(conn)
+        conn.connector = self.loop.create_task(self._adopt(conn, sock))
+        return conn
+
+    async def _adopt(self, conn, sock):
+        try:
+            await self.loop.connect_accepted_socket(lambda: conn, sock)
+        except asyncio.CancelledError:
+            sock.close()
+        finally:
+            conn.connector = None
+
+    async def _connect(self, conn, sock, dns):
+        try:
+            await self.loop.sock_connect(sock, dns)
+            await self.loop.create_connection(lambda: conn, sock=sock)
+        except asyncio.CancelledError:
+            sock.close()
+        except OSError:
+            sock.close()
+            conn.connection_lost(None)
+        finally:
+            conn.connector = None
+
+    def _accept(self):
+        return AsyncSingleSocket(self, self.handler, incoming=True)
+
+    async def serve(self, handler):
+        """Accept connections on bound ports and run until the done flag is
+        set or the server is stopped"""
+        self.handler = handler
+        self.loop_thread = threading.get_ident()
+        self.stopped = self.loop.create_future()
+        try:
+            for server in list(self.sockethandler.servers.values()):
+                self.listeners.append(
+                    await self.loop.create_server(self._accept, sock=server))
+            for dsock in list(self.sockethandler.datagrams.values()):
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: AsyncDatagramSocket(self, dsock.handler),
+                    sock=dsock.socket)
+                self.listeners.append(transport)
+            while not self.doneflag.is_set() and not self.stopped.done():
+                await asyncio.wait([self.stopped], timeout=DONEFLAG_INTERVAL)
+        finally:
+            for listener in self.listeners:
+                listener.close()
+            self.listeners = []
+            self.finished.set()
+
+    def listen_forever(self, handler):
+        try:
+            self.loop.run_until_complete(self.serve(handler))
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        if self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def is_stopping(self):
+        return self.doneflag.is_set() or \
+            (self.stopped is not None and self.stopped.done())
+
+    def is_finished(self):
+        return self.finished.is_set()
+
+    def wait_until_finished(self):
+        self.finished.wait()
+
+    def exception(self, kbint=False):
+        if not kbint:
+            self.excflag.set()
+        self.exccount += 1
+        if self.errorfunc is None:
+            print_exc()
+        else:
+            data = StringIO()
+            print_exc(file=data)
+            if not kbint:
+                self.errorfunc(data.getvalue())
+
+    def shutdown(self):
+        for conn in list(self.connections):
+            if not conn.closed:
+                conn.close()
+        # Left open if serve was interrupted
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+        self.sockethandler.shutdown()
+        if self.owns_loop and not self.loop.is_running():
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
@@ -49,7 +49,8 @@ class Connection(object):
         self.keepalive = lambda: None
         self.closed = False
         self.buffer = b''
-        self.bufferlen = None
+        self.framing = False        # set once handshake is complete
+        self.partial = None         # bytearray for a message split by reads
         self.log = None
         self.read = self._read
         self.write = self._write
@@ -117,6 +118,12 @@ class Connection(object):
     def is_flushed(self):
         return self.connection.is_flushed()
 
+    def can_sendfile(self):
+        """Whether file regions may be sent as they are, unencrypted and
+        unlogged"""
+        return not self.encrypted and self.write == self._write and \
+            self.connection.can_sendfile()
+
     def _read_header(self, s):
         if s == protocol_name:
             return 8, self.read_options
@@ -410,8 +417,9 @@ class Connection(object):
             self.next_len, self.next_func = x
             if self.next_len < 0:  # already checked buffer
                 return             # wait for additional data
-            if self.bufferlen is not None:
-                self._read2(b'')
+            if self.framing:
+                s, self.buffer = self.buffer, b''
+                self._frame(s)
                 return
 
     def _switch_to_read2(self):
@@ -420,43 +428,41 @@ class Connection(object):
             self.encrypter.setrawaccess(self._read2, self._write)
         else:
             self.read = self._read2
-        self.bufferlen = len(self.buffer)
-        self.buffer = [self.buffer]
+        self.framing = True
 
-    def _read2(self, s):  # more efficient, requires buffer['',''] & bufferlen
+    def _read2(self, s):
         if self.log:
             self.log.write('r:' + hexlify(s).decode() + '\n')
         self.Encoder.measurefunc(len(s))
+        self._frame(s)
+
+    def _frame(self, s):
+        """Split length-prefixed messages out of received data
+
+        s may be a view of a buffer that is reused after this call returns.
+        Complete messages are passed on as memoryviews of s; a message that
+        spans reads is gathered into a bytearray, grown as its data arrives
+        rather than sized to the length the peer claims, which is passed on
+        when the rest arrives."""
+        s = memoryview(s)
         while True:
             if self.closed:
                 return
-            p = self.next_len - self.bufferlen
-            if self.next_len == 0:
-                m = b''
-            elif s:
-                if p > len(s):
-                    self.buffer.append(s)
-                    self.bufferlen += len(s)
+            if self.partial is not None:
+                need = self.next_len - len(self.partial)
+                if need > len(s):
+                    self.partial += s
                     return
-                self.bufferlen = len(s) - p
-                self.buffer.append(s[:p])
-                m = b''.join(self.buffer)
-                if p == len(s):
-                    self.buffer = []
-                else:
-                    self.buffer = [s[p:]]
-                s = b''
-            elif p <= 0:
-                # assert len(self.buffer) == 1
-                s = self.buffer[0]
-                self.bufferlen = len(s) - self.next_len
+                self.partial += s[:need]
+                m = memoryview(self.partial)
+                s = s[need:]
+                self.partial = None
+            elif self.next_len <= len(s):
                 m = s[:self.next_len]
-                if p == 0:
-                    self.buffer = []
-                else:
-                    self.buffer = [s[self.next_len:]]
-                s = b''
+                s = s[self.next_len:]
             else:
+                if s:
+                    self.partial = bytearray(s)
                 return
             try:
                 x = self.next_func(m)
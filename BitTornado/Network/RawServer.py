@@ -1,6 +1,7 @@
 import sys
-import bisect
+import heapq
 import socket
+import itertools
 import select
 import threading
 from io import StringIO
@@ -33,10 +34,111 @@ def autodetect_socket_style():
 READSIZE = 32768
 
 
+class Task(object):
+    """Handle on a function scheduled with RawServer.add_task
+
+    Calling cancel() marks the task dead; it is dropped when it reaches the
+    head of the queue rather than searched for."""
+    __slots__ = ('func', 'delay', 'tid', 'cancelled', 'queue')
+
+    def __init__(self, func, delay=0, tid=None):
+        self.func = func
+        self.delay = delay
+        self.tid = tid
+        self.cancelled = False
+        self.queue = None
+
+    def cancel(self):
+        """Prevent the task from running, if it has not already"""
+        if not self.cancelled:
+            self.cancelled = True
+            self.func = None
+            if self.queue is not None:
+                self.queue.cancelled()
+
+
+class TaskQueue(object):
+    """Binary heap of Tasks ordered by scheduled time
+
+    Cancelled tasks are left in the heap as tombstones and skipped on pop; the
+    heap is rebuilt when tombstones outnumber live tasks. Tasks are also
+    indexed by tid, so that kill(tid) only touches the tasks it cancels."""
+    def __init__(self):
+        self.heap = []
+        self.bytid = {}
+        self.dead = 0
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap) - self.dead
+
+    def push(self, task, when):
+        """Schedule task to run at time when"""
+        task.queue = self
+        heapq.heappush(self.heap, (when, next(self.counter), task))
+        if task.tid is not None:
+            self.bytid.setdefault(task.tid, set()).add(task)
+
+    def _detach(self, task):
+        task.queue = None
+        if task.tid is not None:
+            tasks = self.bytid.get(task.tid)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self.bytid[task.tid]
+
+    def _drop_dead(self):
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            self._detach(heapq.heappop(heap)[2])
+            self.dead -= 1
+
+    def next_time(self):
+        """Return scheduled time of next live task, or None if empty"""
+        self._drop_dead()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return next live task scheduled no later than now, or
+        None if there is no such task"""
+        self._drop_dead()
+        if not self.heap or self.heap[0][0] > now:
+            return None
+        task = heapq.heappop(self.heap)[2]
+        self._detach(task)
+        return task
+
+    def cancelled(self):
+        """Count a task cancelled in place, rebuilding the heap once
+        tombstones outnumber live tasks"""
+        self.dead += 1
+        if self.dead > len(self.heap) // 2:
+            self._compact()
+
+    def kill(self, tid):
+        """Cancel all queued tasks with a given tid"""
+        for task in self.bytid.pop(tid, ()):
+            task.cancel()
+
+    def _compact(self):
+        """Rebuild heap without tombstones"""
+        live = []
+        for entry in self.heap:
+            if entry[2].cancelled:
+                self._detach(entry[2])
+            else:
+                live.append(entry)
+        heapq.heapify(live)
+        self.heap = live
+        self.dead = 0
+
+
 class RawServer(object):
     def __init__(self, doneflag, timeout_check_interval, timeout, noisy=True,
                  ipv6_enable=True, failfunc=lambda x: None, errorfunc=None,
-                 sockethandler=None, excflag=threading.Event()):
+                 sockethandler=None, excflag=threading.Event(),
+                 poll_backend=None):
         self.timeout_check_interval = max(timeout_check_interval, 0)
         self.timeout = timeout
         self.servers = {}
@@ -47,20 +149,23 @@ class RawServer(object):
         self.failfunc = failfunc
         self.errorfunc = errorfunc
         self.exccount = 0
-        self.funcs = []
+        self.funcs = TaskQueue()
         self.externally_added = []
         self.finished = threading.Event()
         self.tasks_to_kill = set()
         self.excflag = excflag
 
         if sockethandler is None:
-            sockethandler = SocketHandler(timeout, ipv6_enable, READSIZE)
+            sockethandler = SocketHandler(timeout, ipv6_enable, READSIZE,
+                                          poll_backend)
         self.sockethandler = sockethandler
 
         # Transparently pass sockethandler functions through
         self.find_and_bind = sockethandler.find_and_bind
         self.start_connection = sockethandler.start_connection
         self.get_stats = sockethandler.get_stats
+        self.bind_udp = sockethandler.bind_udp
+        self.adopt_connection = sockethandler.adopt_connection
         # XXX Following don't appear to be used; consider removing
         self.bind = sockethandler.bind
         self.start_connection_raw = sockethandler.start_connection_raw
@@ -71,16 +176,23 @@ class RawServer(object):
         return self.excflag
 
     def add_task(self, func, delay=0, tid=None):
+        """Schedule func to be called after delay seconds
+
+        Returns a Task that may be cancelled; tasks sharing a tid may be
+        cancelled together with kill_tasks."""
         assert float(delay) >= 0
-        self.externally_added.append((func, delay, tid))
+        task = Task(func, delay, tid)
+        self.externally_added.append(task)
+        return task
 
     def pop_external(self):
         """Prepare tasks queued with add_task to be run in the listen_forever
         loop."""
         to_add, self.externally_added = self.externally_added, []
-        for (func, delay, tid) in to_add:
-            if tid not in self.tasks_to_kill:
-                bisect.insort(self.funcs, (clock() + delay, func, tid))
+        now = clock()
+        for task in to_add:
+            if not task.cancelled and task.tid not in self.tasks_to_kill:
+                self.funcs.push(task, now + task.delay)
 
     def scan_for_timeouts(self):
         self.add_task(self.scan_for_timeouts, self.timeout_check_interval)
@@ -93,20 +205,20 @@ class RawServer(object):
                 try:
                     self.pop_external()
                     self._kill_tasks()
-                    if self.funcs:
-                        period = max(0, self.funcs[0][0] + 0.001 - clock())
+                    nexttime = self.funcs.next_time()
+                    if nexttime is not None:
+                        period = max(0, nexttime + 0.001 - clock())
                     else:
                         period = 2 ** 30
                     events = self.sockethandler.do_poll(period)
                     if self.doneflag.is_set():
                         return
-                    while self.funcs and self.funcs[0][0] <= clock():
-                        _, func, tid = self.funcs.pop(0)
-                        if tid in self.tasks_to_kill:
-                            pass
+                    while True:
+                        task = self.funcs.pop_due(clock())
+                        if task is None:
+                            break
                         try:
-                            # print(func.func_name)
-                            func()
+                            task.func()
                         except (SystemError, MemoryError) as e:
                             self.failfunc(str(e))
                             return
@@ -146,8 +258,8 @@ class RawServer(object):
 
     def _kill_tasks(self):
         if self.tasks_to_kill:
-            self.funcs = [(t, func, tid) for (t, func, tid) in self.funcs
-                          if tid not in self.tasks_to_kill]
+            for tid in self.tasks_to_kill:
+                self.funcs.kill(tid)
             self.tasks_to_kill = set()
 
     def kill_tasks(self, tid):
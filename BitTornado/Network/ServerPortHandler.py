@@ -38,8 +38,8 @@ class SingleRawServer(object):
 
     def add_task(self, func, delay=0, tid=None):
         if not self.finished:
-            self.rawserver.add_task(func, delay,
-                                    self.info_hash if tid is None else tid)
+            return self.rawserver.add_task(
+                func, delay, self.info_hash if tid is None else tid)
 
 #    def bind(self, port, bind = '', reuse = False):
 #        pass    # not handled here
@@ -1,32 +1,72 @@
+import os
 import time
 import socket
 import random
 from errno import EWOULDBLOCK
-try:
-    from select import poll, POLLIN, POLLOUT, POLLERR, POLLHUP
-except ImportError:
-    from .selectpoll import poll, POLLIN, POLLOUT, POLLERR, POLLHUP
+from itertools import islice
+from collections import deque
 from BitTornado.clock import clock
+from . import selectpoll, selectorspoll
+from .selectpoll import POLLIN, POLLOUT, POLLERR, POLLHUP
 from .natpunch import UPnP_open_port, UPnP_close_port
 
 POLLALL = POLLIN | POLLOUT
 
+# All backends share the event values of select.poll
+POLL_BACKENDS = {'select': selectpoll.poll,
+                 'selectors': selectorspoll.poll}
+try:
+    from select import poll as _native_poll
+    POLL_BACKENDS['poll'] = _native_poll
+    DEFAULT_POLL_BACKEND = 'poll'
+except ImportError:
+    DEFAULT_POLL_BACKEND = 'select'
+
 UPnP_ERROR = "unable to forward port via UPnP"
 
+# Maximum number of queued buffers passed to a single sendmsg call
+SEND_IOVECS = 64
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+HAVE_SENDFILE = hasattr(os, 'sendfile')
+
+# Maximum number of datagrams read from a socket per poll event
+DATAGRAM_BATCH = 64
+
+
+class FileSlice(object):
+    """Region of an open file, queued on a SingleSocket in place of data so
+    that it is sent directly from disk with os.sendfile"""
+    __slots__ = ('fileh', 'offset', 'length')
+
+    def __init__(self, fileh, offset, length):
+        self.fileh = fileh
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, slc):
+        start, stop, step = slc.indices(self.length)
+        assert step == 1
+        return FileSlice(self.fileh, self.offset + start, max(stop - start, 0))
+
 
 class SingleSocket(object):
     def __init__(self, socket_handler, sock, handler, ip=None):
         self.socket_handler = socket_handler
         self.socket = sock
         self.handler = handler
-        self.buffer = []
+        self.buffer = deque()
+        self.offset = 0     # bytes of buffer[0] already sent
         self.last_hit = clock()
         self.fileno = sock.fileno()
         self.connected = False
+        self.writing = False
         self.skipped = 0
         try:
             self.ip = self.socket.getpeername()[0]
-        except OSError:
+        except (OSError, IndexError):   # IndexError: unnamed Unix socket
             if ip is None:
                 self.ip = 'unknown'
             else:
@@ -36,7 +76,7 @@ class SingleSocket(object):
         if real:
             try:
                 self.ip = self.socket.getpeername()[0]
-            except OSError:
+            except (OSError, IndexError):
                 pass
         return self.ip
 
@@ -55,7 +95,8 @@ class SingleSocket(object):
         self.connected = False
         sock = self.socket
         self.socket = None
-        self.buffer = []
+        self.buffer = deque()
+        self.offset = 0
         del self.socket_handler.single_sockets[self.fileno]
         self.socket_handler.poll.unregister(sock)
         sock.close()
@@ -69,6 +110,10 @@ class SingleSocket(object):
     def is_flushed(self):
         return not self.buffer
 
+    def can_sendfile(self):
+        """Whether FileSlices may be written to this socket"""
+        return HAVE_SENDFILE
+
     def write(self, s):
         # self.check.write(s)
         assert self.socket is not None
@@ -76,21 +121,52 @@ class SingleSocket(object):
         if len(self.buffer) == 1:
             self.try_write()
 
+    def _send(self):
+        """Send as much of the buffer as possible in one system call,
+        returning the number of bytes sent and whether all were sent"""
+        buffer = self.buffer
+        head = buffer[0]
+        if isinstance(head, FileSlice):
+            size = len(head) - self.offset
+            amount = os.sendfile(self.fileno, head.fileh.fileno(),
+                                 head.offset + self.offset, size)
+        else:
+            if HAVE_SENDMSG and len(buffer) > 1:
+                bufs = []
+                for buf in islice(buffer, SEND_IOVECS):
+                    if isinstance(buf, FileSlice):
+                        break
+                    bufs.append(buf)
+            else:
+                bufs = [head]
+            if self.offset:
+                bufs[0] = memoryview(bufs[0])[self.offset:]
+            size = sum(len(buf) for buf in bufs)
+            if len(bufs) > 1:
+                amount = self.socket.sendmsg(bufs)
+            else:
+                amount = self.socket.send(bufs[0])
+        self.socket_handler.count_send(amount)
+
+        # Drop completely sent buffers and note progress into the next
+        sent = amount + self.offset
+        while buffer and sent >= len(buffer[0]):
+            sent -= len(buffer.popleft())
+        self.offset = sent
+        return amount, amount == size
+
     def try_write(self):
         if self.connected:
             dead = False
             try:
                 while self.buffer:
-                    buf = self.buffer[0]
-                    amount = self.socket.send(buf)
+                    amount, complete = self._send()
                     if amount == 0:
                         self.skipped += 1
                         break
                     self.skipped = 0
-                    if amount != len(buf):
-                        self.buffer[0] = buf[amount:]
+                    if not complete:
                         break
-                    del self.buffer[0]
             except OSError as e:
                 try:
                     dead = e.errno != EWOULDBLOCK
@@ -102,26 +178,62 @@ class SingleSocket(object):
             if dead:
                 self.socket_handler.dead_from_write.append(self)
                 return
+        # Only touch write interest when the buffer empties or fills
         if self.buffer:
-            self.socket_handler.poll.register(self.socket, POLLALL)
-        else:
+            if not self.writing:
+                self.writing = True
+                self.socket_handler.poll.register(self.socket, POLLALL)
+        elif self.writing:
+            self.writing = False
             self.socket_handler.poll.register(self.socket, POLLIN)
 
     def set_handler(self, handler):
         self.handler = handler
 
 
+class DatagramSocket(object):
+    """A UDP socket whose datagrams are passed to
+    handler.datagram_received(socket, data, addr)"""
+    def __init__(self, sock, handler):
+        self.socket = sock
+        self.handler = handler
+
+    def sendto(self, data, addr):
+        try:
+            self.socket.sendto(data, addr)
+        except OSError:
+            pass    # Datagrams may be dropped
+
+    def close(self):
+        self.socket.close()
+
+
 class SocketHandler(object):
-    def __init__(self, timeout, ipv6_enable, readsize=100000):
+    def __init__(self, timeout, ipv6_enable, readsize=100000,
+                 poll_backend=None, recv_into=True):
         self.timeout = timeout
         self.ipv6_enable = ipv6_enable
         self.readsize = readsize
-        self.poll = poll()
+        # With recv_into, sockets are read into one preallocated buffer and
+        # handlers receive a memoryview that is only valid during the call
+        if recv_into:
+            self.readbuf = memoryview(bytearray(readsize))
+        else:
+            self.readbuf = None
+        if not poll_backend:
+            poll_backend = DEFAULT_POLL_BACKEND
+        try:
+            self.poll = POLL_BACKENDS[poll_backend]()
+        except KeyError:
+            raise ValueError('unknown poll backend: ' + poll_backend)
         self.single_sockets = {}  # {socket: SingleSocket}
         self.dead_from_write = []
         self.max_connects = 1000
         self.port_forwarded = None
         self.servers = {}
+        self.datagrams = {}     # {fileno: DatagramSocket}
+        self.send_calls = 0
+        self.bytes_sent = 0
 
     def scan_for_timeouts(self):
         t = clock() - self.timeout
@@ -129,11 +241,8 @@ class SocketHandler(object):
             if s.last_hit < t and s.socket is not None:
                 self._close_socket(s)
 
-    def bind(self, port, bind='', reuse=False, ipv6_socket_style=1, upnp=0):
-        port = int(port)
+    def _addrinfos(self, port, bind, ipv6_socket_style, kind):
         addrinfos = []
-        self.servers = {}
-        self.interfaces = []
         # if bind != "" thread it as a comma seperated list and bind to all
         # addresses (can be ips or hostnames) else bind to default ipv6 and
         # ipv4 address
@@ -144,7 +253,7 @@ class SocketHandler(object):
                 socktype = socket.AF_INET
             for addr in bind.split(','):
                 addrinfos.extend(socket.getaddrinfo(addr, port,
-                                 socktype, socket.SOCK_STREAM))
+                                 socktype, kind))
         else:
             if self.ipv6_enable:
                 addrinfos.append([socket.AF_INET6, None, None, None,
@@ -152,6 +261,14 @@ class SocketHandler(object):
             if not addrinfos or ipv6_socket_style != 0:
                 addrinfos.append([socket.AF_INET, None, None, None,
                                  ('', port)])
+        return addrinfos
+
+    def bind(self, port, bind='', reuse=False, ipv6_socket_style=1, upnp=0):
+        port = int(port)
+        self.servers = {}
+        self.interfaces = []
+        addrinfos = self._addrinfos(port, bind, ipv6_socket_style,
+                                    socket.SOCK_STREAM)
         for addrinfo in addrinfos:
             try:
                 server = socket.socket(addrinfo[0], socket.SOCK_STREAM)
@@ -195,6 +312,41 @@ class SocketHandler(object):
             self.port_forwarded = port
         self.port = port
 
+    def bind_udp(self, port, handler, bind='', ipv6_socket_style=1):
+        """Open UDP sockets on a port, passing the datagrams received to
+        handler.datagram_received(socket, data, addr)
+
+        data may be a view of a shared buffer, only valid during the
+        call, and replies are sent with socket.sendto(data, addr)."""
+        opened = []
+        try:
+            for addrinfo in self._addrinfos(int(port), bind,
+                                            ipv6_socket_style,
+                                            socket.SOCK_DGRAM):
+                sock = socket.socket(addrinfo[0], socket.SOCK_DGRAM)
+                opened.append(sock)
+                sock.setblocking(0)
+                sock.bind(addrinfo[4])
+        except OSError:
+            for sock in opened:
+                sock.close()
+            raise
+        for sock in opened:
+            self.datagrams[sock.fileno()] = DatagramSocket(sock, handler)
+            self.poll.register(sock, POLLIN)
+
+    def _read_datagrams(self, dsock):
+        for _ in range(DATAGRAM_BATCH):
+            try:
+                if self.readbuf is not None:
+                    amount, addr = dsock.socket.recvfrom_into(self.readbuf)
+                    data = self.readbuf[:amount]
+                else:
+                    data, addr = dsock.socket.recvfrom(self.readsize)
+            except OSError:
+                return
+            dsock.handler.datagram_received(dsock, data, addr)
+
     def find_and_bind(self, minport, maxport, bind='', reuse=False,
                       ipv6_socket_style=1, upnp=0, randomizer=False):
         e = 'maxport less than minport - no ports to check'
@@ -230,6 +382,18 @@ class SocketHandler(object):
         self.single_sockets[sock.fileno()] = s
         return s
 
+    def adopt_connection(self, sock, handler=None):
+        """Handle an already connected stream socket, such as one of a
+        socket pair"""
+        if handler is None:
+            handler = self.handler
+        sock.setblocking(0)
+        self.poll.register(sock, POLLIN)
+        s = SingleSocket(self, sock, handler)
+        s.connected = True
+        self.single_sockets[sock.fileno()] = s
+        return s
+
     def start_connection(self, dns, handler=None, randomize=False):
         if handler is None:
             handler = self.handler
@@ -278,6 +442,8 @@ class SocketHandler(object):
                         self.handler.external_connection_made(nss)
                     except OSError:
                         time.sleep(1)
+            elif sock in self.datagrams:
+                self._read_datagrams(self.datagrams[sock])
             else:
                 s = self.single_sockets.get(sock)
                 if not s:
@@ -289,7 +455,11 @@ class SocketHandler(object):
                 if event & POLLIN:
                     try:
                         s.last_hit = clock()
-                        data = s.socket.recv(self.readsize)
+                        if self.readbuf is not None:
+                            amount = s.socket.recv_into(self.readbuf)
+                            data = self.readbuf[:amount]
+                        else:
+                            data = s.socket.recv(self.readsize)
                         if not data:
                             self._close_socket(s)
                         else:
@@ -329,10 +499,19 @@ class SocketHandler(object):
             return []
         return r
 
+    def count_send(self, amount):
+        self.send_calls += 1
+        self.bytes_sent += amount
+
     def get_stats(self):
+        mbytes = self.bytes_sent / 2 ** 20
         return {'interfaces': self.interfaces,
                 'port': self.port,
-                'upnp': self.port_forwarded is not None}
+                'upnp': self.port_forwarded is not None,
+                'send_calls': self.send_calls,
+                'bytes_sent': self.bytes_sent,
+                'send_calls_per_mb': (self.send_calls / mbytes if mbytes
+                                      else 0.0)}
 
     def shutdown(self):
         for ss in list(self.single_sockets.values()):
@@ -345,5 +524,10 @@ class SocketHandler(object):
                 server.close()
             except OSError:
                 pass
+        for dsock in self.datagrams.values():
+            try:
+                dsock.close()
+            except OSError:
+                pass
         if self.port_forwarded is not None:
             UPnP_close_port(self.port_forwarded)
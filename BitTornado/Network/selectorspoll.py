@@ -0,0 +1,75 @@
+"""poll-compatible interface to the selectors module
+
+DefaultSelector picks the most efficient mechanism available (epoll, kqueue,
+devpoll, poll or select). Registrations are cached so that re-registering a
+file descriptor with an unchanged event mask makes no system call."""
+
+import selectors
+
+POLLIN = 1
+POLLOUT = 4
+POLLERR = 8
+POLLHUP = 16
+
+_TO_SELECTOR = {POLLIN: selectors.EVENT_READ,
+                POLLOUT: selectors.EVENT_WRITE,
+                POLLIN | POLLOUT: selectors.EVENT_READ | selectors.EVENT_WRITE}
+
+_FROM_SELECTOR = {selectors.EVENT_READ: POLLIN,
+                  selectors.EVENT_WRITE: POLLOUT,
+                  selectors.EVENT_READ | selectors.EVENT_WRITE:
+                  POLLIN | POLLOUT}
+
+
+class poll(object):
+    def __init__(self, selector=None):
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+        self.masks = {}
+
+    def register(self, f, t):
+        if not isinstance(f, int):
+            f = f.fileno()
+        events = _TO_SELECTOR.get(t & (POLLIN | POLLOUT))
+        old = self.masks.get(f)
+        if old == events:
+            return
+        if events is None:
+            self.unregister(f)
+            return
+        if old is None:
+            self.selector.register(f, events)
+        else:
+            try:
+                self.selector.modify(f, events)
+            except (OSError, KeyError):
+                # Descriptor was closed and reused without unregistering
+                try:
+                    self.selector.unregister(f)
+                except (OSError, KeyError):
+                    pass
+                self.selector.register(f, events)
+        self.masks[f] = events
+
+    def unregister(self, f):
+        if not isinstance(f, int):
+            f = f.fileno()
+        if self.masks.pop(f, None) is not None:
+            try:
+                self.selector.unregister(f)
+            except (OSError, KeyError, ValueError):
+                pass
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout /= 1000
+        try:
+            ready = self.selector.select(timeout)
+        except ValueError:
+            return None
+        return [(key.fd, _FROM_SELECTOR[events]) for key, events in ready]
+
+    def close(self):
+        self.selector.close()
+        self.masks = {}
@@ -3,7 +3,7 @@ import time
 import bisect
 
 POLLIN = 1
-POLLOUT = 2
+POLLOUT = 4
 POLLERR = 8
 POLLHUP = 16
 
@@ -1,4 +1,12 @@
 import random
+import hashlib
+from BitTornado.Meta.bencode import bencode
+
+
+def record_checksum(d):
+    """Checksum of a resume record, excluding any existing checksum"""
+    record = {key: val for key, val in d.items() if key != 'checksum'}
+    return hashlib.sha1(bencode(record)).hexdigest()
 
 
 class FileSelector:
@@ -60,9 +68,13 @@ class FileSelector:
                     a list of download priorities for each file.
                     Priority may be -1, 0, 1, 2.  -1 = download disabled,
                     0 = highest, 1 = normal, 2 = lowest.
+    d['checksum'] = hex SHA1 digest of the bencoded record without this key.
+                    Records whose checksum does not match are discarded.
     Also see Storage.pickle and StorageWrapper.pickle for additional keys.
     '''
     def unpickle(self, d):
+        if 'checksum' in d and d['checksum'] != record_checksum(d):
+            return
         if 'priority' in d and not self.init_priority(d['priority']):
             return
         pieces = self.storage.unpickle(d)
@@ -221,4 +233,5 @@ class FileSelector:
             d.update(sw)
         except (IOError, OSError):
             pass
+        d['checksum'] = record_checksum(d)
         return d
@@ -0,0 +1,110 @@
+"""Parallel verification of pieces already on disk
+
+HashChecker reads runs of consecutive pieces with large sequential reads and
+hashes each run on a thread pool. hashlib releases the GIL while hashing, so
+runs are checked on as many cores as there are workers while the next run is
+read from disk. Results are returned in the order the pieces were given.
+
+Example:
+
+checker = HashChecker(read, piecelen, prefixlen, workers=4)
+for run in checker.check(pieces):
+    for index, prefix_digest, digest in run:
+        ...
+checker.close()
+"""
+
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Pieces are read in runs of up to this many bytes (or one piece, if larger)
+READSIZE = 1048576
+# Runs read ahead of the oldest unfinished run, per worker
+READAHEAD = 2
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+class HashChecker(object):
+    """Hash pieces in storage on a pool of worker threads
+
+    read(piece, length) returns a PieceBuffer holding length bytes starting
+    at the beginning of piece, or None on failure. piecelen(piece) gives the
+    length of a piece. For each piece, the SHA1 digest of its first prefixlen
+    bytes is reported along with the digest of the whole piece, so that a
+    short last piece stored in place of another can be recognized."""
+    def __init__(self, read, piecelen, prefixlen, workers=0,
+                 readsize=READSIZE):
+        self.read = read
+        self.piecelen = piecelen
+        self.prefixlen = prefixlen
+        self.readsize = readsize
+        self.workers = workers if workers > 0 else default_workers()
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def _runs(self, pieces):
+        """Group pieces into runs of consecutive pieces, each run no longer
+        than readsize bytes unless it holds a single piece"""
+        run = []
+        length = 0
+        for piece in pieces:
+            plen = self.piecelen(piece)
+            if run and (piece != run[-1] + 1 or
+                        length + plen > self.readsize):
+                yield run, length
+                run = []
+                length = 0
+            run.append(piece)
+            length += plen
+        if run:
+            yield run, length
+
+    def _hash_run(self, data, run):
+        results = []
+        pos = 0
+        with memoryview(data.buf) as view:
+            for piece in run:
+                plen = self.piecelen(piece)
+                prefix = min(self.prefixlen, plen)
+                sh = hashlib.sha1(view[pos:pos + prefix])
+                sp = sh.digest()
+                sh.update(view[pos + prefix:pos + plen])
+                results.append((piece, sp, sh.digest()))
+                pos += plen
+        return results
+
+    def check(self, pieces):
+        """Generate, for each run of pieces in order, a list of
+        (piece, prefix digest, digest) tuples
+
+        Generates None and stops if a read fails."""
+        pending = deque()
+        runs = self._runs(pieces)
+        depth = self.workers * READAHEAD
+        while True:
+            while len(pending) < depth:
+                try:
+                    run, length = next(runs)
+                except StopIteration:
+                    break
+                data = self.read(run[0], length)
+                if data is None:
+                    # Runs still being hashed are left to the garbage
+                    # collector rather than returned to the buffer pool
+                    yield None
+                    return
+                pending.append((self.pool.submit(self._hash_run, data, run),
+                                data, run))
+            if not pending:
+                return
+            future, data, run = pending.popleft()
+            results = future.result()
+            data.release()
+            yield results
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -1,7 +1,9 @@
 import os
+import mmap
 import time
 import bisect
 import threading
+from collections import OrderedDict
 from .PieceBuffer import PieceBuffer
 
 DEBUG = False
@@ -10,10 +12,26 @@ if DEBUG:
     import traceback
 
 MAXREADSIZE = 32768
+O_BINARY = getattr(os, 'O_BINARY', 0)
 MAXLOCKSIZE = 1000000000
 MAXLOCKRANGE = 3999999999   # only lock first 4 gig of file
 
 
+class FileReader(object):
+    """Read-only file descriptor, closed once no longer referenced"""
+    fd = None
+
+    def __init__(self, fname):
+        self.fd = os.open(fname, os.O_RDONLY | O_BINARY)
+
+    def fileno(self):
+        return self.fd
+
+    def __del__(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+
 class Storage:
     def __init__(self, files, piece_length, doneflag, config,
                  disabled_files=None):
@@ -29,6 +47,11 @@ class Storage:
         total = 0
         # so_far = 0
         self.handles = {}       # {fname: fileh}
+        self.maps = {}          # {fname: memoryview}
+        self.readers = {}       # {fname: FileReader}
+        # {(kind, fname): None} for open handles, maps and readers, least
+        # recently used first, all drawing on the max_files_open budget
+        self.opened = OrderedDict()
         self.whandles = set()   # {fname}
         self.tops = {}          # {fname: length}
         self.sizes = {}         # {fname: size}
@@ -80,7 +103,6 @@ class Storage:
         self._reset_ranges()
 
         self.max_files_open = config['max_files_open']
-        self.handlebuffer = [] if 0 < self.max_files_open < numfiles else None
 
     if os.name == 'nt':
         def _lock_file(self, name, fileh):
@@ -123,8 +145,6 @@ class Storage:
 
     def _sync(self, fname):
         self._close(fname)
-        if self.handlebuffer:
-            self.handlebuffer.remove(fname)
 
     def sync(self):
         # may raise IOError or OSError
@@ -145,7 +165,7 @@ class Storage:
     def _open(self, fname, mode):
         if fname in self.mtimes:
             try:
-                if self.handlebuffer is not None:
+                if self.max_files_open > 0:
                     assert os.path.getsize(fname) == self.tops[fname]
                     newmtime = os.path.getmtime(fname)
                     oldmtime = self.mtimes[fname]
@@ -171,6 +191,7 @@ class Storage:
     def _close(self, fname):
         fileh = self.handles[fname]
         del self.handles[fname]
+        self.opened.pop(('handle', fname), None)
         if fname in self.whandles:
             self.whandles.remove(fname)
             fileh.flush()
@@ -187,8 +208,22 @@ class Storage:
         if fname not in self.handles:
             return
         self._close(fname)
-        if self.handlebuffer:
-            self.handlebuffer.remove(fname)
+
+    def _use(self, kind, fname):
+        """Mark a handle, map or reader as most recently used, closing the
+        least recently used of any kind while over the file budget"""
+        self.opened.pop((kind, fname), None)
+        self.opened[kind, fname] = None
+        while 0 < self.max_files_open < len(self.opened):
+            kind, fname = next(iter(self.opened))
+            if kind == 'handle':
+                self._close(fname)
+                continue
+            del self.opened[kind, fname]
+            if kind == 'map':
+                self._unmap(self.maps.pop(fname))
+            else:
+                del self.readers[fname]
 
     def _get_file_handle(self, fname, for_write):
         if fname in self.handles:
@@ -203,13 +238,6 @@ class Storage:
                     if DEBUG:
                         traceback.print_exc()
                     raise IOError('unable to reopen ' + fname + ': ' + str(e))
-
-            if self.handlebuffer:
-                if self.handlebuffer[-1] != fname:
-                    self.handlebuffer.remove(fname)
-                    self.handlebuffer.append(fname)
-            elif self.handlebuffer is not None:
-                self.handlebuffer.append(fname)
         else:
             try:
                 if for_write:
@@ -227,11 +255,7 @@ class Storage:
                     traceback.print_exc()
                 raise IOError('unable to open ' + fname + ': ' + str(e))
 
-            if self.handlebuffer is not None:
-                self.handlebuffer.append(fname)
-                if len(self.handlebuffer) > self.max_files_open:
-                    self._close(self.handlebuffer.pop(0))
-
+        self._use('handle', fname)
         return self.handles[fname]
 
     def _reset_ranges(self):
@@ -273,6 +297,86 @@ class Storage:
                     pos += length
         return pbuf
 
+    def read_mapped(self, pos, amount):
+        """Read through memory maps of the underlying files
+
+        Returns a memoryview over the mapped file if the range lies in a
+        single file. Ranges spanning several files are gathered into a new
+        buffer."""
+        views = []
+        for fname, begin, end in self._intervals(pos, amount):
+            with self.lock:
+                views.append(self._get_mapping(fname, end)[begin:end])
+        if len(views) == 1:
+            return views[0]
+        return memoryview(b''.join(views))
+
+    def locate(self, pos, amount):
+        """Find a range in the underlying files, for sending it directly from
+        disk
+
+        Returns a list of (file, offset, length) regions. Each file is a
+        FileReader, which stays open while any region refers to it."""
+        regions = []
+        for fname, begin, end in self._intervals(pos, amount):
+            with self.lock:
+                if fname in self.whandles:
+                    self.handles[fname].flush()
+                reader = self.readers.get(fname)
+                if reader is None:
+                    try:
+                        reader = FileReader(fname)
+                    except OSError as e:
+                        raise IOError('unable to open ' + fname + ': ' +
+                                      str(e))
+                self.readers[fname] = reader
+                self._use('reader', fname)
+            regions.append((reader, begin, end - begin))
+        return regions
+
+    def _get_mapping(self, fname, end):
+        # Data written through our own handle may not have reached the file
+        if fname in self.whandles:
+            self.handles[fname].flush()
+        mapping = self.maps.get(fname)
+        if mapping is not None and len(mapping) < end:
+            del self.maps[fname]
+            self.opened.pop(('map', fname), None)
+            self._unmap(mapping)
+            mapping = None
+        if mapping is None:
+            try:
+                with open(fname, 'rb') as fileh:
+                    mapping = memoryview(mmap.mmap(fileh.fileno(), 0,
+                                                   access=mmap.ACCESS_READ))
+            except (IOError, OSError, ValueError) as e:
+                raise IOError('unable to map ' + fname + ': ' + str(e))
+            if len(mapping) < end:
+                self._unmap(mapping)
+                raise IOError('error reading data from ' + fname)
+        self.maps[fname] = mapping
+        # Each mapping holds a file descriptor
+        self._use('map', fname)
+        return mapping
+
+    @staticmethod
+    def _unmap(mapping):
+        mm = mapping.obj
+        mapping.release()
+        try:
+            mm.close()
+        except BufferError:
+            # Views handed out are still in use; the map is closed once
+            # they have been released
+            pass
+
+    def _unmap_file(self, fname):
+        with self.lock:
+            mapping = self.maps.pop(fname, None)
+            if mapping is not None:
+                self.opened.pop(('map', fname), None)
+                self._unmap(mapping)
+
     def write(self, pos, s):
         # might raise an IOError
         total = 0
@@ -301,6 +405,11 @@ class Storage:
                 self.handles[fname].flush()
 
     def close(self):
+        for mapping in self.maps.values():
+            self._unmap(mapping)
+        self.maps.clear()
+        self.readers.clear()
+        self.opened.clear()
         for fname, fileh in self.handles.items():
             try:
                 self.unlock_file(fname, fileh)
@@ -312,7 +421,6 @@ class Storage:
                 pass
         self.handles = {}
         self.whandles = set()
-        self.handlebuffer = None
 
     def _get_disabled_ranges(self, fileidx):
         if not self.file_ranges[fileidx]:
@@ -435,6 +543,7 @@ class Storage:
         return self._get_disabled_ranges(fileidx)[1]
 
     def delete_file(self, fileidx):
+        self._unmap_file(self.files[fileidx][0])
         try:
             os.remove(self.files[fileidx][0])
         except OSError:
@@ -447,6 +556,11 @@ class Storage:
                     file # in torrent, and the size and last modification
                     time for those files.  Missing files are either empty
                     or disabled.
+    d['file stats'] = [ file #, size, mtime_ns, inode {, ...} ]
+                    The same files, with modification times in nanoseconds
+                    and inode numbers (0 where not supported).  When
+                    present, files are considered unchanged only if all of
+                    these match exactly.
     d['partial files'] = [ name, size, mtime... ]
                     Names, sizes and last modification times of files
                     containing partial piece data.  Filenames go by the
@@ -461,19 +575,21 @@ class Storage:
     '''
     def pickle(self):
         files = []
+        stats = []
         pfiles = []
         for i, (fname, size) in enumerate(self.files):
             if not size:
                 continue
             if not self.disabled[i]:
-                files.extend([i, os.path.getsize(fname),
-                              int(os.path.getmtime(fname))])
+                st = os.stat(fname)
+                files.extend([i, st.st_size, int(st.st_mtime)])
+                stats.extend([i, st.st_size, st.st_mtime_ns, st.st_ino])
             else:
                 for fname, _, _ in self._get_disabled_ranges(i)[2]:
                     pfiles.extend([os.path.basename(fname),
                                    os.path.getsize(fname),
                                    int(os.path.getmtime(fname))])
-        return {'files': files, 'partial files': pfiles}
+        return {'files': files, 'file stats': stats, 'partial files': pfiles}
 
     def unpickle(self, data):
         # assume all previously-disabled files have already been disabled
@@ -486,6 +602,11 @@ class Storage:
             for i in range(0, len(filelist), 3):
                 files[filelist[i]] = (filelist[i + 1], filelist[i + 2])
 
+            stats = {}
+            statlist = data.get('file stats', [])
+            for i in range(0, len(statlist), 4):
+                stats[statlist[i]] = tuple(statlist[i + 1:i + 4])
+
             pfilelist = data.get('partial files', [])
             for i in range(0, len(pfilelist), 3):
                 pfiles[pfilelist[i]] = (pfilelist[i + 1], pfilelist[i + 2])
@@ -512,6 +633,16 @@ class Storage:
                     return True
                 return not oldmtime - 1 < mtime < oldmtime + 1
 
+            def stat_changed(i, fname):
+                if i not in stats:
+                    return i not in files or changed(
+                        files[i], os.path.getsize(fname),
+                        os.path.getmtime(fname))
+                oldsize, oldmtime, oldino = stats[i]
+                st = os.stat(fname)
+                return st.st_size != oldsize or st.st_mtime_ns != oldmtime \
+                    or (oldino and st.st_ino and st.st_ino != oldino)
+
             for i, (fname, size) in enumerate(self.files):
                 if not size:
                     continue
@@ -532,8 +663,7 @@ class Storage:
                     continue
 
                 # Remove pieces unless part of unchanged completed files
-                if i not in files or changed(files[i], os.path.getsize(fname),
-                                             os.path.getmtime(fname)):
+                if stat_changed(i, fname):
                     start, end, _, fname = self.file_ranges[i]
                     if DEBUG:
                         print('removing ' + fname)
@@ -2,6 +2,7 @@ import hashlib
 import random
 import bisect
 from ..Types import Bitfield, OrderedSet
+from .HashChecker import HashChecker
 from BitTornado.clock import clock
 
 DEBUG = False
@@ -45,6 +46,7 @@ class StorageWrapper:
         self.unpauseflag = unpauseflag
 
         self.alloc_type = config.get('alloc_type', 'normal')
+        self.mmap_reads = config.get('mmap_reads', False)
         self.double_check = config.get('double_check', 0)
         self.triple_check = config.get('triple_check', 0)
         if self.triple_check:
@@ -84,6 +86,7 @@ class StorageWrapper:
         self.write_buf_size = 0
         self.write_buf = {}   # structure:  piece: [(start, data), ...]
         self.write_buf_list = []
+        self.checker = None
 
         self.initialize_tasks = [
             ['checking existing data', 0, self.init_hashcheck,
@@ -193,6 +196,13 @@ class StorageWrapper:
         self.check_numchecked = 0.0
         self.lastlen = self._piecelen(len(self.hashes) - 1)
         self.numchecked = 0.0
+        if self.check_total > 0 and self.check_hashes:
+            self.checker = HashChecker(
+                lambda piece, length: self.read_raw(piece, 0, length),
+                self._piecelen, self.lastlen,
+                self.config.get('check_workers', 0))
+            self.check_results = self.checker.check(self.check_list)
+            self.check_list = []
         return self.check_total > 0
 
     def _markgot(self, piece, pos):
@@ -210,45 +220,49 @@ class StorageWrapper:
 
     def hashcheckfunc(self):
         if self.flag.is_set():
-            return None
-        if not self.check_list:
-            return None
+            return self._end_hashcheck()
 
-        i = self.check_list.pop(0)
         if not self.check_hashes:
+            if not self.check_list:
+                return None
+            i = self.check_list.pop(0)
             self._markgot(i, i)
+            self.numchecked += 1
         else:
-            d1 = self.read_raw(i, 0, self.lastlen)
-            if d1 is None:
-                return None
-            sh = hashlib.sha1(d1[:])
-            d1.release()
-            sp = sh.digest()
-            d2 = self.read_raw(i, self.lastlen,
-                               self._piecelen(i) - self.lastlen)
-            if d2 is None:
-                return None
-            sh.update(d2[:])
-            d2.release()
-            s = sh.digest()
-            if s == self.hashes[i]:
-                self._markgot(i, i)
-            elif self.check_targets.get(s) and self._piecelen(i) == \
-                    self._piecelen(self.check_targets[s][-1]):
-                self._markgot(self.check_targets[s].pop(), i)
-                self.out_of_place += 1
-            elif not self.have[-1] and sp == self.hashes[-1] and (
-                    i == len(self.hashes) - 1 or
-                    not self._waspre(len(self.hashes) - 1)):
-                self._markgot(len(self.hashes) - 1, i)
-                self.out_of_place += 1
-            else:
-                self.places[i] = i
-        self.numchecked += 1
+            results = next(self.check_results, None)
+            if results is None:
+                return self._end_hashcheck()
+            for i, sp, s in results:
+                self._check_piece(i, sp, s)
+            self.numchecked += len(results)
         if self.amount_left == 0:
             self.finished()
         return self.numchecked / self.check_total
 
+    def _check_piece(self, i, sp, s):
+        """Place piece stored at i given the SHA1 digests of its first lastlen
+        bytes (sp) and of the whole piece (s)"""
+        if s == self.hashes[i]:
+            self._markgot(i, i)
+        elif self.check_targets.get(s) and self._piecelen(i) == \
+                self._piecelen(self.check_targets[s][-1]):
+            self._markgot(self.check_targets[s].pop(), i)
+            self.out_of_place += 1
+        elif not self.have[-1] and sp == self.hashes[-1] and (
+                i == len(self.hashes) - 1 or
+                not self._waspre(len(self.hashes) - 1)):
+            self._markgot(len(self.hashes) - 1, i)
+            self.out_of_place += 1
+        else:
+            self.places[i] = i
+
+    def _end_hashcheck(self):
+        if self.checker is not None:
+            self.checker.close()
+            self.checker = None
+            self.check_results = None
+        return None
+
     def init_movedata(self):
         if self.flag.is_set():
             return False
@@ -480,7 +494,8 @@ class StorageWrapper:
         else:
             self.write_buf[piece] = []
         self.write_buf_list.append(piece)
-        self.write_buf[piece].append((start, data))
+        # data may be a view of a network buffer that will be reused
+        self.write_buf[piece].append((start, bytes(data)))
         return True
 
     def _flush_buffer(self, piece, popped=False):
@@ -613,7 +628,7 @@ class StorageWrapper:
             old = self.read_raw(self.places[index], begin, len(piece))
             if old is None:
                 return True
-            if old[:].tostring() != piece:
+            if old[:].tobytes() != piece:
                 try:
                     self.failed_pieces[index].add(
                         self.download_history[index][begin])
@@ -712,7 +727,7 @@ class StorageWrapper:
             if begin > self._piecelen(index):
                 return None
             length = self._piecelen(index) - begin
-            if begin == 0:
+            if begin == 0 and not self.mmap_reads:
                 return self.read_raw(self.places[index], 0, length)
         elif begin + length > self._piecelen(index):
             return None
@@ -720,6 +735,8 @@ class StorageWrapper:
             s = data[begin:begin + length]
             data.release()
             return s
+        if self.mmap_reads:
+            return self.read_mapped(self.places[index], begin, length)
         data = self.read_raw(self.places[index], begin, length)
         if data is None:
             return None
@@ -727,6 +744,21 @@ class StorageWrapper:
         data.release()
         return s
 
+    def get_piece_regions(self, index, begin, length):
+        """Locate part of a verified piece in the files holding it
+
+        Returns a list of (file, offset, length) regions as given by
+        Storage.locate, or None if the data must be read with get_piece."""
+        if not self.have[index] or not self.waschecked[index] or \
+                begin + length > self._piecelen(index):
+            return None
+        try:
+            return self.storage.locate(
+                self.piece_size * self.places[index] + begin, length)
+        except IOError as e:
+            self.failed('IO Error: ' + str(e))
+            return None
+
     def read_raw(self, piece, begin, length, flush_first=False):
         try:
             return self.storage.read(self.piece_size * piece + begin,
@@ -735,6 +767,14 @@ class StorageWrapper:
             self.failed('IO Error: ' + str(e))
             return None
 
+    def read_mapped(self, piece, begin, length):
+        try:
+            return self.storage.read_mapped(self.piece_size * piece + begin,
+                                            length)
+        except IOError as e:
+            self.failed('IO Error: ' + str(e))
+            return None
+
     def set_file_readonly(self, n):
         try:
             self.storage.set_readonly(n)
@@ -893,7 +933,10 @@ class StorageWrapper:
                 _places = []
                 _partials = []
             else:
-                have = Bitfield(len(self.hashes), data['pieces'])
+                pieces = data['pieces']
+                if isinstance(pieces, str):     # decoded as text by bdecode
+                    pieces = pieces.encode('utf-8')
+                have = Bitfield(len(self.hashes), pieces)
                 _places = data['places']
                 assert len(_places) % 2 == 0
                 _places = [_places[x:x + 2]
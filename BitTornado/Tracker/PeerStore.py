@@ -0,0 +1,472 @@
+"""Compact storage for the peers of the swarms a tracker follows
+
+Each peer is a Peer record with __slots__, indexed by peer ID in the Swarm
+of its torrent. Peers that have passed NAT checking are also listed in
+PeerArrays, contiguous buffers of compact addresses (4-byte IPv4 address,
+2-byte port), one for each combination of seeding state and crypto class.
+Peers whose address has no compact form, such as IPv6 addresses or host
+names, are listed in AddressLists of (IP, port) instead, served only in
+non-compact responses. A peer is listed in exactly one array and records
+its position there.
+Removal moves the last entry of the array into the vacated position, so
+peer lists are random samples taken straight from the arrays, and no other
+per-peer structure has to be kept or rebuilt. Peers are expired by a
+TimingWheel of announce times.
+"""
+
+import random
+from bisect import bisect_left
+
+# Length of a compact peer address
+COMPACT_LEN = 6
+
+# Ticks of the expiry timing wheel per expiry timeout
+EXPIRY_TICKS = 45
+
+# Crypto classes: peers without crypto, supporting it, and requiring it.
+# Peers requiring crypto are flagged as such in compact responses
+PLAIN, SUPPORTS, REQUIRES = range(3)
+
+# Crypto classes listed for each tracker response type (see Tracker.get)
+NOCRYPTO = (PLAIN, SUPPORTS)
+CRYPTO = (SUPPORTS, REQUIRES)
+ALL = (PLAIN, SUPPORTS, REQUIRES)
+RETURN_CLASSES = (NOCRYPTO, CRYPTO, ALL, NOCRYPTO, NOCRYPTO)
+
+
+def crypto_class(supportcrypto, requirecrypto):
+    if requirecrypto:
+        return REQUIRES
+    return SUPPORTS if supportcrypto else PLAIN
+
+
+class Peer(object):
+    """A peer in a swarm
+
+    nat is None while the peer has not been checked, 0 if it is reachable
+    and a count of failed checks otherwise. pos is the position of the
+    peer's compact address in its PeerArray, or -1 if not listed."""
+    __slots__ = ('ip', 'port', 'left', 'supportcrypto', 'requirecrypto',
+                 'key', 'given_ip', 'nat', 'time', 'pos')
+
+    def __init__(self, ip, port, left, supportcrypto=0, requirecrypto=0,
+                 key=None, given_ip=None, nat=None, time=0):
+        self.ip = ip
+        self.port = port
+        self.left = left
+        self.supportcrypto = supportcrypto
+        self.requirecrypto = requirecrypto
+        self.key = key
+        self.given_ip = given_ip
+        self.nat = nat
+        self.time = time
+        self.pos = -1
+
+    @property
+    def crypto_class(self):
+        return crypto_class(self.supportcrypto, self.requirecrypto)
+
+    def state(self):
+        """Return the peer as recorded in the tracker state file"""
+        info = {'ip': self.ip, 'port': self.port, 'left': self.left,
+                'supportcrypto': self.supportcrypto,
+                'requirecrypto': self.requirecrypto}
+        if self.key is not None:
+            info['key'] = self.key
+        if self.given_ip is not None:
+            info['given ip'] = self.given_ip
+        if self.nat is not None:
+            info['nat'] = int(self.nat)
+        return info
+
+    @classmethod
+    def from_state(cls, info):
+        """Construct a peer from a tracker state file record"""
+        nat = info.get('nat')
+        return cls(info['ip'], info['port'], info['left'],
+                   int(info['supportcrypto']), int(info['requirecrypto']),
+                   info.get('key'), info.get('given ip'),
+                   None if nat is None else int(nat))
+
+
+class PeerArray(object):
+    """Compact addresses of a set of peers in one buffer, with the ID of the
+    peer at each position"""
+    __slots__ = ('addrs', 'peerids')
+
+    def __init__(self):
+        self.addrs = bytearray()
+        self.peerids = []
+
+    def __len__(self):
+        return len(self.peerids)
+
+    def append(self, peerid, addr):
+        """Add a compact address, returning its position"""
+        self.addrs += addr
+        self.peerids.append(peerid)
+        return len(self.peerids) - 1
+
+    def remove(self, pos):
+        """Remove the address at a position, returning the ID of the peer
+        moved into its place, if any"""
+        last = len(self.peerids) - 1
+        moved = None
+        if pos != last:
+            start = pos * COMPACT_LEN
+            self.addrs[start:start + COMPACT_LEN] = \
+                self.addrs[last * COMPACT_LEN:]
+            moved = self.peerids[pos] = self.peerids[last]
+        del self.addrs[last * COMPACT_LEN:]
+        self.peerids.pop()
+        return moved
+
+    def addr(self, pos):
+        """Compact address at a position"""
+        start = pos * COMPACT_LEN
+        return bytes(self.addrs[start:start + COMPACT_LEN])
+
+
+class AddressList(object):
+    """Addresses with no compact form, as (IP, port), with the ID of the
+    peer at each position, kept as PeerArray keeps compact ones"""
+    __slots__ = ('addrs', 'peerids')
+
+    def __init__(self):
+        self.addrs = []
+        self.peerids = []
+
+    def __len__(self):
+        return len(self.peerids)
+
+    def append(self, peerid, addr):
+        """Add an address, returning its position"""
+        self.addrs.append(addr)
+        self.peerids.append(peerid)
+        return len(self.peerids) - 1
+
+    def remove(self, pos):
+        """Remove the address at a position, returning the ID of the peer
+        moved into its place, if any"""
+        moved = None
+        if pos != len(self.peerids) - 1:
+            self.addrs[pos] = self.addrs[-1]
+            moved = self.peerids[pos] = self.peerids[-1]
+        self.addrs.pop()
+        self.peerids.pop()
+        return moved
+
+    def addr(self, pos):
+        """(IP, port) at a position"""
+        return self.addrs[pos]
+
+
+def positions(total, count):
+    """Return count distinct random positions below total, in order"""
+    if 2 * count > total:
+        return sorted(random.sample(range(total), count))
+    # Reducing random words and discarding repeats is much faster than
+    # random.sample when few repeats are expected
+    chosen = set()
+    while len(chosen) < count:
+        need = count - len(chosen)
+        words = memoryview(random.getrandbits(32 * need).to_bytes(
+            4 * need, 'little')).cast('I')
+        chosen.update([word % total for word in words])
+    return sorted(chosen)
+
+
+def sample(arrays, count):
+    """Choose up to count entries at random from (crypto class, PeerArray)
+    pairs, as (crypto class, PeerArray, [position, ...]) triples"""
+    sizes = [len(array.peerids) for _, array in arrays]
+    total = sum(sizes)
+    if count >= total:
+        return [(cclass, array, range(len(array)))
+                for cclass, array in arrays]
+    chosen = positions(total, count)
+    picks = []
+    start = lo = 0
+    for (cclass, array), size in zip(arrays, sizes):
+        start += size
+        hi = bisect_left(chosen, start, lo)
+        if hi > lo:
+            picks.append((cclass, array,
+                          [pos - start + size for pos in chosen[lo:hi]]))
+        lo = hi
+    return picks
+
+
+class Swarm(object):
+    """The peers of one torrent, by peer ID"""
+    __slots__ = ('peers', 'seeds', 'arrays', 'harvested', 'unpacked',
+                 'harvested_unpacked')
+
+    def __init__(self):
+        self.peers = {}
+        self.seeds = 0
+        # Listed peers as [leechers, seeds] for each crypto class
+        self.arrays = [[PeerArray(), PeerArray()] for _ in ALL]
+        # Peers reported by other trackers, offered as plain leechers
+        self.harvested = PeerArray()
+        # AddressLists as arrays and harvested, made once needed
+        self.unpacked = None
+        self.harvested_unpacked = None
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, peerid):
+        return peerid in self.peers
+
+    def __iter__(self):
+        return iter(self.peers)
+
+    def __getitem__(self, peerid):
+        return self.peers[peerid]
+
+    def get(self, peerid, default=None):
+        return self.peers.get(peerid, default)
+
+    def items(self):
+        return self.peers.items()
+
+    def add(self, peerid, peer):
+        """Add an unlisted peer"""
+        self.peers[peerid] = peer
+        self.seeds += not peer.left
+
+    def remove(self, peerid):
+        """Remove a peer, returning it"""
+        peer = self.peers[peerid]
+        self.unlist(peerid, peer)
+        del self.peers[peerid]
+        self.seeds -= not peer.left
+        return peer
+
+    def _array(self, peer):
+        return self.arrays[peer.crypto_class][not peer.left]
+
+    def _listing(self, peerid, peer):
+        """The PeerArray or AddressList a listed peer is in"""
+        array = self._array(peer)
+        if peer.pos < len(array) and array.peerids[peer.pos] == peerid:
+            return array
+        return self.unpacked[peer.crypto_class][not peer.left]
+
+    def list(self, peerid, peer, addr):
+        """List a reachable peer under its compact address, or under
+        (IP, port) if its address has no compact form"""
+        self.unlist(peerid, peer)
+        if isinstance(addr, tuple):
+            if self.unpacked is None:
+                self.unpacked = [[AddressList(), AddressList()] for _ in ALL]
+            array = self.unpacked[peer.crypto_class][not peer.left]
+        else:
+            array = self._array(peer)
+        peer.pos = array.append(peerid, addr)
+
+    def unlist(self, peerid, peer):
+        """Remove a peer from peer lists, returning its address as given
+        to list, or None if it was not listed"""
+        if peer.pos < 0:
+            return None
+        array = self._listing(peerid, peer)
+        addr = array.addr(peer.pos)
+        moved = array.remove(peer.pos)
+        if moved is not None:
+            self.peers[moved].pos = peer.pos
+        peer.pos = -1
+        return addr
+
+    def set_left(self, peerid, peer, left):
+        """Update the amount a peer has left, moving it between leechers
+        and seeds"""
+        if (not left) == (not peer.left):
+            peer.left = left
+            return
+        addr = self.unlist(peerid, peer)
+        self.seeds += (not left) - (not peer.left)
+        peer.left = left
+        if addr is not None:
+            self.list(peerid, peer, addr)
+
+    def set_harvested(self, harvest, compact):
+        """Replace the peers reported by other trackers with a list of
+        (peer ID, IP, port), compacted with compact(ip, port)"""
+        self.harvested = PeerArray()
+        self.harvested_unpacked = None
+        for peerid, ip, port in harvest:
+            if peerid in self.peers:
+                continue
+            addr = compact(ip, port)
+            if len(addr) == COMPACT_LEN:
+                self.harvested.append(peerid, addr)
+            else:
+                if self.harvested_unpacked is None:
+                    self.harvested_unpacked = AddressList()
+                self.harvested_unpacked.append(peerid, (ip, port))
+
+    def select(self, classes, is_seed, count, unpacked=False):
+        """Choose up to count listed peers of the given crypto classes at
+        random, as (crypto class, array, [position, ...]) triples
+
+        Seeds and leechers are chosen in proportion to their numbers, and
+        seeds are given only leechers. Peers with no compact address are
+        only chosen if unpacked is set, for responses that can hold them."""
+        leechers = [(cclass, self.arrays[cclass][0]) for cclass in classes]
+        seeds = [] if is_seed else \
+            [(cclass, self.arrays[cclass][1]) for cclass in classes]
+        if PLAIN in classes:
+            leechers.append((PLAIN, self.harvested))
+        if unpacked:
+            if self.unpacked is not None:
+                leechers.extend((cclass, self.unpacked[cclass][0])
+                                for cclass in classes)
+                if not is_seed:
+                    seeds.extend((cclass, self.unpacked[cclass][1])
+                                 for cclass in classes)
+            if PLAIN in classes and self.harvested_unpacked is not None:
+                leechers.append((PLAIN, self.harvested_unpacked))
+        nleechers = sum(len(array.peerids) for _, array in leechers)
+        nseeds = sum(len(array.peerids) for _, array in seeds)
+        if not nleechers + nseeds:
+            return []
+        nseeds = min(nseeds, count - count * nleechers //
+                     (nleechers + nseeds))
+        return sample(seeds, nseeds) + \
+            sample(leechers, count - nseeds)
+
+    @staticmethod
+    def compact(picks):
+        """Return the compact addresses and crypto flags of chosen peers"""
+        addrs = []
+        flags = bytearray()
+        for cclass, array, chosen in picks:
+            buf = array.addrs
+            addrs.extend([buf[pos * COMPACT_LEN:(pos + 1) * COMPACT_LEN]
+                          for pos in chosen])
+            flags += bytes([cclass == REQUIRES]) * len(chosen)
+        return b''.join(addrs), bytes(flags)
+
+    @staticmethod
+    def expand(picks, peer_id=True):
+        """Return chosen peers as dictionaries of IP, port and peer ID"""
+        peers = []
+        for _, array, chosen in picks:
+            for pos in chosen:
+                addr = array.addr(pos)
+                if isinstance(addr, tuple):
+                    peer = {'ip': addr[0], 'port': addr[1]}
+                else:
+                    peer = {'ip': '.'.join(str(byte) for byte in addr[:4]),
+                            'port': int.from_bytes(addr[4:], 'big')}
+                if peer_id:
+                    peer['peer id'] = array.peerids[pos]
+                peers.append(peer)
+        return peers
+
+    def state(self):
+        """Return the peers as recorded in the tracker state file"""
+        return {peerid: peer.state() for peerid, peer in self.peers.items()}
+
+
+class TimingWheel(object):
+    """Peers bucketed by the time of their last announce
+
+    Each bucket holds the peers that last announced within one tick of
+    width seconds, as {infohash: {peerid, ...}}. A peer announcing again
+    moves to the bucket of its new tick, so expiring stale peers takes
+    whole buckets that have aged out and visits no other peer."""
+    def __init__(self, width):
+        self.width = width
+        self.buckets = {}
+        self.oldest = None  # No bucket is older than this tick
+
+    def tick(self, when):
+        return int(when // self.width)
+
+    def add(self, infohash, peerid, when):
+        tick = self.tick(when)
+        try:
+            bucket = self.buckets[tick]
+        except KeyError:
+            bucket = self.buckets[tick] = {}
+        try:
+            bucket[infohash].add(peerid)
+        except KeyError:
+            bucket[infohash] = {peerid}
+        if self.oldest is None or tick < self.oldest:
+            self.oldest = tick
+
+    def remove(self, infohash, peerid, when):
+        bucket = self.buckets.get(self.tick(when))
+        if bucket is not None:
+            peerids = bucket.get(infohash)
+            if peerids is not None:
+                peerids.discard(peerid)
+                if not peerids:
+                    del bucket[infohash]
+
+    def move(self, infohash, peerid, old, new):
+        """Move a peer that last announced at old to the bucket of new"""
+        if self.tick(old) != self.tick(new):
+            self.remove(infohash, peerid, old)
+            self.add(infohash, peerid, new)
+
+    def expire(self, before):
+        """Remove the buckets of ticks ending by a time, generating
+        (infohash, {peerid, ...}) for the peers in them"""
+        last = self.tick(before) - 1
+        while self.oldest is not None and self.oldest <= last:
+            bucket = self.buckets.pop(self.oldest, None)
+            self.oldest = self.oldest + 1 if self.buckets else None
+            if bucket:
+                yield from bucket.items()
+
+
+class PeerStore(dict):
+    """Swarms by infohash, with peers bucketed by announce time for expiry
+    in ticks of width seconds"""
+    def __init__(self, width=60):
+        super(PeerStore, self).__init__()
+        self.wheel = TimingWheel(width)
+
+    def swarm(self, infohash):
+        """Return the swarm of a torrent, creating it if necessary"""
+        try:
+            return self[infohash]
+        except KeyError:
+            swarm = self[infohash] = Swarm()
+            return swarm
+
+    def state(self):
+        """Return all peers as recorded in the tracker state file"""
+        return {infohash: swarm.state() for infohash, swarm in self.items()}
+
+    def add(self, infohash, peerid, peer):
+        """Add an unlisted peer that last announced at peer.time"""
+        self.swarm(infohash).add(peerid, peer)
+        self.wheel.add(infohash, peerid, peer.time)
+
+    def remove(self, infohash, peerid):
+        """Remove a peer, returning it"""
+        peer = self[infohash].remove(peerid)
+        self.wheel.remove(infohash, peerid, peer.time)
+        return peer
+
+    def touch(self, infohash, peerid, peer, now):
+        """Record an announce by a peer"""
+        self.wheel.move(infohash, peerid, peer.time, now)
+        peer.time = now
+
+    def expire(self, before):
+        """Remove peers that have not announced since a time, up to the
+        resolution of one tick, returning their number"""
+        expired = 0
+        for infohash, peerids in self.wheel.expire(before):
+            swarm = self[infohash]
+            for peerid in peerids:
+                swarm.remove(peerid)
+            expired += len(peerids)
+        return expired
@@ -0,0 +1,346 @@
+"""Tracker sharded across processes by infohash
+
+With shards > 1, track() starts a worker process per shard, each running a
+Tracker on its own RawServer and saving its own dfile. The listening
+process reads each request only far enough to find its infohash, forwards
+it over a socket pair to the shard owning that infohash, and answers when
+the shard replies. Scrapes and the info page gather the results of every
+shard involved and merge them.
+
+Messages between processes are marshalled tuples, each prefixed with its
+length: a method name and arguments from the listening process, and a
+success flag and result (or ValueError message) in reply, in order.
+"""
+
+import struct
+import marshal
+import urllib.parse
+from collections import deque
+from traceback import print_exc
+
+from .UDPHandler import UDPHandler, announce_reply, scrape_reply, \
+    error_reply
+from BitTornado.Meta.bencode import bencode
+
+FRAME = struct.Struct('>I')
+INFOPAGE_PATHS = ('', 'index.html')
+SCRAPE_PATHS = ('scrape', 'scrape.php', 'tracker.php/scrape')
+
+
+def shard_of(infohash, nshards):
+    """Return the shard owning an infohash"""
+    return int.from_bytes(infohash[:4], 'big') % nshards
+
+
+def frame(message):
+    data = marshal.dumps(message)
+    return FRAME.pack(len(data)) + data
+
+
+class FrameReader(object):
+    """Split a stream into the messages framed in it"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        pos = 0
+        while len(self.buffer) - pos >= FRAME.size:
+            end = pos + FRAME.size + FRAME.unpack_from(self.buffer, pos)[0]
+            if end > len(self.buffer):
+                break
+            messages.append(marshal.loads(self.buffer[pos + FRAME.size:end]))
+            pos = end
+        del self.buffer[:pos]
+        return messages
+
+
+def split_state(state, nshards):
+    """Split tracker state into the states of shards
+
+    Peers and completed downloads are divided by infohash; lists of
+    allowed torrents are shared by every shard."""
+    states = [{key: value for key, value in state.items()
+               if key not in ('peers', 'completed')}
+              for _ in range(nshards)]
+    for key in ('peers', 'completed'):
+        for shard in states:
+            shard[key] = {}
+        for infohash, value in state.get(key, {}).items():
+            states[shard_of(infohash, nshards)][key][infohash] = value
+    return states
+
+
+def merge_states(states):
+    """Merge the states of shards into one tracker state"""
+    merged = {'peers': {}, 'completed': {}}
+    for state in states:
+        for key, value in state.items():
+            if key == 'peers':
+                merged['peers'].update(value)
+            elif key == 'completed':
+                for infohash, count in value.items():
+                    merged['completed'][infohash] = \
+                        merged['completed'].get(infohash, 0) + count
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+def merge_files(results):
+    """Merge scrape data of shards, adding up the counts of torrents that
+    several shards report"""
+    merged = {}
+    for files in results:
+        for infohash, f in files.items():
+            if infohash in merged:
+                merged[infohash] = dict(f, **{
+                    key: merged[infohash][key] + f[key]
+                    for key in ('complete', 'incomplete', 'downloaded')})
+            else:
+                merged[infohash] = f
+    return merged
+
+
+def merge_rows(results):
+    """Merge info page rows of shards, adding up the counts of torrents
+    that several shards list"""
+    merged = {}
+    for rows in results:
+        for name, infohash, size, complete, downloading, downloaded in rows:
+            row = merged.get(infohash)
+            if row is not None:
+                complete += row[3]
+                downloading += row[4]
+                downloaded += row[5]
+            merged[infohash] = (name, infohash, size, complete, downloading,
+                                downloaded)
+    return list(merged.values())
+
+
+class ForwardedConnection(object):
+    """Stands in for the client connection of a forwarded request"""
+    def __init__(self, ip):
+        self.ip = ip
+
+    def get_ip(self):
+        return self.ip
+
+
+class ShardServer(object):
+    """Answer requests forwarded to the Tracker of a shard"""
+    def __init__(self, tracker, doneflag):
+        self.tracker = tracker
+        self.doneflag = doneflag
+        self.reader = FrameReader()
+        self.methods = {'get': self.get, 'scrape': self.scrape,
+                        'rows': self.rows, 'ping': lambda: None,
+                        'udp_announce': tracker.udp_announce,
+                        'udp_scrape': tracker.udp_scrape}
+
+    def get(self, ip, path, headers):
+        return self.tracker.get(ForwardedConnection(ip), path, headers)
+
+    def scrape(self, ip, infohashes):
+        self.tracker.check_ip(ip)
+        return self.tracker.scrape_files(infohashes)
+
+    def rows(self, ip):
+        self.tracker.check_ip(ip)
+        return self.tracker.infopage_rows()
+
+    def external_connection_made(self, connection):
+        pass
+
+    def connection_flushed(self, connection):
+        pass
+
+    def connection_lost(self, connection):
+        self.doneflag.set()
+
+    def data_came_in(self, connection, data):
+        for message in self.reader.feed(data):
+            if message[0] == 'stop':
+                self.doneflag.set()
+                return
+            # Every request is answered, or replies would be mismatched
+            try:
+                reply = (True, self.methods[message[0]](*message[1:]))
+            except ValueError as e:
+                reply = (False, str(e))
+            except Exception:
+                print_exc()
+                reply = (False, 'Server Error')
+            connection.write(frame(reply))
+
+
+class ShardRouter(object):
+    """Forward requests to the shards owning their infohashes
+
+    sockets connect to the shards in order; infopage renders the info
+    page from a function returning Tracker.infopage_rows."""
+    def __init__(self, config, rawserver, sockets, infopage):
+        self.config = config
+        self.rawserver = rawserver
+        self.infopage = infopage
+        self.uq_broken = urllib.parse.unquote('+') != ' '
+        self.links = [rawserver.adopt_connection(sock, self)
+                      for sock in sockets]
+        self.readers = {link: FrameReader() for link in self.links}
+        self.pending = {link: deque() for link in self.links}
+        # Links are idle between requests; keep them from timing out
+        self.ping_interval = max(config['socket_timeout'] / 3, 1)
+        rawserver.add_task(self.ping, self.ping_interval)
+
+    def shard(self, infohash):
+        return shard_of(infohash, len(self.links))
+
+    def request(self, shard, callback, method, *args):
+        """Make a request of a shard, passing callback the success flag
+        and result of the reply"""
+        link = self.links[shard]
+        self.pending[link].append(callback)
+        link.write(frame((method,) + args))
+
+    def gather(self, requests, done, refused):
+        """Make (shard, method, args) requests, passing done the list of
+        results once all succeed, or refused the first failure message"""
+        results = [None] * len(requests)
+        waiting = len(requests)
+        if not requests:
+            done(results)
+
+        def reply(i, ok, result):
+            nonlocal waiting
+            if waiting <= 0:
+                return
+            if not ok:
+                waiting = 0
+                refused(result)
+                return
+            results[i] = result
+            waiting -= 1
+            if waiting == 0:
+                done(results)
+
+        for i, (shard, method, args) in enumerate(requests):
+            self.request(shard, lambda ok, result, i=i: reply(i, ok, result),
+                         method, *args)
+
+    def ping(self):
+        self.rawserver.add_task(self.ping, self.ping_interval)
+        for shard in range(len(self.links)):
+            self.request(shard, None, 'ping')
+
+    def stop(self):
+        for link in self.links:
+            link.write(frame(('stop',)))
+
+    def parse(self, path):
+        """Return the name of a request path and the infohashes in its
+        query, as Tracker.get reads them"""
+        _, _, name, _, query, _ = urllib.parse.urlparse(path)
+        if self.uq_broken:
+            name = name.replace('+', ' ')
+            query = query.replace('+', ' ')
+        infohashes = []
+        for subquery in query.split('&'):
+            key, _, val = subquery.partition('=')
+            if urllib.parse.unquote(key) == 'info_hash':
+                infohashes.append(urllib.parse.unquote_to_bytes(val))
+        return urllib.parse.unquote(name)[1:], infohashes
+
+    def get(self, connection, path, headers):
+        """HTTPHandler getfunc, answering connection once shards reply"""
+        name, infohashes = self.parse(path)
+        ip = connection.get_ip()
+
+        def forward(shard):
+            def answer(ok, result):
+                connection.answer(result if ok else (
+                    500, 'Internal Server Error',
+                    {'Content-Type': 'text/plain'}, result.encode()))
+            self.request(shard, answer, 'get', ip, path, headers)
+
+        if name in INFOPAGE_PATHS and self.config['show_infopage'] and \
+                not self.config['infopage_redirect']:
+            self.gather([(shard, 'rows', (ip,))
+                         for shard in range(len(self.links))],
+                        lambda results: connection.answer(self.infopage(
+                            lambda: merge_rows(results))),
+                        lambda message: forward(0))
+        elif name in SCRAPE_PATHS and (
+                infohashes and self.config['scrape_allowed'] in
+                ('specific', 'full') or
+                self.config['scrape_allowed'] == 'full'):
+            if infohashes:
+                byshard = {}
+                for infohash in infohashes:
+                    byshard.setdefault(self.shard(infohash),
+                                       []).append(infohash)
+                requests = [(shard, 'scrape', (ip, hashes))
+                            for shard, hashes in byshard.items()]
+            else:
+                requests = [(shard, 'scrape', (ip, None))
+                            for shard in range(len(self.links))]
+
+            def scraped(results):
+                ctext = bytearray()
+                bencode.encode({'files': merge_files(results)}, ctext)
+                connection.answer((200, 'OK', {'Content-Type': 'text/plain'},
+                                   ctext))
+
+            self.gather(requests, scraped, lambda message: forward(0))
+        else:
+            # Requests without an infohash are answered alike by any shard
+            forward(self.shard(infohashes[0]) if infohashes else 0)
+        return None
+
+    ### Shard connection handler ###
+
+    def external_connection_made(self, connection):
+        pass
+
+    def connection_flushed(self, connection):
+        pass
+
+    def connection_lost(self, connection):
+        # The tracker cannot answer for the torrents of a lost shard
+        self.rawserver.doneflag.set()
+
+    def data_came_in(self, connection, data):
+        for ok, result in self.readers[connection].feed(data):
+            callback = self.pending[connection].popleft()
+            if callback is not None:
+                callback(ok, result)
+
+
+class ShardUDPHandler(UDPHandler):
+    """UDPHandler forwarding announces and scrapes through a ShardRouter"""
+    def announce(self, socket, addr, tx, infohash, event, paramslist):
+        def reply(ok, result):
+            socket.sendto(announce_reply(tx, *result) if ok
+                          else error_reply(tx, result), addr)
+        router = self.tracker
+        router.request(router.shard(infohash), reply, 'udp_announce',
+                       addr[0], infohash, event, paramslist)
+
+    def scrape(self, socket, addr, tx, infohashes):
+        router = self.tracker
+        byshard = {}
+        for infohash in infohashes:
+            byshard.setdefault(router.shard(infohash), []).append(infohash)
+
+        def scraped(results):
+            stats = {}
+            for hashes, result in zip(byshard.values(), results):
+                stats.update(zip(hashes, result))
+            socket.sendto(scrape_reply(tx, [stats[infohash]
+                                            for infohash in infohashes]),
+                          addr)
+
+        router.gather([(shard, 'udp_scrape', (addr[0], hashes))
+                       for shard, hashes in byshard.items()], scraped,
+                      lambda message: socket.sendto(error_reply(tx, message),
+                                                    addr))
@@ -0,0 +1,117 @@
+"""UDP tracker protocol (BEP 15)
+
+Clients first obtain a connection ID, then announce or scrape with it.
+Connection IDs are not stored: each is a keyed hash of the client address
+and the minute it was issued, and is accepted for that minute and the next.
+Announces and scrapes are answered by the Tracker, as HTTP requests are.
+"""
+
+import os
+import struct
+import hashlib
+from BitTornado.clock import clock
+
+PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+EVENTS = (None, 'completed', 'started', 'stopped')
+
+# Seconds for which a connection ID is issued
+CONNECTION_WINDOW = 60
+# Infohashes that fit in a scrape request of a minimal (576 byte) datagram
+MAX_SCRAPE = 74
+
+HEADER = struct.Struct('>QII')              # connection ID, action, tx
+ANNOUNCE_REQUEST = struct.Struct('>20s20sQqQIIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('>IIIII')
+CONNECT_RESPONSE = struct.Struct('>IIQ')
+REPLY_HEADER = struct.Struct('>II')
+SCRAPE_ENTRY = struct.Struct('>III')
+
+
+def parse_announce(data):
+    """Return the infohash, event and tracker parameters of an announce"""
+    if len(data) < HEADER.size + ANNOUNCE_REQUEST.size:
+        raise ValueError('announce too short')
+    infohash, peerid, _, left, _, event, ip, key, numwant, port = \
+        ANNOUNCE_REQUEST.unpack_from(data, HEADER.size)
+    if event >= len(EVENTS):
+        raise ValueError('invalid event')
+    paramslist = {'peer_id': [peerid], 'port': [str(port)],
+                  'left': [str(left)], 'key': ['{:08X}'.format(key)]}
+    if ip:
+        paramslist['ip'] = ['.'.join(map(str, ip.to_bytes(4, 'big')))]
+    if numwant >= 0:
+        paramslist['numwant'] = [str(numwant)]
+    return infohash, EVENTS[event], paramslist
+
+
+def parse_scrape(data):
+    """Return the infohashes of a scrape"""
+    count = min((len(data) - HEADER.size) // 20, MAX_SCRAPE)
+    return [bytes(data[i:i + 20])
+            for i in range(HEADER.size, HEADER.size + count * 20, 20)]
+
+
+def announce_reply(tx, interval, leechers, seeds, peers):
+    return ANNOUNCE_RESPONSE.pack(ANNOUNCE, tx, interval, leechers,
+                                  seeds) + peers
+
+
+def scrape_reply(tx, stats):
+    reply = bytearray(REPLY_HEADER.pack(SCRAPE, tx))
+    for entry in stats:
+        reply += SCRAPE_ENTRY.pack(*entry)
+    return reply
+
+
+def error_reply(tx, message):
+    return REPLY_HEADER.pack(ERROR, tx) + message.encode()
+
+
+class UDPHandler(object):
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.secret = os.urandom(16)
+
+    def connection_id(self, addr, window):
+        digest = hashlib.blake2b('{}:{}:{}'.format(addr[0], addr[1],
+                                                   window).encode(),
+                                 key=self.secret, digest_size=8)
+        return int.from_bytes(digest.digest(), 'big')
+
+    def check_connection(self, connid, addr):
+        window = int(clock() // CONNECTION_WINDOW)
+        return connid in (self.connection_id(addr, window),
+                          self.connection_id(addr, window - 1))
+
+    def datagram_received(self, socket, data, addr):
+        if len(data) < HEADER.size:
+            return
+        connid, action, tx = HEADER.unpack_from(data)
+        if action == CONNECT:
+            if connid == PROTOCOL_ID:
+                window = int(clock() // CONNECTION_WINDOW)
+                socket.sendto(CONNECT_RESPONSE.pack(
+                    CONNECT, tx, self.connection_id(addr, window)), addr)
+            return
+        if action not in (ANNOUNCE, SCRAPE):
+            return
+        try:
+            if not self.check_connection(connid, addr):
+                raise ValueError('invalid connection id')
+            if action == ANNOUNCE:
+                self.announce(socket, addr, tx, *parse_announce(data))
+            else:
+                self.scrape(socket, addr, tx, parse_scrape(data))
+        except ValueError as e:
+            socket.sendto(error_reply(tx, str(e)), addr)
+
+    def announce(self, socket, addr, tx, infohash, event, paramslist):
+        """Answer an announce; raising ValueError answers with an error"""
+        socket.sendto(announce_reply(tx, *self.tracker.udp_announce(
+            addr[0], infohash, event, paramslist)), addr)
+
+    def scrape(self, socket, addr, tx, infohashes):
+        """Answer a scrape; raising ValueError answers with an error"""
+        socket.sendto(scrape_reply(tx, self.tracker.udp_scrape(
+            addr[0], infohashes)), addr)
@@ -4,26 +4,35 @@ import re
 import time
 import signal
 import random
+import socket
+import functools
 import threading
+import multiprocessing
 import urllib
 from io import StringIO
 from traceback import print_exc
 from binascii import hexlify
-from collections import defaultdict
 
 from .Filter import Filter
+from .PeerStore import PeerStore, Peer, NOCRYPTO, RETURN_CLASSES, \
+    EXPIRY_TICKS
 from .HTTPHandler import HTTPHandler, months
+from .UDPHandler import UDPHandler
+from .Shards import ShardServer, ShardRouter, ShardUDPHandler, \
+    split_state, merge_states
 from .T2T import T2TList
 from .torrentlistparse import HashSet, parsetorrentlist
 from BitTornado.Application.NumberFormats import formatSize
 from BitTornado.Application.parseargs import parseargs, formatDefinitions
 from BitTornado.Application.parsedir import parsedir
 from BitTornado.Client.Announce import HTTPAnnouncer, Response
-from BitTornado.Meta.bencode import bencode, Bencached, BencodedFile
+from BitTornado.Meta.bencode import bencode, bdecode, Bencached, \
+    BencodedFile
 from BitTornado.Network.BTcrypto import CRYPTO_OK
 from BitTornado.Network.NatCheck import NatCheck, CHECK_PEER_ID_ENCRYPTED
 from BitTornado.Network.NetworkAddress import is_valid_ip, to_ipv4, AddrList
 from BitTornado.Network.RawServer import RawServer, autodetect_socket_style
+from BitTornado.Network.AsyncRawServer import AsyncRawServer
 from ..Types import TypedDict, BytesIndexed, Infohash, PeerID, Port, \
     UnsignedInt, IPv4
 from BitTornado.clock import clock
@@ -35,14 +44,21 @@ defaults = [
     ('port', 80, "Port to listen on."),
     ('dfile', None, 'file to store recent downloader info in'),
     ('bind', '', 'comma-separated list of ips/hostnames to bind to locally'),
+    ('udp_port', 0, 'port to answer UDP tracker (BEP 15) requests on '
+     '(0 = none)'),
+    ('shards', 1, 'number of processes to divide torrents among, each '
+     'saving its own dfile (dfile.0, dfile.1, ...) while running'),
     # ('ipv6_enabled', autodetect_ipv6(),
     ('ipv6_enabled', 0, 'allow the client to connect to peers via IPv6'),
     ('ipv6_binds_v4', autodetect_socket_style(),
      'set if an IPv6 server socket will also field IPv4 connections'),
     ('socket_timeout', 15, 'timeout for closing connections'),
+    ('poll_backend', '',
+     "socket event backend: 'poll', 'select', 'selectors' or 'asyncio' "
+     "(blank = best available of poll or select)"),
     ('save_dfile_interval', 5 * 60, 'seconds between saving dfile'),
     ('timeout_downloaders_interval', 45 * 60,
-     'seconds between expiring downloaders'),
+     'seconds without announcing after which downloaders expire'),
     ('reannounce_interval', 30 * 60,
      'seconds downloaders should wait between reannouncements'),
     ('response_size', 50, 'number of peers to send in an info message'),
@@ -264,6 +280,108 @@ def compact_peer_info(ip, port):
         return b''  # not a valid IP, must be a domain name
 
 
+def infopage(config, favicon, rows):
+    """Render the info page of a tracker from a function returning
+    Tracker.infopage_rows"""
+    try:
+        s = StringIO()
+        s.write('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+                '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+                '<html><head><title>BitTorrent download info</title>\n')
+        if favicon:
+            s.write('<link rel="shortcut icon" href="/favicon.ico">\n')
+        s.write('</head>\n<body>\n<h3>BitTorrent download info</h3>\n'
+                '<ul>\n<li><strong>tracker version:</strong> %s</li>\n'
+                '<li><strong>server time:</strong> %s</li>\n'
+                '</ul>\n' % (version, isotime()))
+        show_names = config['allowed_dir'] and config['show_names']
+        names = sorted(rows())
+        if not names:
+            s.write('<p>not tracking any files yet...</p>\n')
+        else:
+            tn = 0
+            tc = 0
+            td = 0
+            tt = 0  # Total transferred
+            ts = 0  # Total size
+            nf = 0  # Number of files displayed
+            if show_names:
+                s.write('<table summary="files" border="1">\n'
+                        '<tr><th>info hash</th><th>torrent name</th>'
+                        '<th align="right">size</th><th align="right">'
+                        'complete</th><th align="right">downloading</th>'
+                        '<th align="right">downloaded</th>'
+                        '<th align="right">transferred</th></tr>\n')
+            else:
+                s.write('<table summary="files">\n'
+                        '<tr><th>info hash</th><th align="right">complete'
+                        '</th><th align="right">downloading</th>'
+                        '<th align="right">downloaded</th></tr>\n')
+            for name, infohash, sz, c, d, n in names:
+                tn = tn + n
+                tc = tc + c
+                td = td + d
+                if show_names:
+                    nf = nf + 1
+                    ts = ts + sz
+                    szt = sz * n   # Transferred for this torrent
+                    tt = tt + szt
+                    if config['allow_get'] == 1:
+                        linkname = '<a href="/file?info_hash=' + \
+                            urllib.parse.quote(infohash) + '">' + \
+                            name + '</a>'
+                    else:
+                        linkname = name
+                    s.write('<tr><td><code>%s</code></td><td>%s</td>'
+                            '<td align="right">%s</td>'
+                            '<td align="right">%i</td>'
+                            '<td align="right">%i</td>'
+                            '<td align="right">%i</td>'
+                            '<td align="right">%s</td></tr>\n' %
+                            (hexlify(infohash).decode(), linkname,
+                             formatSize(sz), c, d, n, formatSize(szt)))
+                else:
+                    s.write('<tr><td><code>%s</code></td>'
+                            '<td align="right"><code>%i</code></td>'
+                            '<td align="right"><code>%i</code></td>'
+                            '<td align="right"><code>%i</code></td>'
+                            '</tr>\n' % (hexlify(infohash).decode(), c, d,
+                                         n))
+            if show_names:
+                s.write('<tr><td align="right" colspan="2">%i files</td>'
+                        '<td align="right">%s</td><td align="right">%i'
+                        '</td><td align="right">%i</td><td align="right">'
+                        '%i</td><td align="right">%s</td></tr>\n' %
+                        (nf, formatSize(ts), tc, td, tn, formatSize(tt)))
+            else:
+                s.write('<tr><td align="right">%i files</td>'
+                        '<td align="right">%i</td><td align="right">%i'
+                        '</td><td align="right">%i</td></tr>\n' %
+                        (nf, tc, td, tn))
+            s.write('</table>\n<ul>\n'
+                    '<li><em>info hash:</em> SHA1 hash of the "info" '
+                    'section of the metainfo (*.torrent)</li>\n'
+                    '<li><em>complete:</em> number of connected clients '
+                    'with the complete file</li>\n'
+                    '<li><em>downloading:</em> number of connected clients'
+                    ' still downloading</li>\n'
+                    '<li><em>downloaded:</em> reported complete downloads'
+                    '</li>\n'
+                    '<li><em>transferred:</em> torrent size * total '
+                    'downloaded (does not include partial '
+                    'transfers)</li>\n</ul>\n')
+
+        s.write('</body>\n</html>\n')
+        return (200, 'OK',
+                {'Content-Type': 'text/html; charset=iso-8859-1'},
+                s.getvalue().encode())
+    except Exception:
+        print_exc()
+        return (500, 'Internal Server Error',
+                {'Content-Type': 'text/html; charset=iso-8859-1'},
+                b'Server Error')
+
+
 class Tracker(object):
     def __init__(self, config, rawserver):
         self.config = config
@@ -282,11 +400,7 @@ class Tracker(object):
                       "exist." % favicon)
 
         self.rawserver = rawserver  # RawServer
-        self.cached = {}    # format: infohash: [[time1, l1, s1], ...]
-        self.cached_t = {}  # format: infohash: [time, cache]
-        self.times = {}
         self.state = TrackerState()
-        self.seedcount = {}
 
         self.allowed_IPs = None
         self.banned_IPs = None
@@ -311,40 +425,32 @@ class Tracker(object):
             except (IOError, ValueError, TypeError):
                 print('**warning** statefile ' + self.dfile +
                       ' corrupt; resetting')
-        self.downloads = self.state.setdefault('peers', {})
+        # Peers expire after timeout_downloaders_interval seconds without
+        # announcing, checked in EXPIRY_TICKS steps
+        self.timeout_downloaders_interval = config[
+            'timeout_downloaders_interval']
+        self.expiry_tick = self.timeout_downloaders_interval / EXPIRY_TICKS
+        self.downloads = PeerStore(self.expiry_tick)
         self.completed = self.state.setdefault('completed', {})
 
-        self.becache = defaultdict(
-            lambda: [({}, {})
-                     for _ in range(3 if config['compact_reqd'] else 5)])
-        ''' format: infohash: [[l0, s0], [l1, s1], ...]
-                l0,s0 = compact, not requirecrypto=1
-                l1,s1 = compact, only supportcrypto=1
-                l2,s2 = [compact, crypto_flag], all peers
-            if --compact_reqd 0:
-                l3,s3 = [ip,port,id]
-                l4,l4 = [ip,port] nopeerid
-        '''
-        for infohash, peers in self.downloads.items():
-            self.seedcount[infohash] = 0
-            for peerid, peer in list(peers.items()):
-                ip = peer['ip']
+        now = clock()
+        for infohash, peers in self.state.pop('peers', {}).items():
+            self.downloads.swarm(infohash)
+            for peerid, info in peers.items():
+                ip = info['ip']
                 if self.allowed_IPs and ip not in self.allowed_IPs \
                         or self.banned_IPs and ip in self.banned_IPs:
-                    del peers[peerid]
                     continue
-                if not peer['left']:
-                    self.seedcount[infohash] += 1
-                if peer.get('nat', -1):
+                peer = Peer.from_state(info)
+                peer.time = now
+                self.downloads.add(infohash, peerid, peer)
+                if peer.nat != 0:
                     continue
-                gip = peer.get('given_ip')
+                gip = peer.given_ip
                 if is_valid_ip(gip) and (not self.only_local_override_ip or
                                          ip in local_IPs):
                     ip = gip
-                self.natcheckOK(infohash, peerid, ip, peer['port'], peer)
-
-        self.times = {dl: {sub: 0 for sub in subs}
-                      for dl, subs in self.downloads.items()}
+                self.natcheckOK(infohash, peerid, ip, peer.port, peer)
 
         self.trackerid = createPeerID(b'-T-')
         random.seed(self.trackerid)
@@ -354,10 +460,7 @@ class Tracker(object):
         self.show_names = config['show_names']
         rawserver.add_task(self.save_state, self.save_dfile_interval)
         self.prevtime = clock()
-        self.timeout_downloaders_interval = config[
-            'timeout_downloaders_interval']
-        rawserver.add_task(self.expire_downloaders,
-                           self.timeout_downloaders_interval)
+        rawserver.add_task(self.expire_downloaders, self.expiry_tick)
         self.logfile = None
         self.log = None
         if config['logfile'] and config['logfile'] != '-':
@@ -443,6 +546,8 @@ class Tracker(object):
         self.dedicated_seed_id = config['dedicated_seed_id']
         self.is_seeded = {}
 
+        # Pre-encoded compact response fragments, by infohash
+        self.fragments = {}
         self.cachetime = 0
         self.cachetimeupdate()
 
@@ -456,130 +561,40 @@ class Tracker(object):
                          daemon=False).start()
 
     def get_infopage(self):
-        try:
-            if not self.config['show_infopage']:
-                return (404, 'Not Found', {'Content-Type': 'text/plain',
-                                           'Pragma': 'no-cache'}, alas)
-            red = self.config['infopage_redirect']
-            if red:
-                return (302, 'Found', {'Content-Type': 'text/html',
-                                       'Location': red},
-                        '<A HREF="{}">Click Here</A>'.format(red).encode())
-
-            s = StringIO()
-            s.write('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
-                    '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
-                    '<html><head><title>BitTorrent download info</title>\n')
-            if self.favicon is not None:
-                s.write('<link rel="shortcut icon" href="/favicon.ico">\n')
-            s.write('</head>\n<body>\n<h3>BitTorrent download info</h3>\n'
-                    '<ul>\n<li><strong>tracker version:</strong> %s</li>\n'
-                    '<li><strong>server time:</strong> %s</li>\n'
-                    '</ul>\n' % (version, isotime()))
-            if self.config['allowed_dir']:
-                if self.show_names:
-                    names = [(self.allowed[infohash]['name'], infohash)
-                             for infohash in self.allowed]
-                else:
-                    names = [(None, infohash) for infohash in self.allowed]
-            else:
-                names = [(None, infohash) for infohash in self.downloads]
-            if not names:
-                s.write('<p>not tracking any files yet...</p>\n')
-            else:
-                names.sort()
-                tn = 0
-                tc = 0
-                td = 0
-                tt = 0  # Total transferred
-                ts = 0  # Total size
-                nf = 0  # Number of files displayed
-                if self.config['allowed_dir'] and self.show_names:
-                    s.write('<table summary="files" border="1">\n'
-                            '<tr><th>info hash</th><th>torrent name</th>'
-                            '<th align="right">size</th><th align="right">'
-                            'complete</th><th align="right">downloading</th>'
-                            '<th align="right">downloaded</th>'
-                            '<th align="right">transferred</th></tr>\n')
-                else:
-                    s.write('<table summary="files">\n'
-                            '<tr><th>info hash</th><th align="right">complete'
-                            '</th><th align="right">downloading</th>'
-                            '<th align="right">downloaded</th></tr>\n')
-                for name, infohash in names:
-                    l = self.downloads[infohash]
-                    n = self.completed.get(infohash, 0)
-                    tn = tn + n
-                    c = self.seedcount[infohash]
-                    tc = tc + c
-                    d = len(l) - c
-                    td = td + d
-                    if self.config['allowed_dir'] and self.show_names:
-                        if infohash in self.allowed:
-                            nf = nf + 1
-                            sz = self.allowed[infohash]['length']  # size
-                            ts = ts + sz
-                            szt = sz * n   # Transferred for this torrent
-                            tt = tt + szt
-                            if self.allow_get == 1:
-                                linkname = '<a href="/file?info_hash=' + \
-                                    urllib.parse.quote(infohash) + '">' + \
-                                    name + '</a>'
-                            else:
-                                linkname = name
-                            s.write('<tr><td><code>%s</code></td><td>%s</td>'
-                                    '<td align="right">%s</td>'
-                                    '<td align="right">%i</td>'
-                                    '<td align="right">%i</td>'
-                                    '<td align="right">%i</td>'
-                                    '<td align="right">%s</td></tr>\n' %
-                                    (hexlify(infohash).decode(), linkname,
-                                     formatSize(sz), c, d, n, formatSize(szt)))
-                    else:
-                        s.write('<tr><td><code>%s</code></td>'
-                                '<td align="right"><code>%i</code></td>'
-                                '<td align="right"><code>%i</code></td>'
-                                '<td align="right"><code>%i</code></td>'
-                                '</tr>\n' % (hexlify(infohash).decode(), c, d,
-                                             n))
-                if self.config['allowed_dir'] and self.show_names:
-                    s.write('<tr><td align="right" colspan="2">%i files</td>'
-                            '<td align="right">%s</td><td align="right">%i'
-                            '</td><td align="right">%i</td><td align="right">'
-                            '%i</td><td align="right">%s</td></tr>\n' %
-                            (nf, formatSize(ts), tc, td, tn, formatSize(tt)))
-                else:
-                    s.write('<tr><td align="right">%i files</td>'
-                            '<td align="right">%i</td><td align="right">%i'
-                            '</td><td align="right">%i</td></tr>\n' %
-                            (nf, tc, td, tn))
-                s.write('</table>\n<ul>\n'
-                        '<li><em>info hash:</em> SHA1 hash of the "info" '
-                        'section of the metainfo (*.torrent)</li>\n'
-                        '<li><em>complete:</em> number of connected clients '
-                        'with the complete file</li>\n'
-                        '<li><em>downloading:</em> number of connected clients'
-                        ' still downloading</li>\n'
-                        '<li><em>downloaded:</em> reported complete downloads'
-                        '</li>\n'
-                        '<li><em>transferred:</em> torrent size * total '
-                        'downloaded (does not include partial '
-                        'transfers)</li>\n</ul>\n')
-
-            s.write('</body>\n</html>\n')
-            return (200, 'OK',
-                    {'Content-Type': 'text/html; charset=iso-8859-1'},
-                    s.getvalue().encode())
-        except Exception:
-            print_exc()
-            return (500, 'Internal Server Error',
-                    {'Content-Type': 'text/html; charset=iso-8859-1'},
-                    b'Server Error')
+        if not self.config['show_infopage']:
+            return (404, 'Not Found', {'Content-Type': 'text/plain',
+                                       'Pragma': 'no-cache'}, alas)
+        red = self.config['infopage_redirect']
+        if red:
+            return (302, 'Found', {'Content-Type': 'text/html',
+                                   'Location': red},
+                    '<A HREF="{}">Click Here</A>'.format(red).encode())
+        return infopage(self.config, self.favicon is not None,
+                        self.infopage_rows)
+
+    def infopage_rows(self):
+        """Return (name, infohash, size, complete, downloading, downloaded)
+        of each torrent on the info page, with names and sizes only when
+        shown"""
+        if self.config['allowed_dir'] and self.show_names:
+            return [(info['name'], infohash, info['length'],
+                     self.downloads[infohash].seeds,
+                     len(self.downloads[infohash]) -
+                     self.downloads[infohash].seeds,
+                     self.completed.get(infohash, 0))
+                    for infohash, info in self.allowed.items()]
+        infohashes = self.allowed if self.config['allowed_dir'] \
+            else self.downloads
+        return [(None, infohash, 0, self.downloads[infohash].seeds,
+                 len(self.downloads[infohash]) -
+                 self.downloads[infohash].seeds,
+                 self.completed.get(infohash, 0))
+                for infohash in infohashes]
 
     def scrapedata(self, infohash, return_name=True):
         l = self.downloads[infohash]
         n = self.completed.get(infohash, 0)
-        c = self.seedcount[infohash]
+        c = l.seeds
         d = len(l) - c
         f = {'complete': c, 'incomplete': d, 'downloaded': n}
         if return_name and self.show_names and self.config['allowed_dir']:
@@ -587,34 +602,44 @@ class Tracker(object):
         return f
 
     def get_scrape(self, paramslist):
-        fs = {}
         if 'info_hash' in paramslist:
             if self.config['scrape_allowed'] not in ['specific', 'full']:
                 return (400, 'Not Authorized', {'Content-Type': 'text/plain',
                                                 'Pragma': 'no-cache'},
                         bencode({'failure reason': 'specific scrape function '
                                  'is not available with this tracker.'}))
-            for infohash in paramslist['info_hash']:
-                if self.allowed is not None:
-                    if infohash in self.allowed:
-                        fs[infohash] = self.scrapedata(infohash)
-                elif infohash in self.downloads:
-                    fs[infohash] = self.scrapedata(infohash)
+            fs = self.scrape_files(paramslist['info_hash'])
         else:
             if self.config['scrape_allowed'] != 'full':
                 return (400, 'Not Authorized', {'Content-Type': 'text/plain',
                                                 'Pragma': 'no-cache'},
                         bencode({'failure reason': 'full scrape function is '
                                  'not available with this tracker.'}))
+            fs = self.scrape_files()
+
+        ctext = bytearray()
+        bencode.encode({'files': fs}, ctext)
+        return (200, 'OK', {'Content-Type': 'text/plain'}, ctext)
+
+    def scrape_files(self, infohashes=None):
+        """Return the scrape data of known torrents among infohashes, or of
+        every torrent"""
+        fs = {}
+        if infohashes is not None:
+            for infohash in infohashes:
+                if self.allowed is not None:
+                    if infohash in self.allowed:
+                        fs[infohash] = self.scrapedata(infohash)
+                elif infohash in self.downloads:
+                    fs[infohash] = self.scrapedata(infohash)
+        else:
             if self.allowed is not None:
                 keys = self.allowed.keys()
             else:
                 keys = self.downloads.keys()
             for infohash in keys:
                 fs[infohash] = self.scrapedata(infohash)
-
-        return (200, 'OK', {'Content-Type': 'text/plain'},
-                bencode({'files': fs}))
+        return fs
 
     def get_file(self, infohash):
         if not self.allow_get:
@@ -673,10 +698,8 @@ class Tracker(object):
         return None
 
     def add_data(self, infohash, event, ip, paramslist):
-        peers = self.downloads.setdefault(infohash, {})
-        ts = self.times.setdefault(infohash, {})
+        swarm = self.downloads.swarm(infohash)
         self.completed.setdefault(infohash, 0)
-        self.seedcount.setdefault(infohash, 0)
 
         def params(key, default=None, l=paramslist):
             if key in l:
@@ -701,14 +724,16 @@ class Tracker(object):
         seeding = left == 0
         # uploaded = long(params('uploaded',''))
         # downloaded = long(params('downloaded',''))
-        supportcrypto = int(bool(params('supportcrypto')))
-        requirecrypto = supportcrypto and int(bool(params('requirecrypto')))
+        supportcrypto = int(params('supportcrypto', '0') not in ('', '0'))
+        requirecrypto = supportcrypto and \
+            int(params('requirecrypto', '0') not in ('', '0'))
 
-        peer = peers.get(peerid)
+        peer = swarm.get(peerid)
         islocal = ip in local_IPs
         mykey = params('key')
         if peer:
-            auth = peer.get('key', -1) == mykey or peer.get('ip') == ip
+            auth = peer.key is not None and peer.key == mykey or \
+                peer.ip == ip
 
         gip = params('ip')
         override = is_valid_ip(gip) and (islocal or
@@ -724,74 +749,55 @@ class Tracker(object):
             return rsize
 
         if peer is None:
-            ts[peerid] = clock()
-            peer = {'ip': ip, 'port': port, 'left': left,
-                    'supportcrypto': supportcrypto,
-                    'requirecrypto': requirecrypto}
-            if mykey:
-                peer['key'] = mykey
-            if gip:
-                peer['given ip'] = gip
+            peer = Peer(ip, port, left, supportcrypto, requirecrypto,
+                        mykey or None, gip or None, time=clock())
+            self.downloads.add(infohash, peerid, peer)
             if port:
                 if self.natcheck == 0 or islocal:
-                    peer['nat'] = 0
+                    peer.nat = 0
                     self.natcheckOK(infohash, peerid, real_ip, port, peer)
                 else:
                     NatCheck(self.connectback_result, infohash, peerid,
                              real_ip, port, self.rawserver,
                              encrypted=requirecrypto)
             else:
-                peer['nat'] = 2 ** 30
+                peer.nat = 2 ** 30
 
             self.completed[infohash] += event == 'completed'
-            self.seedcount[infohash] += seeding
-
-            peers[peerid] = peer
             return rsize
 
         if not auth:
             return rsize    # return w/o changing stats
 
-        ts[peerid] = clock()
-        if seeding != (not peer['left']):  # Changing seeding state
-            update = 1 if seeding else -1  # +1 if seeding, -1 if unseeding
-            self.completed[infohash] += update
-            self.seedcount[infohash] += update
-            if not peer.get('nat', -1):
-                # Swap seeding state in the cache
-                for bc in self.becache[infohash]:
-                    old_cache = bc[not seeding]
-                    if peerid in old_cache:
-                        bc[seeding][peerid] = old_cache.pop(peerid)
-        peer['left'] = left
+        self.downloads.touch(infohash, peerid, peer, clock())
+        if seeding != (not peer.left):  # Changing seeding state
+            self.completed[infohash] += 1 if seeding else -1
+        # Moves a listed peer between leechers and seeds
+        swarm.set_left(peerid, peer, left)
 
         if port == 0:
             return rsize
 
         recheck = False
-        if ip != peer['ip']:
-            peer['ip'] = ip
+        if ip != peer.ip:
+            peer.ip = ip
             recheck = True
-        if gip != peer.get('given ip'):
-            if gip:
-                peer['given ip'] = gip
-            elif 'given ip' in peer:
-                del peer['given ip']
+        if (gip or None) != peer.given_ip:
+            peer.given_ip = gip or None
             recheck = True
 
-        natted = peer.get('nat', -1)
+        natted = -1 if peer.nat is None else peer.nat
         if recheck:
             if natted == 0:
-                for x in self.becache[infohash]:
-                    x[seeding].pop(peerid, None)
+                swarm.unlist(peerid, peer)
             if natted >= 0:
-                del peer['nat']     # restart NAT testing
+                peer.nat = None     # restart NAT testing
         if natted and natted < self.natcheck:
             recheck = True
 
         if recheck:
             if not self.natcheck or islocal:
-                peer['nat'] = 0
+                peer.nat = 0
                 self.natcheckOK(infohash, peerid, real_ip, port, peer)
             else:
                 NatCheck(self.connectback_result, infohash, peerid, real_ip,
@@ -807,9 +813,9 @@ class Tracker(object):
         # even when compact response is requested
         compact = tracker or return_type < 3
         data = CompactResponse() if compact else Response()
-        seeds = self.seedcount[infohash]
-        data['complete'] = seeds
-        data['incomplete'] = len(self.downloads[infohash]) - seeds
+        swarm = self.downloads[infohash]
+        data['complete'] = swarm.seeds
+        data['incomplete'] = len(swarm) - swarm.seeds
 
         if self.config['allowed_controls'] and \
                 'warning message' in self.allowed[infohash]:
@@ -819,18 +825,8 @@ class Tracker(object):
             data['interval'] = self.config['multitracker_reannounce_interval']
             if not rsize:
                 return data
-            cache = self.cached_t.setdefault(infohash, None)
-            if not cache or len(cache[1]) < rsize or cache[0] + \
-                    self.config['min_time_between_cache_refreshes'] < clock():
-                bc = self.becache[infohash]
-                cache = [clock(),
-                         list(bc[0][0].values()) + list(bc[0][1].values())]
-                self.cached_t[infohash] = cache
-                random.shuffle(cache[1])
-                cache = cache[1]
-
-            data['peers'] = cache[-rsize:]
-            del cache[-rsize:]
+            data['peers'] = swarm.compact(
+                swarm.select(NOCRYPTO, False, rsize))[0]
             return data
 
         data['interval'] = self.reannounce_interval
@@ -838,92 +834,154 @@ class Tracker(object):
             data['peers'] = []
             return data
 
-        bc = self.becache[infohash]
-        len_l = len(bc[2][0])
-        len_s = len(bc[2][1])
-        if not len_l + len_s:   # caches are empty!
-            data['peers'] = []
-            return data
-        l_get_size = int(float(rsize) * (len_l) / (len_l + len_s))
-        cache = self.cached.setdefault(infohash,
-                                       [None, None, None])[return_type]
-        if cache and \
-                (not cache[1] or is_seed and len(cache[1]) < rsize or
-                 len(cache[1]) < l_get_size or
-                 cache[0] + self.config['min_time_between_cache_refreshes'] <
-                 self.cachetime):
-            cache = None
-        if cache is None:
-            peers = self.downloads[infohash]
-            if self.config['compact_reqd']:
-                vv = ([], [], [])
-            else:
-                vv = ([], [], [], [], [])
-            # empty if disabled
-            for key, ip, port in self.t2tlist.harvest(infohash):
-                if key not in peers:
-                    cp = compact_peer_info(ip, port)
-                    vv[0].append(cp)
-                    vv[2].append((cp, b'\x00'))
-                    if not self.config['compact_reqd']:
-                        vv[3].append({'ip': ip, 'port': port, 'peer id': key})
-                        vv[4].append({'ip': ip, 'port': port})
-            cache = [self.cachetime,
-                     list(bc[return_type][0].values()) + vv[return_type],
-                     list(bc[return_type][1].values())]
-            random.shuffle(cache[1])
-            random.shuffle(cache[2])
-            self.cached[infohash][return_type] = cache
-            for rr, cached in enumerate(self.cached[infohash]):
-                if rr != return_type:
-                    try:
-                        cached[1].extend(vv[rr])
-                    except (IndexError, TypeError, AttributeError):
-                        pass
-        if len(cache[1]) < l_get_size:
-            peerdata = cache[1]
-            if not is_seed:
-                peerdata.extend(cache[2])
-            cache[1] = []
-            cache[2] = []
-        else:
-            if not is_seed:
-                peerdata = cache[2][l_get_size - rsize:]
-                del cache[2][l_get_size - rsize:]
-                rsize -= len(peerdata)
-            else:
-                peerdata = []
-            if rsize:
-                peerdata.extend(cache[1][-rsize:])
-                del cache[1][-rsize:]
-        if return_type == 0:
-            data['peers'] = b''.join(peerdata)
-        elif return_type == 1:
-            data['crypto_flags'] = b'\x01' * len(peerdata)
-            data['peers'] = b''.join(peerdata)
-        elif return_type == 2:
-            data['crypto_flags'] = bytes(p[1] for p in peerdata)
-            data['peers'] = b''.join(p[0] for p in peerdata)
+        self.harvest(infohash, swarm)
+        picks = swarm.select(RETURN_CLASSES[return_type], is_seed, rsize,
+                             unpacked=return_type >= 3)
+        if return_type < 3:
+            peers, crypto_flags = swarm.compact(picks)
+            if return_type == 1:
+                data['crypto_flags'] = b'\x01' * len(crypto_flags)
+            elif return_type == 2:
+                data['crypto_flags'] = crypto_flags
+            data['peers'] = peers
         else:
-            data['peers'] = peerdata
+            data['peers'] = swarm.expand(picks, peer_id=return_type == 3)
         return data
 
-    def get(self, connection, path, headers):
-        # Returns (int, str, {str: str}, bytes) or None
-        real_ip = connection.get_ip()
-        ip = real_ip
+    def response_fragments(self, infohash, swarm):
+        """Return the pre-encoded parts of compact announce responses for a
+        torrent that precede the crypto flags, precede the peers and follow
+        them
+
+        Fragments are kept until the numbers of seeds and leechers change,
+        or for min_time_between_cache_refreshes."""
+        seeds = swarm.seeds
+        leechers = len(swarm) - seeds
+        cached = self.fragments.get(infohash)
+        if cached is not None and cached[1:3] == (seeds, leechers) and \
+                cached[0] + self.config['min_time_between_cache_refreshes'] \
+                >= self.cachetime:
+            return cached[3:]
+        head = Bencached(b'd8:completei%de' % seeds)
+        middle = Bencached(b'10:incompletei%de8:intervali%de' %
+                           (leechers, self.reannounce_interval))
+        tail = bytearray()
+        if self.config['allowed_controls'] and \
+                'warning message' in self.allowed[infohash]:
+            bencode.encode('warning message', tail)
+            bencode.encode(self.allowed[infohash]['warning message'], tail)
+        tail = Bencached(bytes(tail))
+        self.fragments[infohash] = (self.cachetime, seeds, leechers, head,
+                                    middle, tail)
+        return head, middle, tail
+
+    def compact_response(self, infohash, stopped, is_seed, return_type,
+                         rsize, extras):
+        """Encode a compact announce response, as peerlist and get would,
+        from cached fragments and the compact addresses of chosen peers
+
+        extras holds any response keys that sort between peers and
+        warning message."""
+        swarm = self.downloads[infohash]
+        head, middle, tail = self.response_fragments(infohash, swarm)
+        ctext = bytearray(head.bencoded)
+        if stopped or not rsize:     # save some bandwidth
+            peers = b''
+        else:
+            peers, crypto_flags = self.compact_peers(infohash, swarm, is_seed,
+                                                     return_type, rsize)
+            if return_type:
+                ctext += b'12:crypto_flags%d:' % len(crypto_flags)
+                ctext += crypto_flags
+        ctext += middle.bencoded
+        ctext += b'5:peers%d:' % len(peers)
+        ctext += peers
+        for key in sorted(extras):
+            bencode.encode(key, ctext)
+            bencode.encode(extras[key], ctext)
+        ctext += tail.bencoded
+        ctext += b'e'
+        return ctext
+
+    def harvest(self, infohash, swarm):
+        """Offer the peers other trackers reported for a torrent since its
+        last announce, in place of those offered before"""
+        # empty if disabled
+        harvest = self.t2tlist.harvest(infohash)
+        if harvest or swarm.harvested or swarm.harvested_unpacked:
+            swarm.set_harvested(harvest, compact_peer_info)
+
+    def compact_peers(self, infohash, swarm, is_seed, return_type, rsize):
+        """Choose up to rsize peers for a compact response, returning their
+        addresses and crypto flags"""
+        self.harvest(infohash, swarm)
+        peers, crypto_flags = swarm.compact(swarm.select(
+            RETURN_CLASSES[return_type], is_seed, rsize))
+        if return_type == 1:
+            crypto_flags = b'\x01' * len(crypto_flags)
+        return peers, crypto_flags
+
+    def check_ip(self, ip):
+        """Convert an address to IPv4 where possible, returning it and
+        whether it is IPv4, or raise ValueError if it may not use the
+        tracker"""
         try:
             ip = to_ipv4(ip)
             ipv4 = True
         except ValueError:
             ipv4 = False
-
         if self.allowed_IPs and ip not in self.allowed_IPs or \
                 self.banned_IPs and ip in self.banned_IPs:
+            raise ValueError('your IP is not allowed on this tracker')
+        return ip, ipv4
+
+    def udp_announce(self, ip, infohash, event, paramslist):
+        """Announce a peer for the UDP tracker
+
+        Returns the interval, numbers of leechers and seeds, and compact
+        addresses of other peers; raises ValueError with the reason an
+        announce is refused."""
+        ip, ipv4 = self.check_ip(ip)
+        notallowed = self.check_allowed(infohash, paramslist)
+        if notallowed:
+            raise ValueError(bdecode(notallowed[3])['failure reason'])
+        rsize = self.add_data(infohash, event, ip, paramslist)
+        swarm = self.downloads[infohash]
+        peers = b''
+        if rsize and event != 'stopped' and not self.is_aggregator and ipv4:
+            peers = self.compact_peers(infohash, swarm,
+                                       not int(paramslist['left'][0]), 0,
+                                       rsize)[0]
+        return (self.reannounce_interval, len(swarm) - swarm.seeds,
+                swarm.seeds, peers)
+
+    def udp_scrape(self, ip, infohashes):
+        """Return the numbers of seeds, completed downloads and leechers of
+        torrents for the UDP tracker, zeros for unknown torrents"""
+        self.check_ip(ip)
+        if self.config['scrape_allowed'] not in ('specific', 'full'):
+            raise ValueError('specific scrape function is not available '
+                             'with this tracker.')
+        stats = []
+        for infohash in infohashes:
+            if infohash in self.downloads and (
+                    self.allowed is None or infohash in self.allowed):
+                f = self.scrapedata(infohash, False)
+                stats.append((f['complete'], f['downloaded'],
+                              f['incomplete']))
+            else:
+                stats.append((0, 0, 0))
+        return stats
+
+    def get(self, connection, path, headers):
+        # Returns (int, str, {str: str}, bytes) or None
+        real_ip = connection.get_ip()
+        try:
+            ip, ipv4 = self.check_ip(real_ip)
+        except ValueError as e:
             return (400, 'Not Authorized', {'Content-Type': 'text/plain',
                                             'Pragma': 'no-cache'},
-                    bencode({'failure reason':
-                             'your IP is not allowed on this tracker'}))
+                    bencode({'failure reason': str(e)}))
 
         nip = get_forwarded_ip(headers)
         if nip and not self.only_local_override_ip:
@@ -1022,40 +1080,37 @@ class Tracker(object):
         else:
             return_type = 3
 
-        data = self.peerlist(infohash, event == 'stopped',
-                             params('tracker'), not int(params('left', 1)),
-                             return_type, rsize,
-                             int(params('supportcrypto', 0)))
-
+        extras = {}
         if 'scrape' in paramslist:    # deprecated
-            data['scrape'] = self.scrapedata(infohash, False)
+            extras['scrape'] = self.scrapedata(infohash, False)
 
         if self.dedicated_seed_id:
             if params('seed_id') == self.dedicated_seed_id and \
                     int(params('left', 1)) == 0:
                 self.is_seeded[infohash] = True
             if int(params('check_seeded', 0)) and self.is_seeded.get(infohash):
-                data['seeded'] = 1
+                extras['seeded'] = 1
 
+        if return_type < 3 and not params('tracker'):
+            ctext = self.compact_response(infohash, event == 'stopped',
+                                          not int(params('left', 1)),
+                                          return_type, rsize, extras)
+        else:
+            data = self.peerlist(infohash, event == 'stopped',
+                                 params('tracker'), not int(params('left', 1)),
+                                 return_type, rsize,
+                                 int(params('supportcrypto', 0)))
+            data.update(extras)
+            ctext = bytearray()
+            bencode.encode(data, ctext)
         return (200, 'OK', {'Content-Type': 'text/plain',
-                            'Pragma': 'no-cache'},
-                bencode(data))
+                            'Pragma': 'no-cache'}, ctext)
 
     def natcheckOK(self, infohash, peerid, ip, port, peer):
-        seed = not peer['left']
-        bc = self.becache[infohash]
-        cp = compact_peer_info(ip, port)
-        reqc = peer['requirecrypto']
-        bc[2][seed][peerid] = (cp, reqc)
-        if peer['supportcrypto']:
-            bc[1][seed][peerid] = cp
-        if not reqc:
-            bc[0][seed][peerid] = cp
-            if not self.config['compact_reqd']:
-                bc[3][seed][peerid] = Bencached(
-                    bencode({'ip': ip, 'port': port, 'peer id': peerid}))
-                bc[4][seed][peerid] = Bencached(
-                    bencode({'ip': ip, 'port': port}))
+        # Addresses with no compact form are listed for non-compact
+        # responses only
+        self.downloads[infohash].list(
+            peerid, peer, compact_peer_info(ip, port) or (ip, port))
 
     def natchecklog(self, peerid, ip, port, result):
         year, month, day, hour, minute, second = time.localtime()[:6]
@@ -1064,9 +1119,10 @@ class Tracker(object):
                          year, hour, minute, second, ip, port, result))
 
     def connectback_result(self, result, downloadid, peerid, ip, port):
-        record = self.downloads.get(downloadid, {}).get(peerid)
-        if record is None or record['port'] != port or \
-                record['ip'] != ip and record.get('given ip') != ip:
+        swarm = self.downloads.get(downloadid)
+        record = swarm.get(peerid) if swarm is not None else None
+        if record is None or record.port != port or \
+                record.ip != ip and record.given_ip != ip:
             if self.config['log_nat_checks']:
                 self.natchecklog(peerid, ip, port, 404)
             return
@@ -1076,15 +1132,15 @@ class Tracker(object):
             else:
                 x = 503
             self.natchecklog(peerid, ip, port, x)
-        if 'nat' not in record:
-            record['nat'] = int(not result)
+        if record.nat is None:
+            record.nat = int(not result)
             if result:
                 self.natcheckOK(downloadid, peerid, ip, port, record)
-        elif result and record['nat']:
-            record['nat'] = 0
+        elif result and record.nat:
+            record.nat = 0
             self.natcheckOK(downloadid, peerid, ip, port, record)
         elif not result:
-            record['nat'] += 1
+            record.nat += 1
 
     def remove_from_state(self, *keys):
         for key in keys:
@@ -1092,7 +1148,11 @@ class Tracker(object):
 
     def save_state(self):
         self.rawserver.add_task(self.save_state, self.save_dfile_interval)
-        self.state.write(self.dfile)
+        # Peers are kept in the peer store and only recorded on saving
+        ctext = bytearray()
+        bencode.encode(dict(self.state, peers=self.downloads.state()), ctext)
+        with open(self.dfile, 'wb') as handle:
+            handle.write(ctext)
 
     def parse_allowed(self):
         self.rawserver.add_task(self.parse_allowed, self.parse_dir_interval)
@@ -1130,9 +1190,8 @@ class Tracker(object):
             self.allowed_list_mtime = os.path.getmtime(f)
 
         for infohash in added:
-            self.downloads.setdefault(infohash, {})
+            self.downloads.swarm(infohash)
             self.completed.setdefault(infohash, 0)
-            self.seedcount.setdefault(infohash, 0)
 
     def read_ip_lists(self):
         self.rawserver.add_task(self.read_ip_lists, self.parse_dir_interval)
@@ -1156,32 +1215,124 @@ class Tracker(object):
                 print('**warning** unable to read banned_IP list')
 
     def delete_peer(self, infohash, peerid):
-        dls = self.downloads[infohash]
-        peer = dls[peerid]
-        seeding = not peer['left']
-        if seeding:
-            self.seedcount[infohash] -= 1
-        if not peer.get('nat', -1):
-            for x in self.becache[infohash]:
-                x[seeding].pop(peerid, None)
-        del self.times[infohash][peerid]
-        del dls[peerid]
+        self.downloads.remove(infohash, peerid)
 
     def expire_downloaders(self):
-        for infohash, peertimes in self.times.items():
-            for peerid, t in list(peertimes.items()):
-                if t < self.prevtime:
-                    self.delete_peer(infohash, peerid)
-        self.prevtime = clock()
+        self.rawserver.add_task(self.expire_downloaders, self.expiry_tick)
+        now = clock()
+        self.downloads.expire(now - self.timeout_downloaders_interval)
+        # Dead torrents are only looked for once per expiry period
+        if now - self.prevtime < self.timeout_downloaders_interval:
+            return
+        self.prevtime = now
         if not self.keep_dead:
-            for infohash, peers in list(self.downloads.items()):
-                if len(peers) == 0 and (self.allowed is None or
+            for infohash, swarm in list(self.downloads.items()):
+                if len(swarm) == 0 and (self.allowed is None or
                                         infohash not in self.allowed):
-                    del self.times[infohash]
                     del self.downloads[infohash]
-                    del self.seedcount[infohash]
-        self.rawserver.add_task(self.expire_downloaders,
-                                self.timeout_downloaders_interval)
+                    self.fragments.pop(infohash, None)
+
+
+def make_rawserver(config, doneflag):
+    if config['poll_backend'] == 'asyncio':
+        return AsyncRawServer(doneflag, config['timeout_check_interval'],
+                              config['socket_timeout'],
+                              ipv6_enable=config['ipv6_enabled'])
+    return RawServer(doneflag, config['timeout_check_interval'],
+                     config['socket_timeout'],
+                     ipv6_enable=config['ipv6_enabled'],
+                     poll_backend=config['poll_backend'])
+
+
+def read_state(dfile):
+    try:
+        return TrackerState.read(dfile)
+    except (IOError, ValueError, TypeError):
+        print('**warning** statefile ' + dfile + ' corrupt; resetting')
+        return {}
+
+
+def shard_dfiles(dfile, nshards):
+    """Divide the state saved in dfile among the dfiles of shards
+
+    Shard dfiles left by a sharded tracker that did not shut down are
+    merged and divided again instead."""
+    stale = []
+    while os.path.exists('{}.{}'.format(dfile, len(stale))):
+        stale.append('{}.{}'.format(dfile, len(stale)))
+    if stale:
+        state = merge_states([read_state(path) for path in stale])
+    elif os.path.exists(dfile):
+        state = read_state(dfile)
+    else:
+        state = {}
+    for path in stale[nshards:]:
+        os.remove(path)
+    dfiles = ['{}.{}'.format(dfile, i) for i in range(nshards)]
+    for path, shard_state in zip(dfiles, split_state(state, nshards)):
+        TrackerState(shard_state).write(path)
+    return dfiles
+
+
+def merge_dfiles(dfiles, dfile):
+    """Merge the dfiles of shards back into dfile, removing them"""
+    TrackerState(merge_states([read_state(path)
+                               for path in dfiles])).write(dfile)
+    for path in dfiles:
+        os.remove(path)
+
+
+def run_shard(config, sock, inherited=()):
+    """Run the Tracker of a shard on requests forwarded over sock, until
+    the listening process stops or goes away
+
+    inherited are the listening process's ends of socket pairs, closed so
+    that only the listening process holds them."""
+    for other in inherited:
+        other.close()
+    # Interrupts stop the listening process, which then stops its shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    doneflag = threading.Event()
+    r = make_rawserver(config, doneflag)
+    t = Tracker(config, r)
+    server = ShardServer(t, doneflag)
+    r.adopt_connection(sock, server)
+    r.listen_forever(server)
+    t.save_state()
+    r.shutdown()
+
+
+def track_shards(config):
+    dfiles = shard_dfiles(config['dfile'], config['shards'])
+    sockets = []
+    workers = []
+    for dfile in dfiles:
+        sock, shard_sock = socket.socketpair()
+        sockets.append(sock)
+        worker = multiprocessing.Process(
+            target=run_shard, args=(dict(config, dfile=dfile), shard_sock,
+                                    sockets))
+        worker.start()
+        shard_sock.close()
+        workers.append(worker)
+
+    r = make_rawserver(config, threading.Event())
+    favicon = bool(config['favicon']) and os.path.exists(config['favicon'])
+    router = ShardRouter(config, r, sockets,
+                         functools.partial(infopage, config, favicon))
+    r.bind(config['port'], config['bind'],
+           reuse=True, ipv6_socket_style=config['ipv6_binds_v4'])
+    if config['udp_port']:
+        r.bind_udp(config['udp_port'], ShardUDPHandler(router),
+                   config['bind'], ipv6_socket_style=config['ipv6_binds_v4'])
+    r.listen_forever(
+        HTTPHandler(router.get, config['min_time_between_log_flushes']))
+    router.stop()
+    r.shutdown()
+    for worker in workers:
+        worker.join()
+    merge_dfiles(dfiles, config['dfile'])
+    print('# Shutting down: ', isotime())
 
 
 def track(args):
@@ -1194,11 +1345,16 @@ def track(args):
         print('error: ', str(e))
         print('run with no arguments for parameter explanations')
         return
-    r = RawServer(threading.Event(), config['timeout_check_interval'],
-                  config['socket_timeout'], ipv6_enable=config['ipv6_enabled'])
+    if config['shards'] > 1:
+        track_shards(config)
+        return
+    r = make_rawserver(config, threading.Event())
     t = Tracker(config, r)
     r.bind(config['port'], config['bind'],
            reuse=True, ipv6_socket_style=config['ipv6_binds_v4'])
+    if config['udp_port']:
+        r.bind_udp(config['udp_port'], UDPHandler(t), config['bind'],
+                   ipv6_socket_style=config['ipv6_binds_v4'])
     r.listen_forever(
         HTTPHandler(t.get, config['min_time_between_log_flushes']))
     t.save_state()
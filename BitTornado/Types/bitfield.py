@@ -1,54 +1,153 @@
 """Manipulable boolean list structure and related functions"""
 
+from itertools import islice
 
 CHARBITMAP = [tuple(bool((integer << nbits) & 0x80) for nbits in range(8))
               for integer in range(256)]
 
-BITCHARMAP = dict(zip(CHARBITMAP, range(256)))
+# Positions of the set bits in each byte value, most significant first
+CHARINDICES = [tuple(nbits for nbits in range(8) if (integer << nbits) & 0x80)
+               for integer in range(256)]
 
+if hasattr(int, 'bit_count'):
+    def popcount(value):
+        """Number of set bits in a non-negative integer"""
+        return value.bit_count()
+else:
+    def popcount(value):
+        """Number of set bits in a non-negative integer"""
+        return bin(value).count('1')
+
+
+class Bitfield(object):
+    """Allow a sequence of booleans to be used as an indexable bitfield
+
+    Bits are packed into a bytearray in wire order (the high bit of the first
+    byte is index 0), so conversion to and from bytes is a copy, and bitwise
+    operations between bitfields of equal length run over whole integers."""
+    __slots__ = ('length', 'bits', 'numfalse')
 
-class Bitfield(list):
-    """Allow a sequence of booleans to be used as an indexable bitfield"""
     def __init__(self, length=None, bitstring=None, copyfrom=None, val=False):
         if copyfrom is not None:
-            super(Bitfield, self).__init__(copyfrom)
+            self.length = copyfrom.length
+            self.bits = bytearray(copyfrom.bits)
             self.numfalse = copyfrom.numfalse
             return
         if length is None:
             raise ValueError('length must be provided unless copying from '
                              'another array')
+        self.length = length
         if bitstring is not None:
             extra = len(bitstring) * 8 - length
             if not 0 <= extra < 8:
                 raise ValueError
 
             if isinstance(bitstring, str):
-                bitstring = map(ord, bitstring)
-            bits = [bit for byte in bitstring for bit in CHARBITMAP[byte]]
-            if extra > 0:
-                if bits[-extra:] != [False] * extra:
-                    raise ValueError
-                del bits[-extra:]
-            self.numfalse = len(bits) - sum(bits)
+                bitstring = bitstring.encode('latin-1')
+            if extra > 0 and bitstring[-1] & ((1 << extra) - 1):
+                raise ValueError
+            self.bits = bytearray(bitstring)
+            self.numfalse = length - popcount(int(self))
+        elif val:
+            self.bits = bytearray(b'\xff' * ((length + 7) // 8))
+            if length % 8:
+                self.bits[-1] = (0xff << (8 - length % 8)) & 0xff
+            self.numfalse = 0
         else:
-            bits = [val] * length
-            self.numfalse = 0 if val else length
+            self.bits = bytearray((length + 7) // 8)
+            self.numfalse = length
+
+    def _index(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('Bitfield index out of range')
+        return index
 
-        super(Bitfield, self).__init__(bits)
+    def __getitem__(self, index):
+        index = self._index(index)
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
 
     def __setitem__(self, index, val):
-        val = bool(val)
-        self.numfalse += self[index] - val
-        super(Bitfield, self).__setitem__(index, val)
+        index = self._index(index)
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if val:
+            if not byte & mask:
+                self.bits[index >> 3] = byte | mask
+                self.numfalse -= 1
+        elif byte & mask:
+            self.bits[index >> 3] = byte & ~mask
+            self.numfalse += 1
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return islice((bit for byte in self.bits for bit in CHARBITMAP[byte]),
+                      self.length)
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitfield):
+            return NotImplemented
+        return self.length == other.length and self.bits == other.bits
+
+    __hash__ = None
 
     def __repr__(self):
         return "<Bitfield ({})>".format(','.join(str(int(i)) for i in self))
 
     def __bytes__(self):
         """Produce a bytestring corresponding to the current bitfield"""
-        bits = self + [False] * (-len(self) % 8)
-        return bytes(BITCHARMAP[tuple(bits[x:x + 8])]
-                     for x in range(0, len(bits), 8))
+        return bytes(self.bits)
+
+    def __int__(self):
+        """Bits as an integer, index 0 being the most significant bit of the
+        first byte"""
+        return int.from_bytes(self.bits, 'big')
+
+    def _from_int(self, value):
+        new = Bitfield.__new__(Bitfield)
+        new.length = self.length
+        new.bits = bytearray(value.to_bytes(len(self.bits), 'big'))
+        new.numfalse = self.length - popcount(value)
+        return new
+
+    def _check_length(self, other):
+        if self.length != len(other):
+            raise ValueError('Bitfield lengths differ')
+
+    def __and__(self, other):
+        """Bits set in both bitfields"""
+        self._check_length(other)
+        return self._from_int(int(self) & int(other))
+
+    def __or__(self, other):
+        """Bits set in either bitfield"""
+        self._check_length(other)
+        return self._from_int(int(self) | int(other))
+
+    def __sub__(self, other):
+        """Bits set in this bitfield but not the other (AND NOT)"""
+        self._check_length(other)
+        return self._from_int(int(self) & ~int(other))
+
+    def any(self):
+        """True if any boolean is True"""
+        return self.numfalse < self.length
+
+    def indices(self):
+        """Generate the indices of True booleans in ascending order"""
+        for pos, byte in enumerate(self.bits):
+            if byte:
+                base = pos << 3
+                for nbits in CHARINDICES[byte]:
+                    yield base + nbits
+
+    @property
+    def numtrue(self):
+        """Number of True booleans"""
+        return self.length - self.numfalse
 
     @property
     def complete(self):
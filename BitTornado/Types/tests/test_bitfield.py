@@ -45,5 +45,44 @@ class BitfieldTests(unittest.TestCase):
         self.assertEqual(testx.numfalse, 5)
         self.assertEqual(bytes(testx), b'\xc4')
 
+    def test_access(self):
+        testx = Bitfield(10, b'\xa0\x40')
+        self.assertEqual(list(testx), [True, False, True] + [False] * 6 +
+                         [True])
+        self.assertTrue(testx[-1])
+        self.assertFalse(testx[-2])
+        self.assertRaises(IndexError, testx.__getitem__, 10)
+        self.assertRaises(IndexError, testx.__setitem__, -11, True)
+        testx[-1] = False
+        self.assertEqual(testx.numfalse, 8)
+        self.assertEqual(testx.numtrue, 2)
+        self.assertEqual(list(testx.indices()), [0, 2])
+
+        full = Bitfield(10, val=True)
+        self.assertTrue(full.complete)
+        self.assertEqual(bytes(full), b'\xff\xc0')
+        copy = Bitfield(copyfrom=full)
+        copy[3] = False
+        self.assertTrue(full.complete)
+        self.assertEqual(copy.numfalse, 1)
+        self.assertNotEqual(copy, full)
+        self.assertEqual(copy, Bitfield(10, b'\xef\xc0'))
+
+    def test_operations(self):
+        mine = Bitfield(12, b'\xf0\x30')
+        theirs = Bitfield(12, b'\x3c\x90')
+
+        both = mine & theirs
+        self.assertEqual(bytes(both), b'\x30\x10')
+        self.assertEqual(both.numfalse, 9)
+        self.assertEqual(bytes(mine | theirs), b'\xfc\xb0')
+        wanted = theirs - mine
+        self.assertEqual(bytes(wanted), b'\x0c\x80')
+        self.assertEqual(list(wanted.indices()), [4, 5, 8])
+        self.assertTrue(wanted.any())
+        self.assertFalse((mine - mine).any())
+        self.assertEqual((mine - mine).numfalse, 12)
+        self.assertRaises(ValueError, mine.__and__, Bitfield(13))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,25 @@
 from ..Types.tests import *
+from .test_asyncrawserver import AsyncRawServerTests
 from .test_bencode import CodecTests
+from .test_download_bt1 import StreamingTests
+from .test_downloader import DuplicateRequestTests, PipelineTests, \
+    RateLimitTests
+from .test_encrypter import FramingTests
+from .test_hashchecker import HashCheckerTests
+from .test_lazymetainfo import LazyMetaInfoTests
+from .test_makemetafile import PieceHasherTests, ParallelMakeTests
 from .test_networkaddress import AddressFunctionTests, AddressRangeTests, \
     SubnetTests, TestAddrList
 from .test_parseargs import ParseArgsTest
+from .test_peerstore import SwarmTests, TimingWheelTests, TrackerPeerTests, \
+    TrackerGetTests
 from .test_piecebuffer import PieceBufferTests
-from .test_selectpoll import PollListTests
+from .test_piecepicker import PiecePickerTests
+from .test_ratelimiter import RateLimiterTests
+from .test_resume import ResumeRecordTests
+from .test_selectpoll import PollListTests, SelectorsPollTests
+from .test_shards import ShardStateTests, ShardRouterTests
+from .test_sockethandler import SingleSocketWriteTests
+from .test_storage import MappedReadTests
+from .test_taskqueue import TaskQueueTests
+from .test_udptracker import UDPHandlerTests, DatagramTests
@@ -0,0 +1,94 @@
+import unittest
+import threading
+
+from BitTornado.Network.AsyncRawServer import AsyncRawServer
+
+
+class EchoHandler(object):
+    """Echo data on accepted connections; record data on outgoing ones"""
+    def __init__(self):
+        self.received = b''
+        self.lost = []
+
+    def external_connection_made(self, connection):
+        pass
+
+    def data_came_in(self, connection, data):
+        if connection.incoming:
+            connection.write(data)
+        else:
+            self.received += data
+
+    def connection_flushed(self, connection):
+        pass
+
+    def connection_lost(self, connection):
+        self.lost.append(connection)
+
+
+class AsyncRawServerTests(unittest.TestCase):
+    def setUp(self):
+        self.doneflag = threading.Event()
+        self.server = AsyncRawServer(self.doneflag, 60, 300,
+                                     ipv6_enable=False)
+        # Bind to an ephemeral port
+        self.server.bind(0, '127.0.0.1')
+        listener, = self.server.sockethandler.servers.values()
+        self.port = listener.getsockname()[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_tasks(self):
+        calls = []
+        self.server.add_task(lambda: calls.append(2), 0.02)
+        self.server.add_task(lambda: calls.append(1), 0.01)
+        self.server.add_task(lambda: calls.append('x'), 0.01).cancel()
+        self.server.add_task(lambda: calls.append('k'), 0.02, 'k')
+        self.server.kill_tasks('k')
+        self.server.add_task(self.doneflag.set, 0.05)
+        self.server.listen_forever(EchoHandler())
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(self.server.tasks, {})
+
+    def test_echo(self):
+        handler = EchoHandler()
+
+        def connect():
+            conn = self.server.start_connection(('127.0.0.1', self.port))
+            conn.write(b'hello ')
+            conn.write(b'world')
+
+        def check():
+            if handler.received == b'hello world':
+                self.doneflag.set()
+            else:
+                self.server.add_task(check, 0.01)
+
+        self.server.add_task(connect)
+        self.server.add_task(check, 0.01)
+        self.server.add_task(self.doneflag.set, 5)
+        self.server.listen_forever(handler)
+        self.assertEqual(handler.received, b'hello world')
+
+    def test_refused(self):
+        handler = EchoHandler()
+
+        def connect():
+            self.conn = self.server.start_connection(('127.0.0.1', 1))
+
+        def check():
+            if handler.lost:
+                self.doneflag.set()
+            else:
+                self.server.add_task(check, 0.01)
+
+        self.server.add_task(connect)
+        self.server.add_task(check, 0.01)
+        self.server.add_task(self.doneflag.set, 5)
+        self.server.listen_forever(handler)
+        self.assertEqual(handler.lost, [self.conn])
+        self.assertEqual(self.server.connections, set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 
-from ..Meta.bencode import bencode, bdecode, Bencached
+from ..Meta.bencode import bencode, bdecode, Bencached, FastDecoder, \
+    fast_bdecode
 
 
 class CodecTests(unittest.TestCase):
@@ -32,8 +33,47 @@ class CodecTests(unittest.TestCase):
 
         self.assertEqual(bencode(''), bencode(b''))
 
+    def test_bencode_buffer(self):
+        """Test encoding into a supplied buffer"""
+        ctext = bytearray(b'prefix')
+        bencode.encode({'b': [1, 'x'], 'a': b'\xff'}, ctext)
+        self.assertEqual(ctext, b'prefixd1:a1:\xff1:bli1e1:xee')
+
+        # Compact peer lists and mixed lists encode alike
+        peers = [bytes([i] * 6) for i in range(3)]
+        self.assertEqual(bencode(peers), b'l' + b''.join(
+            b'6:' + peer for peer in peers) + b'e')
+        self.assertEqual(bencode([b'ab', b'abc']), b'l2:ab3:abce')
+        self.assertEqual(bencode([b'ab', 'ab']), b'l2:ab2:abe')
+
+        # Key orders are reused across dictionaries of the same shape
+        first = {'b': 1, 'a': 2}
+        second = {'b': 3, 'a': 4}
+        self.assertEqual(bencode(first), b'd1:ai2e1:bi1ee')
+        self.assertEqual(bencode(second), b'd1:ai4e1:bi3ee')
+        self.assertEqual(bencode({'a': 4, 'b': 3}), bencode(second))
+        self.assertRaises(TypeError, bencode, {'a': 1, 2: 'b'})
+
+        class Subdict(dict):
+            pass
+        self.assertEqual(bencode(Subdict(b=True)), b'd1:bi1ee')
+
+        # Mappings may list keys other than those they store
+        class Hidden(dict):
+            def keys(self):
+                return iter(key for key in super().keys() if key != 'x')
+        self.assertEqual(bencode(Hidden(x=1, y=2)), b'd1:yi2ee')
+        self.assertEqual(bencode(memoryview(b'abc')), b'3:abc')
+
     def test_bdecode(self):
         """Test decoding of valid and erroneous sample strings"""
+        self._test_decoder(bdecode)
+
+    def test_fast_bdecode(self):
+        """Test the iterative decoder on the same samples"""
+        self._test_decoder(fast_bdecode)
+
+    def _test_decoder(self, bdecode):
         self.assertWarns(Warning, bdecode, b'0:0:')
         self.assertRaises(ValueError, bdecode, b'ie')
         self.assertRaises(ValueError, bdecode, b'i341foo382e')
@@ -79,5 +119,26 @@ class CodecTests(unittest.TestCase):
         self.assertRaises(ValueError, bdecode, b'd0:0:')
         self.assertRaises(ValueError, bdecode, b'd0:')
 
+    def test_fast_bdecode_binary(self):
+        """Binary keys are not decoded as text, and may be views"""
+        ctext = b'd5:peers6:abcdef6:peers6le5:piecei3e4:text3:abce'
+        self.assertEqual(bdecode(ctext)['peers'], 'abcdef')
+        self.assertEqual(fast_bdecode(ctext),
+                         {'peers': b'abcdef', 'peers6': [], 'piece': 3,
+                          'text': 'abc'})
+
+        view = FastDecoder(views=True)(ctext)['peers']
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, b'abcdef')
+
+    def test_fast_bdecode_deep(self):
+        """Nesting is not limited by the recursion limit"""
+        depth = 100000
+        data = fast_bdecode(b'l' * depth + b'i1e' + b'e' * depth)
+        for _ in range(depth):
+            data, = data
+        self.assertEqual(data, 1)
+        self.assertRaises(ValueError, fast_bdecode, b'l' * depth)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+import threading
+import unittest
+
+from BitTornado.Client.download_bt1 import BT1Download, defaults
+from BitTornado.Client.PiecePicker import PiecePicker
+
+PIECE = 1024
+NUMPIECES = 10
+DATA = bytes(range(256)) * (PIECE * NUMPIECES // 256 - 2)
+
+
+class FakeRawServer(object):
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, func, delay=0, context=None):
+        self.tasks.append((delay, func))
+
+    def run(self):
+        tasks, self.tasks = self.tasks, []
+        for _, func in tasks:
+            func()
+        return len(tasks)
+
+
+class FakeStorage(object):
+    def get_total_length(self):
+        return len(DATA)
+
+
+class FakeStorageWrapper(object):
+    piece_size = PIECE
+
+    def __init__(self):
+        self.have = set()
+
+    def do_I_have(self, index):
+        return index in self.have
+
+    def get_piece(self, index, begin, length):
+        if index not in self.have:
+            return None
+        start = index * PIECE + begin
+        return DATA[start:start + length]
+
+
+class FakeDownloader(object):
+    def __init__(self):
+        self.checks = 0
+
+    def check_deadlines(self):
+        self.checks += 1
+
+
+class StreamingTests(unittest.TestCase):
+    def setUp(self):
+        dow = self.dow = BT1Download.__new__(BT1Download)
+        dow.config = {key: value for key, value, _ in defaults}
+        dow.config['stream_window'] = 1
+        dow.rawserver = FakeRawServer()
+        dow.storage = FakeStorage()
+        dow.storagewrapper = FakeStorageWrapper()
+        dow.picker = PiecePicker(NUMPIECES)
+        dow.downloader = FakeDownloader()
+        dow.len_pieces = NUMPIECES
+        dow.started = True
+        dow.doneflag = threading.Event()
+        dow.finflag = threading.Event()
+        dow.cursor = None
+        dow.stream_ticking = False
+
+    def test_cursor(self):
+        dow = self.dow
+        rawserver = dow.rawserver
+        dow.set_cursor(3 * PIECE, 2)
+        rawserver.run()
+        self.assertEqual(sorted(dow.picker.deadlines), [3, 4])
+        self.assertEqual(dow.downloader.checks, 1)
+        # One tick is kept scheduled, however often the cursor is cleared
+        # and set again
+        for _ in range(3):
+            dow.clear_cursor()
+            dow.set_cursor(5 * PIECE, 2)
+            rawserver.run()
+        self.assertEqual(sorted(dow.picker.deadlines), [5, 6])
+        self.assertEqual(len(rawserver.tasks), 1)
+        self.assertEqual(rawserver.run(), 1)
+        self.assertEqual(len(rawserver.tasks), 1)
+        # Clearing the cursor ends the ticks
+        dow.clear_cursor()
+        rawserver.run()
+        self.assertEqual(dow.picker.deadlines, {})
+        self.assertEqual(rawserver.run(), 1)
+        self.assertEqual(rawserver.tasks, [])
+        self.assertFalse(dow.stream_ticking)
+
+    def test_read(self):
+        dow = self.dow
+        dow.storagewrapper.have.update((0, 1, 2, 4, 9))
+        self.assertEqual(dow.get_available(100), 3 * PIECE - 100)
+        self.assertEqual(dow.get_available(3 * PIECE), 0)
+        # The last piece is short
+        self.assertEqual(dow.get_available(9 * PIECE), len(DATA) - 9 * PIECE)
+        self.assertEqual(dow.read(100, 5000), DATA[100:3 * PIECE])
+        self.assertEqual(dow.read(PIECE - 10, 20), DATA[PIECE - 10:PIECE + 10])
+        self.assertEqual(dow.read(4 * PIECE + 5, 10),
+                         DATA[4 * PIECE + 5:4 * PIECE + 15])
+
+        reads = []
+        dow.request_read(9 * PIECE, 5000, reads.append)
+        self.assertEqual(reads, [])
+        dow.rawserver.run()
+        self.assertEqual(reads, [DATA[9 * PIECE:]])
+
+if __name__ == '__main__':
+    unittest.main()
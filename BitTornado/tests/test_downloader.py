@@ -0,0 +1,234 @@
+import unittest
+
+from BitTornado.Client.Downloader import Downloader
+from BitTornado.Client.PiecePicker import PiecePicker
+from BitTornado.Client.RateLimiter import RateLimiter
+from BitTornado.clock import clock
+from BitTornado.Types import Bitfield
+
+NUMPIECES = 20
+BLOCKS = 2
+BLOCK = 16
+
+
+class FakeStorage(object):
+    """Hands out the blocks of each piece as StorageWrapper does"""
+    piece_length = BLOCKS * BLOCK
+    request_size = BLOCK
+
+    def __init__(self):
+        self.inactive = [[(begin, BLOCK)
+                          for begin in range(0, self.piece_length, BLOCK)]
+                         for _ in range(NUMPIECES)]
+        self.got = [set() for _ in range(NUMPIECES)]
+        self.dirty = {}
+
+    def new_request(self, index):
+        return self.inactive[index].pop(0)
+
+    def do_I_have_requests(self, index):
+        return bool(self.inactive[index])
+
+    def request_lost(self, index, begin, length):
+        assert (begin, length) not in self.inactive[index]
+        self.inactive[index].append((begin, length))
+
+    def piece_came_in(self, index, begin, piece, source=None):
+        assert begin not in self.got[index]
+        self.got[index].add(begin)
+        return True
+
+    def do_I_have(self, index):
+        return len(self.got[index]) == BLOCKS
+
+    def is_endgame(self):
+        return False
+
+    def am_I_complete(self):
+        return False
+
+
+class FakeConnection(object):
+    def __init__(self, n):
+        self.n = n
+        self.requests = []
+        self.cancels = []
+
+    def get_ip(self):
+        return '10.0.0.%d' % self.n
+
+    def get_readable_id(self):
+        return str(self.n)
+
+    def send_interested(self):
+        pass
+
+    def send_not_interested(self):
+        pass
+
+    def send_request(self, index, begin, length):
+        self.requests.append((index, begin, length))
+
+    def send_cancel(self, index, begin, length):
+        self.cancels.append((index, begin, length))
+
+
+class DuplicateRequestTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = FakeStorage()
+        self.picker = PiecePicker(NUMPIECES)
+        self.downloader = Downloader(
+            self.storage, self.picker, 5, 20, NUMPIECES, BLOCK,
+            lambda amount: None, 30, False, None, None)
+        self.downloads = []
+        for n in range(3):
+            download = self.downloader.make_download(FakeConnection(n))
+            have = Bitfield(NUMPIECES)
+            for piece in range(NUMPIECES):
+                have[piece] = True
+            download.got_have_bitfield(have)
+            self.downloads.append(download)
+
+    def test_stream_order(self):
+        self.picker.set_deadlines({piece: clock() + 100 + piece
+                                   for piece in (9, 7, 8)})
+        for download, index in zip(self.downloads, (7, 8, 9)):
+            download.got_unchoke()
+            self.assertEqual([request[0]
+                              for request in download.active_requests],
+                             [index] * BLOCKS)
+
+    def test_duplicates(self):
+        downloader = self.downloader
+        first, second, third = self.downloads
+        first.got_unchoke()
+        index = first.active_requests[0][0]
+        self.assertFalse(self.storage.do_I_have_requests(index))
+        # The piece falls due: its blocks are requested again elsewhere
+        self.picker.set_deadlines({index: clock()}, 5)
+        second.got_unchoke()
+        third.got_unchoke()
+        duplicated = [request for request in first.active_requests
+                      if request[0] == index]
+        self.assertEqual([request for request in second.active_requests
+                          if request[0] == index], duplicated)
+        self.assertEqual(downloader.duplicates,
+                         {request: 3 for request in duplicated})
+
+        # A block arriving cancels its duplicates
+        request = duplicated[0]
+        second.got_piece(request[0], request[1], b'x' * request[2])
+        self.assertEqual(self.storage.got[index], {request[1]})
+        self.assertIn(request, first.connection.cancels)
+        self.assertIn(request, third.connection.cancels)
+        self.assertNotIn(request, downloader.duplicates)
+        self.assertNotIn(request, first.active_requests)
+        self.assertNotIn(request, third.active_requests)
+
+        # Blocks are only returned to storage when no duplicate remains
+        request = duplicated[1]
+        first.got_choke()
+        self.assertEqual(downloader.duplicates[request], 2)
+        second.got_choke()
+        self.assertNotIn(request, downloader.duplicates)
+        self.assertFalse(self.storage.do_I_have_requests(index))
+        third.got_choke()
+        self.assertTrue(self.storage.do_I_have_requests(index))
+        self.assertEqual(downloader.duplicates, {})
+
+
+class FakeMeasure(object):
+    def __init__(self, rate):
+        self.rate = rate
+
+    def get_rate(self):
+        return self.rate
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.downloader = Downloader(
+            FakeStorage(), PiecePicker(NUMPIECES), 100, 20, NUMPIECES, BLOCK,
+            lambda amount: None, 30, False, None, None)
+        self.download = self.downloader.make_download(FakeConnection(0))
+
+    def test_rtt(self):
+        download = self.download
+        have = Bitfield(NUMPIECES)
+        have[3] = True
+        download.got_have_bitfield(have)
+        download.got_unchoke()
+        request = download.timed[0]
+        self.assertEqual(request, download.active_requests[0])
+        download.got_piece(request[0], request[1], b'x' * request[2])
+        self.assertGreaterEqual(download.rtt, 0)
+        # The lowest round trip is kept
+        rtt = download.rtt
+        download._got_rtt(rtt + 0.5)
+        self.assertEqual(download.rtt, rtt)
+        download.rtt = 0.8
+        download._got_rtt(0.5)
+        self.assertEqual(download.rtt, 0.5)
+        # Requests cancelled are not timed
+        request = download.active_requests[0]
+        download._sent(request)
+        download._cancelled(request)
+        self.assertIsNone(download.timed)
+        download._sent(request)
+        download.got_choke()
+        self.assertIsNone(download.timed)
+
+    def test_depth(self):
+        download = self.download
+        download.measure = FakeMeasure(BLOCK * 100)
+        self.assertEqual(download._backlog(False), 50)
+        # Short round trips need no deeper pipe than before
+        download.rtt = 0.1
+        self.assertEqual(download._backlog(False), 50)
+        download.rtt = 0.4
+        self.assertEqual(download._backlog(False), 82)
+        download.rtt = 2
+        self.assertEqual(download._backlog(False), 100)
+        self.assertEqual(download.backlog, 100)
+        self.downloader.set_download_rate(BLOCK * 10 / 1000.0)
+        self.assertLessEqual(download._backlog(False), 10)
+
+
+class RateLimitTests(unittest.TestCase):
+    def setUp(self):
+        self.tasks = []
+        limiter = RateLimiter(lambda func, delay: self.tasks.append(
+            (delay, func)), BLOCK)
+        self.downloader = Downloader(
+            FakeStorage(), PiecePicker(NUMPIECES), 100, 20, NUMPIECES, BLOCK,
+            lambda amount: None, 30, False, None, None, limiter.add_class())
+        self.download = self.downloader.make_download(FakeConnection(0))
+        self.download.got_have_bitfield(Bitfield(NUMPIECES, val=True))
+
+    def receive(self):
+        download = self.download
+        for request in list(download.active_requests):
+            download.got_piece(request[0], request[1], b'x' * request[2])
+
+    def test_peer_rate(self):
+        downloader = self.downloader
+        download = self.download
+        downloader.set_peer_download_rate(BLOCK * 2 / 1000.0)
+        download.got_unchoke()
+        self.assertEqual(len(download.active_requests), 2)
+        self.receive()
+        # Downloads in debt are held back until their credit returns
+        self.assertEqual(download.active_requests, [])
+        self.assertTrue(download.held)
+        (delay, func), = self.tasks
+        self.assertAlmostEqual(delay, 1, places=2)
+        # Downloads held back request again when woken
+        download.bucket.tokens = BLOCK
+        func()
+        self.assertFalse(download.held)
+        self.assertEqual(len(download.active_requests), 2)
+        # Downloads are limited by the torrent's rate too
+        downloader.set_peer_download_rate(0)
+        downloader.set_download_rate(BLOCK / 1000.0)
+        self.receive()
+        self.assertEqual(len(download.active_requests), 1)
@@ -0,0 +1,50 @@
+import unittest
+
+from BitTornado.Network.Encrypter import Connection
+
+
+class FramingTests(unittest.TestCase):
+    """Connection._frame splits length-prefixed messages out of reads"""
+    def setUp(self):
+        self.conn = Connection.__new__(Connection)
+        self.conn.closed = False
+        self.conn.partial = None
+        self.conn.next_len, self.conn.next_func = 4, self.read_len
+        self.messages = []
+
+    def read_len(self, s):
+        return int.from_bytes(s, 'big'), self.read_message
+
+    def read_message(self, s):
+        self.messages.append(bytes(s))
+        return 4, self.read_len
+
+    def feed(self, data, readsize):
+        # Reuse one buffer for every read, as SocketHandler does
+        buf = bytearray(readsize)
+        for i in range(0, len(data), readsize):
+            chunk = data[i:i + readsize]
+            buf[:len(chunk)] = chunk
+            self.conn._frame(memoryview(buf)[:len(chunk)])
+
+    def test_frame(self):
+        msgs = [bytes([i]) * (i * 37 % 1000) for i in range(50)]
+        data = b''.join(len(m).to_bytes(4, 'big') + m for m in msgs)
+        for readsize in (1, 3, 64, 999, len(data)):
+            self.setUp()
+            self.feed(data, readsize)
+            self.assertEqual(self.messages, msgs)
+            self.assertIsNone(self.conn.partial)
+
+    def test_claimed_length(self):
+        # A peer claiming a long message is given no more memory than it
+        # has sent
+        self.conn.next_len = 8 * 2 ** 20
+        self.conn.next_func = self.read_message
+        self.feed(b'x' * 100, 10)
+        self.assertEqual(self.conn.partial, b'x' * 100)
+        self.assertLess(self.conn.partial.__sizeof__(), 1000)
+        self.assertEqual(self.messages, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import hashlib
+import unittest
+
+from BitTornado.Storage.HashChecker import HashChecker
+
+
+class Buffer(object):
+    """Stands in for PieceBuffer, without touching the shared pool"""
+    def __init__(self, data):
+        self.buf = bytearray(data)
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class HashCheckerTests(unittest.TestCase):
+    piece_length = 64
+    lastlen = 40
+
+    def setUp(self):
+        self.data = bytes(range(256)) * 4 + bytes(range(self.lastlen))
+        self.npieces = len(self.data) // self.piece_length + 1
+        self.reads = []
+        self.buffers = []
+
+    def piecelen(self, piece):
+        if piece == self.npieces - 1:
+            return self.lastlen
+        return self.piece_length
+
+    def read(self, piece, length):
+        self.reads.append((piece, length))
+        pos = piece * self.piece_length
+        buf = Buffer(self.data[pos:pos + length])
+        self.buffers.append(buf)
+        return buf
+
+    def expected(self, piece):
+        pos = piece * self.piece_length
+        data = self.data[pos:pos + self.piecelen(piece)]
+        return (piece, hashlib.sha1(data[:self.lastlen]).digest(),
+                hashlib.sha1(data).digest())
+
+    def test_check(self):
+        pieces = [0, 1, 2, 5, 6, 7, 8, 9, 10, 16]
+        checker = HashChecker(self.read, self.piecelen, self.lastlen,
+                              workers=3, readsize=3 * self.piece_length)
+        results = [result for run in checker.check(pieces) for result in run]
+        checker.close()
+
+        self.assertEqual(results, [self.expected(i) for i in pieces])
+        # Consecutive pieces are read together, up to readsize bytes
+        self.assertEqual(self.reads, [(0, 192), (5, 192), (8, 192),
+                                      (16, self.lastlen)])
+        self.assertTrue(all(buf.released for buf in self.buffers))
+
+    def test_large_pieces(self):
+        checker = HashChecker(self.read, self.piecelen, self.lastlen,
+                              workers=2, readsize=1)
+        results = [result for run in checker.check(range(self.npieces))
+                   for result in run]
+        checker.close()
+
+        self.assertEqual(results,
+                         [self.expected(i) for i in range(self.npieces)])
+        self.assertEqual(len(self.reads), self.npieces)
+
+    def test_read_failure(self):
+        def read(piece, length):
+            return None if piece >= 4 else self.read(piece, length)
+
+        checker = HashChecker(read, self.piecelen, self.lastlen, workers=1,
+                              readsize=self.piece_length)
+        runs = list(checker.check(range(self.npieces)))
+        checker.close()
+
+        # Runs already read are reported before the failure
+        self.assertIsNone(runs[-1])
+        self.assertEqual(runs[:-1], [[self.expected(i)] for i in range(3)])
@@ -0,0 +1,81 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from BitTornado.Meta.bencode import bencode
+from BitTornado.Meta.Info import LazyMetaInfo, MetaInfo
+from BitTornado.Application.parsedir import parse_torrent
+
+
+class LazyMetaInfoTests(unittest.TestCase):
+    def metainfo(self, **info):
+        base = {'name': 'example', 'piece length': 16384,
+                'pieces': os.urandom(60),
+                'files': [{'length': 10, 'path': ['a']},
+                          {'length': 20, 'path': ['b', 'c']}]}
+        base.update(info)
+        return {'announce': 'http://localhost/announce',
+                'announce-list': [['http://localhost/announce']],
+                'creation date': 1500000000, 'info': base}
+
+    def test_fields(self):
+        data = self.metainfo()
+        lazy = LazyMetaInfo(bencode(data))
+        self.assertEqual(lazy.infohash,
+                         hashlib.sha1(bencode(data['info'])).digest())
+        self.assertEqual(lazy['announce'], data['announce'])
+        self.assertEqual(lazy['info']['name'], 'example')
+        self.assertEqual(lazy.info.size('pieces'), 60)
+        self.assertNotIn('pieces', lazy.info.decoded)
+        self.assertEqual((lazy.numfiles, lazy.length), (2, 30))
+        self.assertIsNone(lazy.get('comment'))
+        lazy.check()
+
+        single = self.metainfo(length=5)
+        del single['info']['files']
+        lazy = LazyMetaInfo(bencode(single))
+        self.assertEqual((lazy.numfiles, lazy.length), (1, 5))
+
+    def test_check(self):
+        for info in ({'pieces': os.urandom(30)}, {'piece length': 0},
+                     {'name': '../x'}, {'length': 5}):
+            lazy = LazyMetaInfo(bencode(self.metainfo(**info)))
+            self.assertRaises(ValueError, lazy.check)
+        self.assertRaises(ValueError, LazyMetaInfo, bencode({'a': 1}))
+        self.assertRaises(ValueError, LazyMetaInfo,
+                          bencode(self.metainfo())[:-20])
+
+    def test_materialize(self):
+        data = self.metainfo()
+        metainfo = LazyMetaInfo(bencode(data)).materialize()
+        self.assertIsInstance(metainfo, MetaInfo)
+        self.assertEqual(metainfo['info']['pieces'], data['info']['pieces'])
+
+        bad = LazyMetaInfo(bencode(self.metainfo(
+            files=[{'length': 1, 'path': ['..']}])))
+        bad.check()
+        self.assertRaises(ValueError, bad.materialize)
+
+    def test_parse_torrent(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'example.torrent')
+            data = self.metainfo()
+            with open(path, 'wb') as handle:
+                handle.write(bencode(data))
+            torrentinfo, infohash = parse_torrent(path)
+            self.assertEqual(infohash,
+                             hashlib.sha1(bencode(data['info'])).digest())
+            self.assertEqual(torrentinfo['name'], 'example')
+            self.assertEqual(torrentinfo['numfiles'], 2)
+            self.assertEqual(torrentinfo['length'], 30)
+            self.assertEqual(torrentinfo['announce-list'],
+                             data['announce-list'])
+            self.assertNotIn('metainfo', torrentinfo)
+
+            torrentinfo, _ = parse_torrent(path, return_metainfo=True)
+            self.assertIsInstance(torrentinfo['metainfo'], MetaInfo)
+        finally:
+            shutil.rmtree(tmpdir)
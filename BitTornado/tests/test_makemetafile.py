@@ -0,0 +1,134 @@
+import os
+import mmap
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from BitTornado.Meta.bencode import bdecode
+from BitTornado.Meta.Info import PieceHasher, read_chunks
+from BitTornado.Meta.ParallelHasher import ParallelHasher, piece_jobs
+from BitTornado.Application.makemetafile import make_meta_file, completedir
+
+
+class PieceHasherTests(unittest.TestCase):
+    def reference(self, data, piece_length):
+        return b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                        for i in range(0, len(data), piece_length))
+
+    def test_chunking(self):
+        data = os.urandom(10000)
+        for chunk in (1, 999, 1000, 2000, 3001, 10000):
+            hasher = PieceHasher(1000)
+            hashed = []
+            for i in range(0, len(data), chunk):
+                hasher.update(memoryview(data)[i:i + chunk], hashed.append)
+            self.assertEqual(bytes(hasher), self.reference(data, 1000))
+            self.assertEqual(sum(hashed), len(data))
+
+        # Data running past the current piece by a multiple of the piece
+        # length leaves no piece in progress
+        hasher = PieceHasher(1000)
+        hasher.update(data[:500])
+        hasher.update(data[500:2500])
+        self.assertEqual(hasher.done, 500)
+        hasher.update(data[2500:])
+        self.assertEqual(bytes(hasher), self.reference(data, 1000))
+
+    def test_files(self):
+        data = os.urandom(10000)
+        with tempfile.TemporaryFile(buffering=0) as fileh:
+            fileh.write(data)
+            fileh.seek(0)
+            hasher = PieceHasher(4096)
+            for chunk in read_chunks(fileh, len(data), 3000):
+                hasher.update(chunk)
+            self.assertEqual(bytes(hasher), self.reference(data, 4096))
+
+            fileh.seek(0)
+            self.assertRaises(IOError, list,
+                              read_chunks(fileh, len(data) + 1, 3000))
+
+            with mmap.mmap(fileh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hasher = PieceHasher(4096)
+                hasher.update(mm)
+            self.assertEqual(bytes(hasher), self.reference(data, 4096))
+
+
+class ParallelMakeTests(unittest.TestCase):
+    sizes = (('a', 70000), ('e/b', 0), ('e/c', 1), ('d', 100000))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'e'))
+        self.files = []
+        for name, size in self.sizes:
+            fname = os.path.join(self.dir, name)
+            with open(fname, 'wb') as fileh:
+                fileh.write(os.urandom(size))
+            self.files.append((fname, size))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_piece_jobs(self):
+        jobs = list(piece_jobs(self.files, 32768, 70000))
+        self.assertEqual([length for _, length in jobs], [65536] * 2 + [38929])
+        self.assertEqual(jobs[1][0], [(self.files[0][0], 65536, 4464),
+                                      (self.files[2][0], 0, 1),
+                                      (self.files[3][0], 0, 61071)])
+
+    def test_hasher(self):
+        serial = PieceHasher(32768)
+        for fname, _ in self.files:
+            with open(fname, 'rb') as fileh:
+                serial.update(fileh.read())
+
+        hasher = ParallelHasher(workers=3, jobsize=32768)
+        try:
+            job = hasher.submit(self.files, 32768)
+            nbytes = sum(part for _, part in hasher.completed([job]))
+            self.assertEqual(b''.join(job.pieces()), bytes(serial))
+            self.assertEqual(nbytes, sum(size for _, size in self.files))
+        finally:
+            hasher.close()
+
+    def test_short_file(self):
+        hasher = ParallelHasher(workers=1)
+        try:
+            job = hasher.submit([(self.files[0][0], 80000)], 32768)
+            self.assertRaises(IOError, job.pieces)
+        finally:
+            hasher.close()
+
+    def read_torrents(self, workers):
+        target = tempfile.mkdtemp()
+        progress = []
+        try:
+            completedir(self.dir, 'http://localhost/announce',
+                        {'target': target, 'piece_size_pow2': 15,
+                         'workers': workers}, progress=progress.append)
+            make_meta_file(self.dir, 'http://localhost/announce',
+                           {'target': os.path.join(target, 'all.torrent'),
+                            'piece_size_pow2': 15, 'workers': workers})
+            torrents = {}
+            for fname in os.listdir(target):
+                with open(os.path.join(target, fname), 'rb') as fileh:
+                    torrents[fname] = bdecode(fileh.read())['info']
+        finally:
+            shutil.rmtree(target)
+        self.assertAlmostEqual(progress[-1], 1.0)
+        return torrents
+
+    def test_make(self):
+        serial = self.read_torrents(1)
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(self.read_torrents(2), serial)
+
+    def test_empty(self):
+        # Entries with no data are skipped, leaving the rest to be made
+        open(os.path.join(self.dir, 'f'), 'wb').close()
+        serial = self.read_torrents(1)
+        self.assertNotIn('f.torrent', serial)
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(self.read_torrents(2), serial)
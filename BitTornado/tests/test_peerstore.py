@@ -0,0 +1,337 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from BitTornado.Tracker.PeerStore import Peer, Swarm, PeerStore, NOCRYPTO, \
+    CRYPTO, ALL, PLAIN, TimingWheel, positions
+from BitTornado.Tracker.track import Tracker, defaults, compact_peer_info
+from BitTornado.clock import clock
+from BitTornado.Meta.bencode import bencode, bdecode
+
+
+def peerid(i):
+    return b'%020d' % i
+
+
+def addr(i):
+    return compact_peer_info('10.0.{}.{}'.format(i // 256, i % 256), 6881)
+
+
+class SwarmTests(unittest.TestCase):
+    def fill(self, swarm, n, **kwargs):
+        for i in range(n):
+            peer = Peer('10.0.0.1', 6881, i % 2, **kwargs)
+            swarm.add(peerid(i), peer)
+            swarm.list(peerid(i), peer, addr(i))
+
+    def check(self, swarm):
+        """Every listed peer is found at its recorded position"""
+        for pid, peer in swarm.items():
+            if peer.pos >= 0:
+                array = swarm._listing(pid, peer)
+                self.assertEqual(array.peerids[peer.pos], pid)
+                self.assertEqual(array.addr(peer.pos),
+                                 (peer.ip, 6881) if ':' in peer.ip
+                                 else addr(int(pid)))
+        nlisted = sum(len(array) for arrays in swarm.arrays + (
+            swarm.unpacked or []) for array in arrays)
+        self.assertEqual(nlisted, sum(peer.pos >= 0
+                                      for peer in swarm.peers.values()))
+
+    def test_remove(self):
+        swarm = Swarm()
+        self.fill(swarm, 100)
+        self.assertEqual(swarm.seeds, 50)
+        for i in range(0, 100, 3):
+            swarm.remove(peerid(i))
+            self.check(swarm)
+        self.assertEqual(len(swarm), 66)
+        self.assertEqual(swarm.seeds, 33)
+        swarm.unlist(peerid(1), swarm[peerid(1)])
+        self.assertIsNone(swarm.unlist(peerid(1), swarm[peerid(1)]))
+        self.check(swarm)
+
+    def test_set_left(self):
+        swarm = Swarm()
+        self.fill(swarm, 10)
+        for i in range(10):
+            swarm.set_left(peerid(i), swarm[peerid(i)], 0)
+            self.check(swarm)
+        self.assertEqual(swarm.seeds, 10)
+        self.assertEqual(len(swarm.arrays[PLAIN][1]), 10)
+        self.assertEqual(len(swarm.arrays[PLAIN][0]), 0)
+
+    def test_select(self):
+        swarm = Swarm()
+        self.fill(swarm, 40)
+        for i in range(40, 50):
+            peer = Peer('10.0.0.1', 6881, 1, 1, 1)
+            swarm.add(peerid(i), peer)
+            swarm.list(peerid(i), peer, addr(i))
+
+        picks = swarm.select(ALL, False, 20)
+        chosen = [(id(array), pos) for _, array, positions in picks
+                  for pos in positions]
+        self.assertEqual(len(set(chosen)), 20)
+        # 30 leechers, 20 seeds
+        self.assertEqual(sum(len(positions) for _, array, positions in picks
+                             if array is swarm.arrays[PLAIN][1]), 8)
+
+        # Seeds are only given leechers
+        peers, flags = swarm.compact(swarm.select(ALL, True, 100))
+        self.assertEqual(len(peers), 30 * 6)
+        self.assertEqual(flags.count(1), 10)
+        peers, flags = swarm.compact(swarm.select(NOCRYPTO, True, 100))
+        self.assertEqual(len(peers), 20 * 6)
+        peers, flags = swarm.compact(swarm.select(CRYPTO, False, 100))
+        self.assertEqual(flags, b'\x01' * 10)
+
+        expanded = swarm.expand(swarm.select(CRYPTO, False, 1))[0]
+        self.assertEqual(compact_peer_info(expanded['ip'], expanded['port']),
+                         addr(int(expanded['peer id'])))
+
+    def test_harvested(self):
+        swarm = Swarm()
+        self.fill(swarm, 2)
+        swarm.set_harvested([(peerid(0), '10.1.0.1', 6881),
+                             (peerid(5), '10.1.0.5', 6881),
+                             (peerid(6), 'example.com', 6881)],
+                            compact_peer_info)
+        self.assertEqual(len(swarm.harvested), 1)
+        self.assertEqual(len(swarm.expand(swarm.select(NOCRYPTO, True, 10))),
+                         2)
+        self.assertEqual(swarm.select(CRYPTO, True, 10), [])
+        # Host names are offered in non-compact responses
+        self.assertIn({'ip': 'example.com', 'port': 6881},
+                      swarm.expand(swarm.select(NOCRYPTO, True, 10,
+                                                unpacked=True),
+                                   peer_id=False))
+
+    def test_unpacked(self):
+        swarm = Swarm()
+        self.fill(swarm, 10)
+        for i in range(10, 20):
+            peer = Peer('2001:db8::{}'.format(i), 6881, i % 2)
+            swarm.add(peerid(i), peer)
+            swarm.list(peerid(i), peer, (peer.ip, 6881))
+        self.check(swarm)
+        for i in (10, 0, 13):
+            swarm.set_left(peerid(i), swarm[peerid(i)], 0)
+            self.check(swarm)
+        for i in (11, 1, 19, 12):
+            swarm.remove(peerid(i))
+            self.check(swarm)
+
+        self.assertEqual(len(swarm.compact(swarm.select(ALL, False, 20))[0]),
+                         9 * 6)
+        expanded = swarm.expand(swarm.select(ALL, False, 20, unpacked=True))
+        self.assertEqual(len(expanded), 16)
+        self.assertEqual(sorted(peer['ip'] for peer in expanded
+                                if ':' in peer['ip']),
+                         ['2001:db8::{}'.format(i)
+                          for i in (10, 13, 14, 15, 16, 17, 18)])
+        # Seeds are given only leechers
+        expanded = swarm.expand(swarm.select(ALL, True, 20, unpacked=True))
+        self.assertEqual(sorted(peer['ip'] for peer in expanded
+                                if ':' in peer['ip']),
+                         ['2001:db8::{}'.format(i) for i in (15, 17)])
+
+    def test_positions(self):
+        for total, count in ((100, 10), (100, 60), (5, 5)):
+            chosen = positions(total, count)
+            self.assertEqual(len(set(chosen)), count)
+            self.assertEqual(chosen, sorted(chosen))
+            self.assertTrue(all(0 <= pos < total for pos in chosen))
+
+    def test_state(self):
+        store = PeerStore()
+        self.fill(store.swarm(b'a' * 20), 4, key='k')
+        state = store.state()
+        self.assertEqual(state[b'a' * 20][peerid(1)],
+                         {'ip': '10.0.0.1', 'port': 6881, 'left': 1,
+                          'supportcrypto': 0, 'requirecrypto': 0,
+                          'key': 'k'})
+        peer = Peer.from_state(state[b'a' * 20][peerid(1)])
+        self.assertEqual((peer.key, peer.nat, peer.pos), ('k', None, -1))
+
+
+class FakeRawServer(object):
+    def add_task(self, func, delay=0, context=None):
+        pass
+
+
+class FakeT2TList(object):
+    def __init__(self, harvests):
+        self.harvests = harvests
+
+    def harvest(self, infohash):
+        return self.harvests.pop(0)
+
+
+class TrackerPeerTests(unittest.TestCase):
+    infohash = b'i' * 20
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {key: value for key, value, _ in defaults}
+        self.config.update(dfile=os.path.join(self.dir, 'dfile'),
+                           nat_check=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def announce(self, tracker, i, left, **params):
+        params.update(peer_id=peerid(i), port=str(6000 + i), left=str(left),
+                      ip='10.0.0.{}'.format(i + 1))
+        return tracker.add_data(self.infohash, params.pop('event', None),
+                                '127.0.0.1', {key: [value] for key, value
+                                              in params.items()})
+
+    def test_announce(self):
+        tracker = Tracker(self.config, FakeRawServer())
+        for i in range(10):
+            self.announce(tracker, i, i % 2, supportcrypto='1',
+                          requirecrypto='1' if i < 3 else '0')
+        self.announce(tracker, 10, 5, supportcrypto='0', requirecrypto='0')
+        swarm = tracker.downloads[self.infohash]
+        self.assertEqual(len(swarm), 11)
+        self.assertEqual(swarm.seeds, 5)
+
+        data = tracker.peerlist(self.infohash, False, False, False, 2, 50, 1)
+        self.assertEqual(len(data['peers']), 11 * 6)
+        self.assertEqual(data['crypto_flags'].count(1), 3)
+        data = tracker.peerlist(self.infohash, False, False, False, 0, 50, 0)
+        self.assertEqual(len(data['peers']), 8 * 6)
+
+        # A leecher becoming a seed, and a stopped peer
+        self.announce(tracker, 1, 0)
+        self.announce(tracker, 2, 0, event='stopped')
+        self.assertEqual((len(swarm), swarm.seeds), (10, 5))
+        data = tracker.peerlist(self.infohash, False, False, True, 2, 50, 1)
+        self.assertEqual(len(data['peers']), 5 * 6)
+
+        tracker.save_state()
+        tracker = Tracker(self.config, FakeRawServer())
+        swarm = tracker.downloads[self.infohash]
+        self.assertEqual((len(swarm), swarm.seeds), (10, 5))
+        data = tracker.peerlist(self.infohash, False, False, False, 2, 50, 1)
+        self.assertEqual(len(data['peers']), 10 * 6)
+
+        # Reloaded peers expire as if they had just announced
+        tracker.expire_downloaders()
+        self.assertEqual(len(swarm), 10)
+        self.assertEqual(tracker.downloads.expire(clock() + 3600), 10)
+        tracker.prevtime -= self.config['timeout_downloaders_interval']
+        tracker.expire_downloaders()
+        self.assertNotIn(self.infohash, tracker.downloads)
+
+    def test_unpacked(self):
+        tracker = Tracker(self.config, FakeRawServer())
+        self.announce(tracker, 0, 1)
+        tracker.add_data(self.infohash, None, '2001:db8::1',
+                         {'peer_id': [peerid(1)], 'port': ['6001'],
+                          'left': ['1']})
+        data = tracker.peerlist(self.infohash, False, False, False, 4, 50, 0)
+        self.assertEqual(sorted(peer['ip'] for peer in data['peers']),
+                         ['10.0.0.1', '2001:db8::1'])
+        data = tracker.peerlist(self.infohash, False, False, False, 0, 50, 0)
+        self.assertEqual(data['peers'], compact_peer_info('10.0.0.1', 6000))
+
+    def test_harvest(self):
+        tracker = Tracker(self.config, FakeRawServer())
+        harvests = [[(peerid(5), '10.1.0.5', 6881)], []]
+        tracker.t2tlist = FakeT2TList(harvests)
+        self.announce(tracker, 0, 1)
+        data = tracker.peerlist(self.infohash, False, False, False, 4, 50, 0)
+        self.assertEqual(len(data['peers']), 2)
+        # Peers harvested before are dropped when none are harvested
+        data = tracker.peerlist(self.infohash, False, False, False, 4, 50, 0)
+        self.assertEqual(len(data['peers']), 1)
+
+    def test_compact_response(self):
+        tracker = Tracker(self.config, FakeRawServer())
+        for i in range(30):
+            self.announce(tracker, i, i % 3, supportcrypto=str(i % 2),
+                          requirecrypto=str(int(i % 4 == 1)))
+        tracker.allowed = {self.infohash: {'warning message': 'careful'}}
+        for controls in (0, 1):
+            tracker.config['allowed_controls'] = controls
+            tracker.fragments.clear()
+            for args in ((False, False, 2, 20), (False, True, 1, 20),
+                         (False, False, 0, 50), (True, False, 2, 20),
+                         (False, False, 2, 0)):
+                for extras in ({}, {'scrape': {'complete': 1}, 'seeded': 1}):
+                    random.seed(1)
+                    data = tracker.peerlist(self.infohash, args[0], None,
+                                            *args[1:], supportcrypto=1)
+                    data = dict(data, **extras)
+                    random.seed(1)
+                    self.assertEqual(
+                        tracker.compact_response(self.infohash, *args,
+                                                 extras=extras),
+                        bencode(data))
+
+        # Fragments follow the numbers of seeds and leechers
+        self.announce(tracker, 0, 0, event='stopped')
+        self.assertEqual(bdecode(tracker.compact_response(
+            self.infohash, False, False, 0, 1, {}))['complete'], 9)
+
+
+class FakeConnection(object):
+    def get_ip(self):
+        return '127.0.0.1'
+
+
+class TrackerGetTests(unittest.TestCase):
+    def test_get(self):
+        config = {key: value for key, value, _ in defaults}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config.update(dfile=os.path.join(tmpdir, 'dfile'), nat_check=0)
+            tracker = Tracker(config, FakeRawServer())
+            for i in range(3):
+                code, _, _, ctext = tracker.get(
+                    FakeConnection(), '/announce?info_hash=%01%02%03%04%05'
+                    '%06%07%08%09%0A%0B%0C%0D%0E%0F%10%11%12%13%14&peer_id='
+                    '{:020d}&port={}&left={}&compact=1&supportcrypto=1'
+                    '&ip=10.0.0.{}'.format(i, 6881 + i, i, i + 1), {})
+            self.assertEqual(code, 200)
+            response = bdecode(ctext)
+            self.assertEqual(response['complete'], 1)
+            self.assertEqual(response['incomplete'], 2)
+            self.assertEqual(len(response['crypto_flags']), 3)
+            self.assertEqual(len(response['peers']), 3 * 6)
+
+
+class TimingWheelTests(unittest.TestCase):
+    def test_wheel(self):
+        wheel = TimingWheel(10)
+        wheel.add(b'a', b'1', 5)
+        wheel.add(b'a', b'2', 15)
+        wheel.add(b'b', b'3', 19)
+        wheel.move(b'a', b'2', 15, 18)
+        self.assertEqual(len(wheel.buckets), 2)
+        self.assertEqual(list(wheel.expire(19)), [(b'a', {b'1'})])
+        wheel.move(b'a', b'2', 18, 25)
+        wheel.remove(b'b', b'3', 19)
+        self.assertEqual(list(wheel.expire(25)), [])
+        self.assertEqual(list(wheel.expire(30)), [(b'a', {b'2'})])
+        self.assertEqual((wheel.buckets, wheel.oldest), ({}, None))
+
+    def test_store(self):
+        store = PeerStore(10)
+        for i in range(20):
+            peer = Peer('10.0.0.1', 6881, i % 2, time=i)
+            store.add(b'a' * 20, peerid(i), peer)
+            store.swarm(b'a' * 20).list(peerid(i), peer, addr(i))
+        for i in range(0, 10, 2):
+            store.touch(b'a' * 20, peerid(i), store[b'a' * 20][peerid(i)],
+                        12)
+        store.remove(b'a' * 20, peerid(1))
+        self.assertEqual(store.expire(10), 4)
+        self.assertEqual(sorted(store[b'a' * 20]),
+                         [peerid(i) for i in list(range(0, 10, 2)) +
+                          list(range(10, 20))])
+        self.assertEqual(store.expire(20), 15)
+        self.assertEqual(len(store[b'a' * 20].arrays[PLAIN][0]), 0)
@@ -0,0 +1,236 @@
+import random
+import unittest
+
+from BitTornado.Client.PiecePicker import PiecePicker
+from BitTornado.clock import clock
+from BitTornado.Types import Bitfield, TrueBitfield
+
+NUMPIECES = 203
+
+
+class PiecePickerTests(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.picker = PiecePicker(NUMPIECES)
+        self.peers = [Bitfield(NUMPIECES) for _ in range(8)]
+
+    def check_levels(self):
+        picker = self.picker
+        nlevels = len(picker.level_bits)
+        self.assertEqual(len(picker.level_ints), nlevels)
+        members = [set() for _ in range(nlevels)]
+        for piece in range(NUMPIECES):
+            if picker.superseed or not picker.has[piece] and \
+                    picker.priority[piece] >= 0:
+                members[picker.level_in_interests[piece]].add(piece)
+        self.assertEqual(picker.level_sizes, [len(level) for level in members])
+        for i, level in enumerate(members):
+            bits = Bitfield(NUMPIECES, bytes(picker.level_bits[i]))
+            self.assertEqual(set(bits.indices()), level - picker.bumped)
+            if picker.level_ints[i] is not None:
+                self.assertEqual(picker.level_ints[i], int(bits))
+
+    def got_have(self, peer, piece):
+        if not self.peers[peer][piece]:
+            self.peers[peer][piece] = True
+            self.picker.got_have(piece)
+
+    def lost_have(self, peer, piece):
+        if self.peers[peer][piece]:
+            self.peers[peer][piece] = False
+            self.picker.lost_have(piece)
+
+    def best_level(self, haves, wanted):
+        """Lowest level of interests of a piece haves has and is wanted"""
+        picker = self.picker
+        return min((picker.level_in_interests[i] for i in range(NUMPIECES)
+                    if haves[i] and i in wanted and not picker.has[i] and
+                    picker.priority[i] >= 0), default=None)
+
+    def test_levels(self):
+        picker = self.picker
+        for _ in range(2000):
+            op = random.randrange(6)
+            peer = random.randrange(len(self.peers))
+            piece = random.randrange(NUMPIECES)
+            if op < 2:
+                self.got_have(peer, piece)
+            elif op == 2:
+                self.lost_have(peer, piece)
+            elif op == 3 and not picker.has[piece] and \
+                    picker.priority[piece] >= 0:
+                picker.complete(piece)
+            elif op == 4:
+                picker.set_priority(piece, random.randrange(-1, 3))
+            elif op == 5 and not picker.has[piece] and \
+                    picker.priority[piece] >= 0:
+                picker.bump(piece)
+        self.check_levels()
+
+    def test_rarest(self):
+        picker = self.picker
+        for peer in range(len(self.peers)):
+            for piece in range(NUMPIECES):
+                if random.random() < 0.5:
+                    self.got_have(peer, piece)
+        for piece in random.sample(range(NUMPIECES), 50):
+            picker.complete(piece)
+        for piece in random.sample(range(NUMPIECES), 20):
+            picker.set_priority(piece, 2)
+        self.check_levels()
+
+        wanted = set(random.sample(range(NUMPIECES), 150))
+        for haves in self.peers:
+            for _ in range(10):
+                piece = picker.next(haves, wanted.__contains__)
+                self.assertTrue(haves[piece])
+                self.assertIn(piece, wanted)
+                self.assertEqual(picker.level_in_interests[piece],
+                                 self.best_level(haves, wanted))
+        self.assertIsNone(picker.next(Bitfield(NUMPIECES),
+                                      wanted.__contains__))
+        self.assertIsNone(picker.next(self.peers[0], lambda piece: False))
+        piece = picker.next(TrueBitfield(), wanted.__contains__)
+        self.assertEqual(picker.level_in_interests[piece],
+                         self.best_level(TrueBitfield(), wanted))
+
+    def test_spread(self):
+        # Pieces of a level are chosen among, not taken in order
+        chosen = {self.picker.next(TrueBitfield(), lambda piece: True)
+                  for _ in range(200)}
+        self.assertGreater(len(chosen), NUMPIECES // 4)
+
+    def test_bump(self):
+        picker = self.picker
+        for piece in range(NUMPIECES):
+            picker.bump(piece)
+            if piece != 17:
+                picker.complete(piece)
+        self.check_levels()
+        self.assertEqual(picker.next(TrueBitfield(), lambda piece: True), 17)
+        picker.bump(17)
+        # Bumped pieces move on as others do
+        self.got_have(0, 17)
+        self.assertEqual(picker.bumped, set())
+        self.check_levels()
+        self.assertEqual(picker.next(self.peers[0], lambda piece: True), 17)
+
+    def state(self, picker):
+        return (picker.totalcount, picker.numhaves, picker.crosscount,
+                picker.crosscount2, picker.level_in_interests,
+                picker.level_sizes,
+                [bytes(bits) for bits in picker.level_bits], picker.bumped,
+                getattr(picker, 'seed_got_haves', None))
+
+    def test_bitfield(self):
+        bulk = self.picker
+        single = PiecePicker(NUMPIECES)
+        bitfields = [Bitfield(NUMPIECES) for _ in range(6)]
+        for have in bitfields:
+            for piece in random.sample(range(NUMPIECES), NUMPIECES // 2):
+                have[piece] = True
+        for picker in (bulk, single):
+            for piece in range(0, NUMPIECES, 7):
+                picker.complete(piece)
+            for piece in range(1, NUMPIECES, 11):
+                picker.set_priority(piece, -1)
+            for piece in range(2, NUMPIECES, 13):
+                picker.set_priority(piece, 2)
+            for piece in range(3, NUMPIECES, 17):
+                if not picker.has[piece] and picker.priority[piece] >= 0:
+                    picker.bump(piece)
+        for have in bitfields:
+            bulk.got_bitfield(have)
+            for piece in have.indices():
+                single.got_have(piece)
+            self.assertEqual(self.state(bulk), self.state(single))
+        for have in bitfields[::2]:
+            bulk.lost_bitfield(have)
+            for piece in have.indices():
+                single.lost_have(piece)
+            self.assertEqual(self.state(bulk), self.state(single))
+        self.picker = bulk
+        self.check_levels()
+        bulk.got_bitfield(Bitfield(NUMPIECES))
+        self.assertEqual(self.state(bulk), self.state(single))
+
+    def test_superseed_bitfield(self):
+        bulk = self.picker
+        single = PiecePicker(NUMPIECES)
+        have = Bitfield(NUMPIECES)
+        for piece in random.sample(range(NUMPIECES), NUMPIECES // 3):
+            have[piece] = True
+        for picker in (bulk, single):
+            for piece in range(NUMPIECES):
+                picker.complete(piece)
+            picker.set_superseed()
+        bulk.got_bitfield(have)
+        for piece in have.indices():
+            single.got_have(piece)
+        self.assertEqual(self.state(bulk), self.state(single))
+        bulk.lost_bitfield(have)
+        for piece in have.indices():
+            single.lost_have(piece)
+        self.assertEqual(self.state(bulk), self.state(single))
+        self.check_levels()
+
+    def test_next_have(self):
+        picker = self.picker
+        for piece in range(NUMPIECES):
+            picker.complete(piece)
+        picker.set_superseed()
+        picker.seed_time = clock() - 20
+
+        class Upload(object):
+            super_seeding = True
+            was_ever_interested = True
+            skipped_count = 0
+
+        class Connection(object):
+            def __init__(self, have):
+                self.upload = Upload()
+                self.upload.seed_have_list = []
+                self.download = self
+                self.have = have
+
+            def get_ip(self):
+                return '10.0.0.1'
+
+        # Pieces fewer peers have are offered first
+        for have in self.peers[:4]:
+            for piece in range(NUMPIECES // 2):
+                have[piece] = True
+            picker.got_bitfield(have)
+        have = Bitfield(NUMPIECES)
+        for piece in range(0, NUMPIECES, 2):
+            have[piece] = True
+        piece = picker.next_have(Connection(have), True)
+        self.assertGreaterEqual(piece, NUMPIECES // 2)
+        self.assertFalse(have[piece])
+        self.assertEqual(picker.level_in_interests[piece],
+                         picker.priority_step + 1)
+        self.check_levels()
+
+    def test_deadlines(self):
+        picker = self.picker
+        picker.complete(5)
+        now = clock()
+        picker.set_deadlines({piece: now + piece - 10
+                              for piece in range(5, 40)}, 2)
+        self.assertNotIn(5, picker.deadlines)
+        self.assertEqual(picker.near_deadline(), list(range(6, 13)))
+        self.assertEqual(picker.next(TrueBitfield(), lambda piece: True), 6)
+        picker.set_priority(6, -1)
+        haves = self.peers[0]
+        for piece in (6, 7, 9, 100):
+            self.got_have(0, piece)
+        # Pieces are picked by deadline, among those the peer has
+        self.assertEqual(picker.next(haves, lambda piece: True), 7)
+        picker.complete(7)
+        self.assertNotIn(7, picker.near_deadline())
+        self.assertEqual(picker.next(haves, lambda piece: True), 9)
+        self.assertEqual(picker.next(haves, lambda piece: piece != 9), 100)
+        picker.set_deadlines({})
+        self.assertEqual(picker.near_deadline(), [])
+        self.assertIn(picker.next(haves, lambda piece: True), (9, 100))
+        self.check_levels()
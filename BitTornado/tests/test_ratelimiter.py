@@ -0,0 +1,157 @@
+import heapq
+import unittest
+from unittest import mock
+
+from BitTornado.Client.RateLimiter import RateLimiter, TokenBucket
+
+UNIT = 1000
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+        self.tasks = []
+        self.count = 0
+
+    def __call__(self):
+        return self.now
+
+    def sched(self, func, delay=0):
+        self.count += 1
+        heapq.heappush(self.tasks, (self.now + delay, self.count, func))
+
+    def run(self, until):
+        while self.tasks and self.tasks[0][0] <= until:
+            self.now, _, func = heapq.heappop(self.tasks)
+            func()
+        self.now = until
+
+
+class FakeConnection(object):
+    """Always has data to send"""
+    def __init__(self, rate_class, rate=0):
+        self.queued = False
+        self.upload_bucket = rate_class.peer_bucket(rate)
+        self.sent = 0
+
+    def send_partial(self, nbytes):
+        self.sent += nbytes
+        return nbytes
+
+    def backlogged(self):
+        return False
+
+
+class FakeDownload(object):
+    """Always wants to request more, a unit each time it is woken"""
+    def __init__(self, rate_class, rate=0):
+        self.rate_class = rate_class
+        self.bucket = TokenBucket(rate_class.down)
+        self.bucket.set_rate(rate * 1000)
+        self.received = 0
+
+    def admit(self):
+        self.bucket.spend(UNIT)
+        self.received += UNIT
+        self.rate_class.queue_download(self)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('BitTornado.Client.RateLimiter.clock',
+                             self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = RateLimiter(self.clock.sched, UNIT)
+
+    def test_buckets(self):
+        root = TokenBucket()
+        child = TokenBucket(root)
+        self.assertIsNone(child.credit(self.clock.now))
+        root.set_rate(1000)
+        child.set_rate(100)
+        self.clock.now += 0.2
+        self.assertAlmostEqual(child.credit(self.clock.now), 20)
+        child.spend(120)
+        self.assertTrue(child.in_debt(self.clock.now))
+        self.assertFalse(root.in_debt(self.clock.now))
+        self.assertAlmostEqual(child.delay(self.clock.now), 1)
+        # Credit saved up is limited to the burst
+        self.clock.now += 10
+        self.assertAlmostEqual(root.credit(self.clock.now),
+                               1000 * root.burst)
+
+    def send(self, connections, seconds):
+        for conn, rate_class in connections:
+            rate_class.queue(conn)
+        self.clock.run(self.clock.now + seconds)
+        return [conn.sent / seconds for conn, _ in connections]
+
+    def test_global(self):
+        self.limiter.set_upload_rate(100)
+        a = self.limiter.add_class()
+        b = self.limiter.add_class()
+        rates = self.send([(FakeConnection(a), a), (FakeConnection(a), a),
+                           (FakeConnection(b), b)], 20)
+        # Classes share the rate equally, and their connections theirs
+        self.assertAlmostEqual(sum(rates), 100000, delta=5000)
+        self.assertAlmostEqual(rates[0], rates[1], delta=UNIT)
+        self.assertAlmostEqual(rates[0] + rates[1], rates[2], delta=UNIT)
+
+    def test_class_limits(self):
+        self.limiter.set_upload_rate(100)
+        a = self.limiter.add_class()
+        a.set_upload_rate(20)
+        b = self.limiter.add_class()
+        c = self.limiter.add_class()
+        rates = self.send([(FakeConnection(a), a), (FakeConnection(b), b),
+                           (FakeConnection(c, 10), c),
+                           (FakeConnection(c), c)], 20)
+        self.assertAlmostEqual(rates[0], 20000, delta=2000)
+        self.assertAlmostEqual(rates[2], 10000, delta=1000)
+        # What limited classes and peers leave is shared by the rest
+        self.assertAlmostEqual(sum(rates), 100000, delta=5000)
+        self.assertAlmostEqual(rates[1], rates[2] + rates[3], delta=UNIT)
+
+    def test_priority(self):
+        self.limiter.set_upload_rate(100)
+        low = self.limiter.add_class()
+        high = self.limiter.add_class(1)
+        high.set_upload_rate(60)
+        rates = self.send([(FakeConnection(low), low),
+                           (FakeConnection(high), high)], 20)
+        self.assertAlmostEqual(rates[1], 60000, delta=3000)
+        self.assertAlmostEqual(rates[0], 40000, delta=3000)
+        # Higher priorities take all they can
+        high.set_upload_rate(0)
+        rates = self.send([(FakeConnection(low), low),
+                           (FakeConnection(high), high)], 20)
+        self.assertLess(rates[0], UNIT)
+
+    def test_done(self):
+        a = self.limiter.add_class()
+        conn = FakeConnection(a)
+        conn.send_partial = lambda nbytes: 0
+        a.queue(conn)
+        self.assertFalse(conn.queued)
+        self.assertFalse(a.queued)
+
+    def download(self, downloads, seconds):
+        for download in downloads:
+            download.rate_class.queue_download(download)
+        self.clock.run(self.clock.now + seconds)
+        return [download.received / seconds for download in downloads]
+
+    def test_download_turns(self):
+        self.limiter.set_download_rate(100)
+        low = self.limiter.add_class()
+        high = self.limiter.add_class(1)
+        high.set_download_rate(60)
+        rates = self.download([FakeDownload(low), FakeDownload(low),
+                               FakeDownload(low, 10), FakeDownload(high)], 20)
+        # Held back downloads are woken by class priority, then in turn
+        self.assertAlmostEqual(rates[3], 60000, delta=3000)
+        self.assertAlmostEqual(rates[2], 10000, delta=1000)
+        self.assertAlmostEqual(sum(rates), 100000, delta=5000)
+        self.assertAlmostEqual(rates[0], rates[1], delta=UNIT)
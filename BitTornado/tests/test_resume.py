@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from BitTornado.Meta.bencode import bencode, bdecode
+from BitTornado.Storage.Storage import Storage
+from BitTornado.Storage.FileSelector import FileSelector, record_checksum
+
+
+class FakeStorageWrapper(object):
+    """Records what FileSelector restores; pieces it is not given are
+    hashed again"""
+    def __init__(self):
+        self.restored = None
+
+    def pickle(self):
+        return {'pieces': b'\xff', 'places': [], 'partials': []}
+
+    def reblock(self, blocked):
+        pass
+
+    def unpickle(self, data, valid_places):
+        self.restored = valid_places
+        return []
+
+
+class ResumeRecordTests(unittest.TestCase):
+    piece_length = 1024
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for name, length in (('a', 3000), ('b', 5000)):
+            fname = os.path.join(self.dir, name)
+            with open(fname, 'wb') as fileh:
+                fileh.write(os.urandom(length))
+            self.files.append((fname, length))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def storage(self):
+        config = {'max_files_open': 0, 'lock_files': False}
+        return Storage(self.files, self.piece_length, threading.Event(),
+                       config)
+
+    def test_unchanged(self):
+        record = bdecode(bencode(self.storage().pickle()))
+        self.assertEqual(len(record['file stats']), 8)
+        self.assertEqual(self.storage().unpickle(record), set(range(8)))
+
+    def test_modified(self):
+        record = bdecode(bencode(self.storage().pickle()))
+        # Same size, and mtime moved by less than the old one second margin
+        fname = self.files[1][0]
+        with open(fname, 'r+b') as fileh:
+            fileh.write(b'x')
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, record['file stats'][6] + 1000))
+
+        # Pieces 2-7 touch the second file and must be checked again
+        self.assertEqual(self.storage().unpickle(record), {0, 1})
+        # Without exact stats, the change goes unnoticed
+        del record['file stats']
+        self.assertEqual(self.storage().unpickle(record), set(range(8)))
+
+    def test_checksum(self):
+        record = {'priority': [1, 1], 'pieces': b'\xff\xc0'}
+        record['checksum'] = record_checksum(record)
+        decoded = bdecode(bencode(record))
+        self.assertEqual(record_checksum(decoded), decoded['checksum'])
+
+        decoded['priority'] = [1, -1]
+        self.assertNotEqual(record_checksum(decoded), decoded['checksum'])
+
+    def selector(self):
+        wrapper = FakeStorageWrapper()
+        return FileSelector(self.files, self.piece_length, None,
+                            self.storage(), wrapper, None, None), wrapper
+
+    def test_tampered(self):
+        record = bdecode(bencode(self.selector()[0].pickle()))
+        selector, wrapper = self.selector()
+        selector.unpickle(record)
+        self.assertEqual(wrapper.restored, set(range(8)))
+
+        # A record altered after it was saved restores nothing, leaving
+        # every piece to be hashed
+        record['pieces'] = b'\xfe'
+        selector, wrapper = self.selector()
+        selector.unpickle(record)
+        self.assertIsNone(wrapper.restored)
+        self.assertIsNone(selector.new_partials)
@@ -1,6 +1,8 @@
+import socket
 import unittest
 
 from BitTornado.Network.selectpoll import remove, insert
+from BitTornado.Network import selectorspoll
 
 
 class PollListTests(unittest.TestCase):
@@ -53,5 +55,48 @@ class PollListTests(unittest.TestCase):
         insert(x, 3)
         self.assertEqual(x, [3])
 
+
+class SelectorsPollTests(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.poll = selectorspoll.poll()
+
+    def tearDown(self):
+        self.poll.close()
+        self.a.close()
+        self.b.close()
+
+    def test_events(self):
+        POLLIN, POLLOUT = selectorspoll.POLLIN, selectorspoll.POLLOUT
+        fd = self.a.fileno()
+        self.poll.register(self.a, POLLIN)
+        self.assertEqual(self.poll.poll(0), [])
+        self.b.send(b'x')
+        self.assertEqual(self.poll.poll(1000), [(fd, POLLIN)])
+        self.poll.register(fd, POLLIN | POLLOUT)
+        self.assertEqual(self.poll.poll(0), [(fd, POLLIN | POLLOUT)])
+        self.poll.unregister(self.a)
+        self.assertEqual(self.poll.poll(0), [])
+        self.assertEqual(self.poll.masks, {})
+
+    def test_unchanged_register(self):
+        class CountingSelector(object):
+            def __init__(self):
+                self.calls = 0
+
+            def register(self, f, events):
+                self.calls += 1
+
+            modify = unregister = register
+
+        selector = CountingSelector()
+        poll = selectorspoll.poll(selector)
+        for _ in range(3):
+            poll.register(self.a, selectorspoll.POLLIN)
+        self.assertEqual(selector.calls, 1)
+        poll.register(self.a, selectorspoll.POLLIN | selectorspoll.POLLOUT)
+        poll.register(self.a, selectorspoll.POLLIN | selectorspoll.POLLOUT)
+        self.assertEqual(selector.calls, 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,182 @@
+import os
+import struct
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+from BitTornado.Meta.bencode import bdecode
+from BitTornado.Tracker.Shards import ShardServer, ShardRouter, \
+    ShardUDPHandler, FrameReader, frame, shard_of, split_state, merge_states
+from BitTornado.Tracker.track import Tracker, TrackerState, defaults, \
+    infopage, shard_dfiles, merge_dfiles
+from BitTornado.Tracker.UDPHandler import PROTOCOL_ID, CONNECT, ANNOUNCE, \
+    SCRAPE
+from BitTornado.tests.test_udptracker import FakeSocket, announce_request
+
+NSHARDS = 3
+
+
+class FakeRawServer(object):
+    def __init__(self):
+        self.doneflag = threading.Event()
+
+    def add_task(self, func, delay=0, context=None):
+        pass
+
+    def adopt_connection(self, server, handler):
+        """Connect handler directly to a ShardServer"""
+        return Link(handler, server)
+
+
+class Link(object):
+    """Delivers writes to a handler at the other end, as a socket pair"""
+    def __init__(self, handler, peer_handler, peer=None):
+        self.peer = peer or Link(peer_handler, handler, self)
+        self.handler = peer_handler
+
+    def write(self, data):
+        # Split messages, as streams may
+        for i in range(0, len(data), 7):
+            self.handler.data_came_in(self.peer, data[i:i + 7])
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.answers = []
+
+    def get_ip(self):
+        return '127.0.0.1'
+
+    def answer(self, response):
+        self.answers.append(response)
+
+
+def infohash(i):
+    return bytes([i]) * 20
+
+
+class ShardStateTests(unittest.TestCase):
+    def test_frames(self):
+        reader = FrameReader()
+        data = frame(('get', '1.2.3.4', b'\x00', {'a': 1})) + frame((True,))
+        self.assertEqual(reader.feed(data[:5]), [])
+        self.assertEqual(reader.feed(data[5:]),
+                         [('get', '1.2.3.4', b'\x00', {'a': 1}), (True,)])
+
+    def test_split_merge(self):
+        state = {'peers': {infohash(i): {b'p' * 20: {'ip': '10.0.0.1'}}
+                           for i in range(10)},
+                 'completed': {infohash(i): i for i in range(10)},
+                 'allowed': {infohash(1): {}}}
+        states = split_state(state, NSHARDS)
+        for i, shard in enumerate(states):
+            self.assertEqual(shard['allowed'], state['allowed'])
+            self.assertTrue(all(shard_of(ih, NSHARDS) == i
+                                for ih in shard['peers']))
+        self.assertEqual(merge_states(states), state)
+
+    def test_dfiles(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dfile = os.path.join(tmpdir, 'dfile')
+            TrackerState({'completed': {infohash(i): i
+                                        for i in range(10)}}).write(dfile)
+            dfiles = shard_dfiles(dfile, NSHARDS)
+            self.assertEqual(len(dfiles), NSHARDS)
+            self.assertEqual(sum(len(TrackerState.read(path)['completed'])
+                                 for path in dfiles), 10)
+            # Shard dfiles left behind are merged and divided again
+            self.assertEqual(shard_dfiles(dfile, 2), dfiles[:2])
+            self.assertFalse(os.path.exists(dfiles[2]))
+            merge_dfiles(dfiles[:2], dfile)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['dfile'])
+            self.assertEqual(TrackerState.read(dfile)['completed'],
+                             {infohash(i): i for i in range(10)})
+
+
+class ShardRouterTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {key: value for key, value, _ in defaults}
+        self.config.update(nat_check=0)
+        self.trackers = []
+        servers = []
+        for i in range(NSHARDS):
+            config = dict(self.config, dfile=os.path.join(self.dir.name,
+                                                          'dfile.%d' % i))
+            tracker = Tracker(config, FakeRawServer())
+            self.trackers.append(tracker)
+            servers.append(ShardServer(tracker, threading.Event()))
+        self.router = ShardRouter(
+            self.config, FakeRawServer(), servers,
+            lambda rows: infopage(self.config, False, rows))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def get(self, path):
+        connection = FakeConnection()
+        self.assertIsNone(self.router.get(connection, path, {}))
+        response, = connection.answers
+        return response
+
+    def announce(self, i, peer, left):
+        return self.get('/announce?' + urllib.parse.urlencode({
+            'info_hash': infohash(i), 'peer_id': b'%020d' % peer,
+            'port': 6881, 'left': left, 'compact': 1,
+            'ip': '10.0.0.%d' % (peer + 1)}))
+
+    def test_announce(self):
+        for i in range(6):
+            for peer in range(i + 1):
+                code, _, _, ctext = self.announce(i, peer, peer % 2)
+            self.assertEqual(code, 200)
+            self.assertEqual(bdecode(ctext)['complete'], i // 2 + 1)
+            tracker = self.trackers[shard_of(infohash(i), NSHARDS)]
+            self.assertEqual(len(tracker.downloads[infohash(i)]), i + 1)
+        self.assertEqual(sum(len(tracker.downloads)
+                             for tracker in self.trackers), 6)
+        # Errors are the shard's to report
+        self.assertEqual(self.get('/announce?info_hash=x')[0], 400)
+        self.assertEqual(self.get('/nothing')[0], 404)
+
+    def test_scrape(self):
+        for i in range(6):
+            self.announce(i, 0, 0)
+        files = bdecode(self.get('/scrape')[3])['files']
+        self.assertEqual(len(files), 6)
+        query = '&'.join('info_hash=' + urllib.parse.quote(infohash(i))
+                         for i in (1, 2, 3, 7))
+        files = bdecode(self.get('/scrape?' + query)[3])['files']
+        self.assertEqual(len(files), 3)
+        self.assertEqual(infopage(self.config, False,
+                                  self.trackers[0].infopage_rows)[0], 200)
+        self.assertEqual(self.get('/')[3].count(b'<tr>'), 6 + 2)
+
+        for tracker in self.trackers:
+            tracker.config['scrape_allowed'] = 'specific'
+        self.config['scrape_allowed'] = 'specific'
+        self.assertEqual(self.get('/scrape')[0], 400)
+        # Shards refusing the client are answered for by the first
+        for tracker in self.trackers:
+            tracker.banned_IPs = {'127.0.0.1'}
+        self.assertEqual(self.get('/scrape?' + query)[0], 400)
+
+    def test_udp(self):
+        handler = ShardUDPHandler(self.router)
+        socket = FakeSocket()
+        addr = ('127.0.0.1', 5000)
+        handler.datagram_received(
+            socket, struct.pack('>QII', PROTOCOL_ID, CONNECT, 1), addr)
+        connid = struct.unpack('>IIQ', socket.sent.pop()[0])[2]
+        for i in range(4):
+            handler.datagram_received(
+                socket, announce_request(connid, i, infohash(i), i, 0), addr)
+            self.assertEqual(struct.unpack_from('>IIIII',
+                                                socket.sent.pop()[0]),
+                             (ANNOUNCE, i, 1800, 0, 1))
+        handler.datagram_received(
+            socket, struct.pack('>QII', connid, SCRAPE, 9) + infohash(3) +
+            infohash(9) + infohash(0), addr)
+        self.assertEqual(struct.unpack('>11I', socket.sent.pop()[0]),
+                         (SCRAPE, 9, 1, 0, 0, 0, 0, 0, 1, 0, 0))
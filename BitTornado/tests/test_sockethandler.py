@@ -0,0 +1,89 @@
+import socket
+import select
+import tempfile
+import unittest
+
+from BitTornado.Network.SocketHandler import SocketHandler, SingleSocket, \
+    FileSlice, POLLIN, HAVE_SENDFILE
+
+
+class NullHandler(object):
+    def connection_flushed(self, s):
+        pass
+
+
+class SingleSocketWriteTests(unittest.TestCase):
+    def setUp(self):
+        self.handler = SocketHandler(300, False)
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        a = socket.create_connection(listener.getsockname())
+        self.peer, _ = listener.accept()
+        listener.close()
+        a.setblocking(0)
+        a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.handler.poll.register(a, POLLIN)
+        self.ss = SingleSocket(self.handler, a, NullHandler())
+        self.handler.single_sockets[self.ss.fileno] = self.ss
+        self.ss.connected = True
+
+    def tearDown(self):
+        self.ss.close()
+        self.peer.close()
+
+    def drain(self, expected):
+        received = bytearray()
+        while len(received) < expected:
+            # Only write when writable, as after a POLLOUT event
+            wlist = [] if self.ss.is_flushed() else [self.ss.socket]
+            r, w, _ = select.select([self.peer], wlist, [], 1)
+            if not (r or w):
+                break
+            if r:
+                received += self.peer.recv(65536)
+            if w:
+                self.ss.try_write()
+        return bytes(received)
+
+    def test_gather(self):
+        messages = [bytes([i % 256]) * (100 + i) for i in range(200)]
+        self.ss.buffer.extend(messages)
+        self.ss.try_write()
+        data = b''.join(messages)
+        self.assertEqual(self.drain(len(data)), data)
+        self.assertTrue(self.ss.is_flushed())
+        self.assertEqual(self.ss.offset, 0)
+        self.assertEqual(self.handler.bytes_sent, len(data))
+        self.assertLess(self.handler.send_calls, len(messages))
+
+    def test_partial(self):
+        big = bytes(range(256)) * 1024
+        for _ in range(4):
+            self.ss.write(big)
+        self.ss.write(b'tail')
+        self.assertFalse(self.ss.is_flushed())
+        self.assertEqual(self.drain(4 * len(big) + 4), big * 4 + b'tail')
+        self.assertTrue(self.ss.is_flushed())
+
+    @unittest.skipUnless(HAVE_SENDFILE, 'os.sendfile not available')
+    def test_sendfile(self):
+        content = bytes(range(256)) * 2048
+        with tempfile.TemporaryFile() as fileh:
+            fileh.write(content)
+            fileh.flush()
+            whole = FileSlice(fileh, 1000, 300000)
+            self.assertEqual(len(whole[:100]), 100)
+            self.assertEqual(whole[100:].offset, 1100)
+
+            self.ss.write(b'head')
+            self.ss.write(whole[:100000])
+            self.ss.write(whole[100000:])
+            self.ss.write(b'tail')
+            expected = b'head' + content[1000:301000] + b'tail'
+            self.assertEqual(self.drain(len(expected)), expected)
+        self.assertTrue(self.ss.is_flushed())
+        self.assertEqual(self.handler.bytes_sent, len(expected))
+
+if __name__ == '__main__':
+    unittest.main()
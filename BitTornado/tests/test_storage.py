@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from BitTornado.Storage.Storage import Storage
+
+
+class MappedReadTests(unittest.TestCase):
+    piece_length = 1024
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(6000)
+        self.files = []
+        pos = 0
+        for name, length in (('a', 3000), ('b', 1000), ('c', 2000)):
+            fname = os.path.join(self.dir, name)
+            with open(fname, 'wb') as fileh:
+                fileh.write(self.data[pos:pos + length])
+            self.files.append((fname, length))
+            pos += length
+        config = {'max_files_open': 2, 'lock_files': False}
+        self.storage = Storage(self.files, self.piece_length,
+                               threading.Event(), config)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        view = self.storage.read_mapped(1024, 1024)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, self.data[1024:2048])
+        # Spanning all three files
+        view = self.storage.read_mapped(2048, 3000)
+        self.assertEqual(view, self.data[2048:5048])
+        self.assertEqual(self.storage.read_mapped(0, 6000), self.data)
+
+    def test_handle_budget(self):
+        self.storage.read_mapped(0, 6000)
+        self.assertEqual(list(self.storage.maps),
+                         [fname for fname, _ in self.files[1:]])
+
+    def test_shared_budget(self):
+        storage = self.storage
+        # Handles, maps and readers are closed least recently used first,
+        # whatever their kind, to keep within max_files_open between them
+        storage.read(0, 100)
+        storage.read_mapped(3000, 100)
+        self.assertEqual(len(storage.handles) + len(storage.maps), 2)
+        regions = storage.locate(4000, 100)
+        self.assertEqual(list(storage.opened),
+                         [('map', self.files[1][0]),
+                          ('reader', self.files[2][0])])
+        self.assertEqual(storage.handles, {})
+        storage.write(0, b'x')
+        self.assertEqual(list(storage.opened),
+                         [('reader', self.files[2][0]),
+                          ('handle', self.files[0][0])])
+        self.assertEqual(storage.maps, {})
+        # Regions located keep their files open until sent
+        reader, offset, length = regions[0]
+        self.assertEqual(os.pread(reader.fileno(), length, offset),
+                         self.data[4000:4100])
+
+    def test_views_outlive_mappings(self):
+        view = self.storage.read_mapped(0, 100)
+        self.storage.read_mapped(3000, 3000)
+        self.assertNotIn(self.files[0][0], self.storage.maps)
+        self.assertEqual(view, self.data[:100])
+        self.storage.close()
+        self.assertEqual(view, self.data[:100])
+
+    def test_write(self):
+        self.assertEqual(self.storage.read_mapped(0, 10), self.data[:10])
+        self.storage.write(5, b'x' * 10)
+        self.assertEqual(self.storage.read_mapped(0, 20),
+                         self.data[:5] + b'x' * 10 + self.data[15:20])
+
+    def test_short_file(self):
+        with open(self.files[2][0], 'r+b') as fileh:
+            fileh.truncate(1000)
+        with self.assertRaises(IOError):
+            self.storage.read_mapped(4000, 2000)
@@ -0,0 +1,78 @@
+import unittest
+
+from BitTornado.Network.RawServer import Task, TaskQueue
+
+
+class TaskQueueTests(unittest.TestCase):
+    def test_order(self):
+        q = TaskQueue()
+        for when in (3, 1, 2, 1):
+            q.push(Task(when), when)
+        self.assertEqual(q.next_time(), 1)
+        self.assertIsNone(q.pop_due(0))
+        order = []
+        while True:
+            task = q.pop_due(5)
+            if task is None:
+                break
+            order.append(task.func)
+        self.assertEqual(order, [1, 1, 2, 3])
+        self.assertEqual(len(q), 0)
+        self.assertIsNone(q.next_time())
+
+    def test_fifo(self):
+        q = TaskQueue()
+        tasks = [Task(i) for i in range(5)]
+        for task in tasks:
+            q.push(task, 1)
+        self.assertEqual([q.pop_due(1) for _ in range(5)], tasks)
+
+    def test_cancel(self):
+        q = TaskQueue()
+        a, b, c = Task('a'), Task('b'), Task('c')
+        q.push(a, 1)
+        q.push(b, 2)
+        q.push(c, 3)
+        a.cancel()
+        c.cancel()
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.next_time(), 2)
+        self.assertIs(q.pop_due(5), b)
+        self.assertIsNone(q.pop_due(5))
+        self.assertEqual(q.heap, [])
+
+    def test_compact(self):
+        q = TaskQueue()
+        tasks = [Task(i) for i in range(10)]
+        for i, task in enumerate(tasks):
+            q.push(task, 1000 + i)
+        # Tasks cancelled directly, never reaching the head, are dropped
+        # once they outnumber the live ones
+        for task in tasks[5:]:
+            task.cancel()
+        self.assertEqual(len(q.heap), 10)
+        tasks[4].cancel()
+        self.assertEqual(len(q.heap), 4)
+        self.assertEqual(q.dead, 0)
+        self.assertEqual(len(q), 4)
+        self.assertIsNone(tasks[9].queue)
+
+    def test_kill(self):
+        q = TaskQueue()
+        tasks = [Task(i, tid='x' if i % 2 else None) for i in range(10)]
+        for i, task in enumerate(tasks):
+            q.push(task, i)
+        q.kill('x')
+        self.assertEqual(len(q), 5)
+        self.assertNotIn('x', q.bytid)
+        self.assertEqual([q.pop_due(10).func for _ in range(5)],
+                         [0, 2, 4, 6, 8])
+        self.assertIsNone(q.pop_due(10))
+
+        # Tasks scheduled after a kill are unaffected
+        q.push(Task('y', tid='x'), 0)
+        self.assertEqual(q.pop_due(0).func, 'y')
+        self.assertEqual(q.bytid, {})
+
+if __name__ == '__main__':
+    unittest.main()
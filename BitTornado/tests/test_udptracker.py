@@ -0,0 +1,175 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from BitTornado.Network.SocketHandler import SocketHandler
+from BitTornado.Network.AsyncRawServer import AsyncRawServer
+from BitTornado.Tracker.track import Tracker, defaults
+from BitTornado.Tracker.UDPHandler import UDPHandler, PROTOCOL_ID, \
+    CONNECT, ANNOUNCE, SCRAPE, ERROR
+
+
+class FakeRawServer(object):
+    def add_task(self, func, delay=0, context=None):
+        pass
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((bytes(data), addr))
+
+
+def announce_request(connid, tx, infohash, i, left, event=0, numwant=-1):
+    return struct.pack('>QII20s20sQqQIIIiH', connid, ANNOUNCE, tx, infohash,
+                       b'%020d' % i, 0, left, 0, event,
+                       0x0a000001 + i, i, numwant, 6881 + i)
+
+
+class UDPHandlerTests(unittest.TestCase):
+    infohash = b'i' * 20
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {key: value for key, value, _ in defaults}
+        self.config.update(dfile=os.path.join(self.dir.name, 'dfile'),
+                           nat_check=0)
+        self.tracker = Tracker(self.config, FakeRawServer())
+        self.handler = UDPHandler(self.tracker)
+        self.socket = FakeSocket()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def request(self, data, addr=('127.0.0.1', 5000)):
+        self.handler.datagram_received(self.socket, memoryview(data), addr)
+        return self.socket.sent.pop()[0] if self.socket.sent else None
+
+    def connect(self, addr=('127.0.0.1', 5000)):
+        reply = self.request(struct.pack('>QII', PROTOCOL_ID, CONNECT, 7),
+                             addr)
+        action, tx, connid = struct.unpack('>IIQ', reply)
+        self.assertEqual((action, tx), (CONNECT, 7))
+        return connid
+
+    def test_announce(self):
+        connid = self.connect()
+        for i in range(5):
+            reply = self.request(announce_request(connid, i, self.infohash,
+                                                  i, i % 2, event=2))
+            action, tx, interval, leechers, seeds = \
+                struct.unpack_from('>IIIII', reply)
+            self.assertEqual((action, tx), (ANNOUNCE, i))
+            self.assertEqual(interval, self.tracker.reannounce_interval)
+            self.assertEqual((leechers, seeds), ((i + 1) // 2, i // 2 + 1))
+            # Seeds are only given leechers
+            self.assertEqual(len(reply) - 20,
+                             6 * (leechers if i % 2 == 0 else i + 1))
+        swarm = self.tracker.downloads[self.infohash]
+        self.assertEqual(swarm[b'%020d' % 3].key, '00000003')
+        self.assertEqual(swarm[b'%020d' % 3].given_ip, '10.0.0.4')
+
+        reply = self.request(announce_request(connid, 9, self.infohash, 4,
+                                              0, numwant=2))
+        self.assertEqual(len(reply) - 20, 2 * 6)
+        reply = self.request(announce_request(connid, 9, self.infohash, 4,
+                                              0, event=3))
+        self.assertEqual(len(reply), 20)
+        self.assertEqual(len(swarm), 4)
+
+    def test_scrape(self):
+        connid = self.connect()
+        for i in range(3):
+            self.request(announce_request(connid, i, self.infohash, i, i))
+        reply = self.request(struct.pack('>QII', connid, SCRAPE, 3) +
+                             self.infohash + b'u' * 20)
+        self.assertEqual(struct.unpack('>IIIIIIII', reply),
+                         (SCRAPE, 3, 1, 0, 2, 0, 0, 0))
+
+        self.tracker.config['scrape_allowed'] = 'none'
+        reply = self.request(struct.pack('>QII', connid, SCRAPE, 4) +
+                             self.infohash)
+        self.assertEqual(struct.unpack_from('>II', reply), (ERROR, 4))
+
+    def test_errors(self):
+        connid = self.connect()
+        # Connection IDs are tied to the client address
+        reply = self.request(announce_request(connid, 1, self.infohash, 1,
+                                              0), ('127.0.0.1', 5001))
+        self.assertEqual(reply, struct.pack('>II', ERROR, 1) +
+                         b'invalid connection id')
+        self.assertEqual(self.connect(('127.0.0.1', 5000)), connid)
+
+        reply = self.request(announce_request(connid, 2, self.infohash, 1,
+                                              0, event=7))
+        self.assertEqual(reply[8:], b'invalid event')
+        reply = self.request(announce_request(connid, 3, self.infohash, 1,
+                                              0)[:50])
+        self.assertEqual(reply[:8], struct.pack('>II', ERROR, 3))
+
+        self.tracker.allowed = {}
+        reply = self.request(announce_request(connid, 4, self.infohash, 1,
+                                              0))
+        self.assertEqual(reply[8:], b'Requested download is not '
+                         b'authorized for use with this tracker.')
+
+        # Malformed connects and unknown actions are ignored
+        self.assertIsNone(self.request(struct.pack('>QII', 0, CONNECT, 5)))
+        self.assertIsNone(self.request(struct.pack('>QII', connid, 9, 5)))
+        self.assertIsNone(self.request(b'short'))
+
+
+class EchoHandler(object):
+    def datagram_received(self, socket, data, addr):
+        socket.sendto(bytes(data).upper(), addr)
+
+
+class DatagramTests(unittest.TestCase):
+    def setUp(self):
+        self.client = socket.socket(type=socket.SOCK_DGRAM)
+        self.client.settimeout(5)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_sockethandler(self):
+        handler = SocketHandler(300, False)
+        handler.bind_udp(0, EchoHandler(), '127.0.0.1')
+        dsock, = handler.datagrams.values()
+        for i in range(3):
+            self.client.sendto(b'ping %d' % i, dsock.socket.getsockname())
+        received = []
+        while len(received) < 3:
+            handler.handle_events(handler.do_poll(1))
+            self.client.settimeout(0.1)
+            try:
+                while True:
+                    received.append(self.client.recv(100))
+            except socket.timeout:
+                pass
+        self.assertEqual(received, [b'PING 0', b'PING 1', b'PING 2'])
+        handler.shutdown()
+
+    def test_asyncrawserver(self):
+        doneflag = threading.Event()
+        server = AsyncRawServer(doneflag, 60, 300, ipv6_enable=False)
+        server.bind_udp(0, EchoHandler(), '127.0.0.1')
+        dsock, = server.sockethandler.datagrams.values()
+        addr = dsock.socket.getsockname()
+        received = []
+
+        def ping():
+            self.client.sendto(b'ping', addr)
+            received.append(self.client.recv(100))
+            doneflag.set()
+
+        server.add_task(lambda: threading.Thread(target=ping).start())
+        server.add_task(doneflag.set, 5)
+        server.listen_forever(None)
+        server.shutdown()
+        self.assertEqual(received, [b'PING'])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare announce responses spliced from cached fragments with the former
+dictionary encoding.
+
+Fills a tracker with peers over a few torrents, then times building
+compact responses alone and whole announces through Tracker.get, once
+splicing sampled peers between pre-encoded fragments and once filling a
+CompactResponse from peerlist and bencoding it, as before.
+
+Usage: bench_announce.py [peers per torrent] [announces]"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import urllib.parse
+
+from BitTornado.Meta.bencode import bencode
+from BitTornado.Tracker.track import Tracker, defaults
+
+NTORRENTS = 10
+
+
+class RawServer(object):
+    def add_task(self, func, delay=0, context=None):
+        pass
+
+
+class Connection(object):
+    def get_ip(self):
+        return '127.0.0.1'
+
+
+def legacy_response(tracker):
+    """Tracker.compact_response in terms of peerlist, as get encoded
+    compact responses before"""
+    def compact_response(infohash, stopped, is_seed, return_type, rsize,
+                         extras):
+        data = tracker.peerlist(infohash, stopped, None, is_seed,
+                                return_type, rsize, return_type == 2)
+        data.update(extras)
+        ctext = bytearray()
+        bencode.encode(data, ctext)
+        return ctext
+    return compact_response
+
+
+def announce_path(torrent, peer, left):
+    return '/announce?' + urllib.parse.urlencode({
+        'info_hash': b'%020d' % torrent, 'peer_id': b'%020d' % peer,
+        'port': 6881 + peer % 1000, 'left': left, 'compact': 1,
+        'supportcrypto': 1, 'uploaded': 0, 'downloaded': 0,
+        'ip': '10.{}.{}.{}'.format(peer >> 16, (peer >> 8) & 255,
+                                   peer & 255)})
+
+
+def main(argv):
+    npeers = int(argv[0]) if argv else 2000
+    nannounces = int(argv[1]) if len(argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    config = {key: value for key, value, _ in defaults}
+    config.update(dfile=os.path.join(directory, 'dfile'), nat_check=0)
+    try:
+        tracker = Tracker(config, RawServer())
+    finally:
+        shutil.rmtree(directory)
+    connection = Connection()
+    paths = [announce_path(i % NTORRENTS, i, (i % 3) * 1000)
+             for i in range(NTORRENTS * npeers)]
+    for path in paths:
+        tracker.get(connection, path, {})
+    infohashes = [b'%020d' % i for i in range(NTORRENTS)]
+
+    print('{} torrents of {} peers'.format(NTORRENTS, npeers))
+    print('{:>10} {:>14} {:>14}'.format('responses', 'built/s',
+                                        'announces/s'))
+    for name in ('dict', 'fragments'):
+        if name == 'dict':
+            tracker.compact_response = legacy_response(tracker)
+        else:
+            del tracker.compact_response
+        start = time.perf_counter()
+        for i in range(nannounces):
+            tracker.compact_response(infohashes[i % NTORRENTS], False,
+                                     False, 2, 50, {})
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(nannounces):
+            tracker.get(connection, paths[i % len(paths)], {})
+        announced = time.perf_counter() - start
+        print('{:>10} {:>14.0f} {:>14.0f}'.format(
+            name, nannounces / built, nannounces / announced))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Compare bdecode with the iterative fast_bdecode, and bencode with the
+former list-joining encoder.
+
+Decodes synthetic documents of the kinds BitTornado reads in bulk: a
+multi-file .torrent with a large pieces string, a compact tracker response,
+and a tracker state file with many peers. The .torrent is also decoded from
+a memory-mapped file, with and without views into the map. The same
+documents, and a non-compact peer list, are then encoded.
+
+Usage: bench_bencode.py [repeat]"""
+
+import os
+import sys
+import mmap
+import time
+import random
+import tempfile
+import collections
+
+from BitTornado.Meta.bencode import bencode, bdecode, fast_bdecode, \
+    FastDecoder, Bencached, BENCACHED_MARKER
+
+
+class ListEncoder(object):
+    """Encoder as implemented before it wrote into a bytearray"""
+    def __call__(self, data):
+        ctext = []
+        self.encode(data, ctext)
+        return b''.join(ctext)
+
+    def encode(self, data, ctext):
+        if isinstance(data, int):
+            ctext.append('i{:d}e'.format(data).encode('utf-8'))
+        elif isinstance(data, (str, bytes)):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            ctext.extend((str(len(data)).encode('utf-8'), b':', data))
+        elif isinstance(data, Bencached):
+            assert data.marker == BENCACHED_MARKER
+            ctext.append(data.bencoded)
+        elif isinstance(data, collections.Sequence):
+            ctext.append(b'l')
+            for element in data:
+                self.encode(element, ctext)
+            ctext.append(b'e')
+        elif isinstance(data, collections.Mapping):
+            ctext.append(b'd')
+            for key, data in sorted(data.items()):
+                if not isinstance(key, (str, bytes)):
+                    raise TypeError("Dictionary keys must be (byte)strings")
+                self.encode(key, ctext)
+                self.encode(data, ctext)
+            ctext.append(b'e')
+        else:
+            raise TypeError('Unknown type for bencode: ' + str(type(data)))
+
+list_bencode = ListEncoder()
+
+
+def torrent(npieces=50000, nfiles=2000):
+    files = [{'length': random.randrange(1 << 20, 1 << 30),
+              'path': ['dir{}'.format(i % 50), 'file{}.bin'.format(i)]}
+             for i in range(nfiles)]
+    return {'announce': 'http://tracker.example.com:6969/announce',
+            'creation date': 1500000000,
+            'info': {'name': 'example', 'piece length': 1 << 18,
+                     'pieces': os.urandom(20 * npieces), 'files': files}}
+
+
+def response(npeers=200):
+    return {'interval': 1800, 'min interval': 900, 'complete': 150,
+            'incomplete': 50, 'peers': os.urandom(6 * npeers)}
+
+
+def random_key():
+    """Random 20-byte key that is not valid UTF-8, so is decoded as bytes
+    and sorts with the other keys when encoded again"""
+    return b'\xff' + os.urandom(19)
+
+
+def state(ntorrents=200, npeers=50):
+    peers = {}
+    for _ in range(ntorrents):
+        peers[random_key()] = {
+            random_key(): {'ip': '10.0.{}.{}'.format(i // 256, i % 256),
+                           'port': 6881, 'left': i * 1000, 'nat': 0,
+                           'requirecrypto': 0, 'supportcrypto': 1}
+            for i in range(npeers)}
+    return {'completed': {key: 3 for key in peers}, 'peers': peers}
+
+
+def peerlist(npeers=50):
+    return {'complete': 10, 'incomplete': 40, 'interval': 1800,
+            'peers': [{'ip': '10.0.0.{}'.format(i), 'port': 6881 + i,
+                       'peer id': os.urandom(20)} for i in range(npeers)]}
+
+
+def timed(func, ctext, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(ctext)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 20
+    views = FastDecoder(views=True)
+    documents = [('torrent', bencode(torrent())),
+                 ('response', bencode(response())),
+                 ('state', bencode(state()))]
+
+    print('{:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'document', 'bytes', 'bdecode ms', 'fast ms', 'speedup'))
+    for name, ctext in documents:
+        old = timed(bdecode, ctext, repeat)
+        new = timed(fast_bdecode, ctext, repeat)
+        print('{:>10} {:>10} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+            name, len(ctext), old * 1000, new * 1000, old / new))
+
+    torrent_ctext = documents[0][1]
+    with tempfile.TemporaryFile() as handle:
+        handle.write(torrent_ctext)
+        handle.flush()
+        mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        old = timed(bdecode, mm, repeat)
+        new = timed(fast_bdecode, mm, repeat)
+        view = timed(views, mm, repeat)
+    print('{:>10} {:>10} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+        'mmap', len(torrent_ctext), old * 1000, new * 1000, old / new))
+    print('{:>10} {:>10} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+        'mmap view', len(torrent_ctext), old * 1000, view * 1000, old / view))
+
+    print()
+    print('{:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'document', 'bytes', 'list ms', 'buffer ms', 'speedup'))
+    documents = [(name, bdecode(ctext)) for name, ctext in documents]
+    documents.append(('peerlist', peerlist()))
+    for name, data in documents:
+        assert list_bencode(data) == bencode(data)
+        old = timed(list_bencode, data, repeat)
+        new = timed(bencode, data, repeat)
+        print('{:>10} {:>10} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+            name, len(bencode(data)), old * 1000, new * 1000, old / new))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Compare the packed Bitfield with the former list-of-bools version.
+
+For each torrent size, a peer's bitfield message is decoded, then used the
+way Downloader does on receipt (walking the pieces the peer has) and to find
+pieces the peer has that we lack. Memory is the size of one decoded
+bitfield, as held per connection.
+
+Usage: bench_bitfield.py [pieces...]"""
+
+import sys
+import time
+import random
+import tracemalloc
+
+from BitTornado.Types.bitfield import Bitfield, CHARBITMAP
+
+BITCHARMAP = dict(zip(CHARBITMAP, range(256)))
+REPEAT = 20
+
+
+class ListBitfield(list):
+    """Bitfield as implemented before it was packed into a bytearray"""
+    def __init__(self, length=None, bitstring=None, copyfrom=None, val=False):
+        if copyfrom is not None:
+            super(ListBitfield, self).__init__(copyfrom)
+            self.numfalse = copyfrom.numfalse
+            return
+        if bitstring is not None:
+            extra = len(bitstring) * 8 - length
+            if not 0 <= extra < 8:
+                raise ValueError
+            bits = [bit for byte in bitstring for bit in CHARBITMAP[byte]]
+            if extra > 0:
+                if bits[-extra:] != [False] * extra:
+                    raise ValueError
+                del bits[-extra:]
+            self.numfalse = len(bits) - sum(bits)
+        else:
+            bits = [val] * length
+            self.numfalse = 0 if val else length
+        super(ListBitfield, self).__init__(bits)
+
+    def __setitem__(self, index, val):
+        val = bool(val)
+        self.numfalse += self[index] - val
+        super(ListBitfield, self).__setitem__(index, val)
+
+    def __bytes__(self):
+        bits = self + [False] * (-len(self) % 8)
+        return bytes(BITCHARMAP[tuple(bits[x:x + 8])]
+                     for x in range(0, len(bits), 8))
+
+
+def list_wanted(theirs, mine):
+    return [i for i, have in enumerate(theirs) if have and not mine[i]]
+
+
+def packed_wanted(theirs, mine):
+    return list((theirs - mine).indices())
+
+
+def list_haves(theirs):
+    return [i for i, have in enumerate(theirs) if have]
+
+
+def packed_haves(theirs):
+    return list(theirs.indices())
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = func(*args)
+    return (time.perf_counter() - start) / REPEAT, result
+
+
+def size_of(klass, npieces, message):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    bitfield = klass(npieces, message)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del bitfield
+    return used
+
+
+def random_message(npieces, fraction):
+    field = Bitfield(npieces)
+    for i in random.sample(range(npieces), int(npieces * fraction)):
+        field[i] = True
+    return bytes(field)
+
+
+def run(npieces):
+    theirs_msg = random_message(npieces, 0.5)
+    mine_msg = random_message(npieces, 0.3)
+    results = {}
+    for name, klass, haves, wanted in (
+            ('list', ListBitfield, list_haves, list_wanted),
+            ('bytes', Bitfield, packed_haves, packed_wanted)):
+        decode, theirs = timed(klass, npieces, theirs_msg)
+        mine = klass(npieces, mine_msg)
+        walk, haveset = timed(haves, theirs)
+        diff, wantset = timed(wanted, theirs, mine)
+        encode, _ = timed(bytes, theirs)
+        results[name] = (decode, walk, diff, encode,
+                         size_of(klass, npieces, theirs_msg), haveset, wantset)
+    assert results['list'][5:] == results['bytes'][5:]
+    return results
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [1000, 10000, 100000, 1000000]
+    print('{:>8} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'pieces', 'impl', 'decode ms', 'haves ms', 'wanted ms', 'encode ms',
+        'bytes'))
+    for npieces in sizes:
+        for name, (decode, walk, diff, encode, size, _, _) in \
+                sorted(run(npieces).items(), reverse=True):
+            print('{:>8} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} '
+                  '{:>10}'.format(npieces, name, decode * 1000, walk * 1000,
+                                  diff * 1000, encode * 1000, size))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare timing wheel expiry of tracker peers with the former scan.
+
+Fills a peer store with live peers that announced within the last expiry
+period, and a share of stale peers that stopped announcing during the one
+before. The stale peers are expired as the tracker did before, scanning
+every announce time once per period, and with the timing wheel, one tick
+at a time over the period. The longest pause is what stalls the tracker
+loop.
+
+Usage: bench_expiry.py [torrents] [peers per torrent] [stale percent]"""
+
+import sys
+import time
+import random
+
+from BitTornado.Tracker.PeerStore import PeerStore, Peer, EXPIRY_TICKS
+
+PERIOD = 45 * 60.0
+
+
+def fill(ntorrents, npeers, stale):
+    rand = random.Random(0)
+    store = PeerStore(PERIOD / EXPIRY_TICKS)
+    for i in range(ntorrents):
+        infohash = b'%020d' % i
+        for j in range(npeers):
+            peer = Peer('10.0.0.1', 6881, j % 2,
+                        time=rand.uniform(0 if rand.random() < stale
+                                          else PERIOD, 2 * PERIOD))
+            store.add(infohash, b'%020d' % (i * npeers + j), peer)
+    return store
+
+
+def legacy_expire(store, prevtime):
+    """Tracker.expire_downloaders as implemented before the timing wheel"""
+    times = {infohash: {peerid: peer.time for peerid, peer in swarm.items()}
+             for infohash, swarm in store.items()}
+    start = time.perf_counter()
+    for infohash, peertimes in times.items():
+        for peerid, t in list(peertimes.items()):
+            if t < prevtime:
+                store[infohash].remove(peerid)
+                del peertimes[peerid]
+    return time.perf_counter() - start
+
+
+def main(argv):
+    ntorrents = int(argv[0]) if argv else 1000
+    npeers = int(argv[1]) if len(argv) > 1 else 200
+    stale = (float(argv[2]) if len(argv) > 2 else 10) / 100
+    print('{} torrents of {} peers, {:.0%} stale'.format(ntorrents, npeers,
+                                                         stale))
+
+    store = fill(ntorrents, npeers, stale)
+    legacy = legacy_expire(store, PERIOD)
+    remaining = sum(len(swarm) for swarm in store.values())
+
+    store = fill(ntorrents, npeers, stale)
+    ticks = []
+    now = PERIOD
+    while now <= 2 * PERIOD:
+        start = time.perf_counter()
+        store.expire(now - PERIOD)
+        ticks.append(time.perf_counter() - start)
+        now += store.wheel.width
+    assert sum(len(swarm) for swarm in store.values()) == remaining
+
+    print('{:>8} {:>12} {:>16}'.format('expiry', 'total ms',
+                                       'longest pause ms'))
+    print('{:>8} {:>12.1f} {:>16.1f}'.format('scan', legacy * 1e3,
+                                             legacy * 1e3))
+    print('{:>8} {:>12.1f} {:>16.1f}'.format('wheel', sum(ticks) * 1e3,
+                                             max(ticks) * 1e3))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare lazy and full parsing of a directory of torrents.
+
+Writes multi-file torrents into a temporary directory, then parses the
+directory as the tracker does for allowed_dir, once with the lazy metainfo
+and once with the former full MetaInfo parse, checks and re-encoding.
+
+Usage: bench_parsedir.py [torrents] [files per torrent]"""
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+
+from BitTornado.Meta.bencode import bencode
+from BitTornado.Meta.Info import MetaInfo, check_info
+from BitTornado.Application import parsedir
+
+
+def full_parse_torrent(path, return_metainfo=False):
+    """parse_torrent as implemented before metainfo was read lazily"""
+    fname = os.path.basename(path)
+    data = MetaInfo.read(path)
+    info = data['info']
+    check_info(info)
+    infohash = hashlib.sha1(bencode(info)).digest()
+    single = 'length' in info
+    torrentinfo = {
+        'path': path,
+        'file': fname,
+        'name': info.get('name', fname),
+        'numfiles': 1 if single else len(info['files']),
+        'length': info['length'] if single else sum(
+            li['length'] for li in info['files'] if 'length' in li)
+    }
+    for key in ('failure reason', 'warning message', 'announce-list'):
+        if key in data:
+            torrentinfo[key] = data[key]
+    if return_metainfo:
+        torrentinfo['metainfo'] = data
+    return torrentinfo, infohash
+
+
+def write_torrents(directory, ntorrents, nfiles):
+    for i in range(ntorrents):
+        files = [{'length': 1 << 20, 'path': ['dir', 'file{}'.format(j)]}
+                 for j in range(nfiles)]
+        metainfo = {'announce': 'http://tracker.example.com/announce',
+                    'creation date': 1500000000,
+                    'info': {'name': 'torrent{}'.format(i),
+                             'piece length': 1 << 18,
+                             'pieces': os.urandom(80 * nfiles),
+                             'files': files}}
+        with open(os.path.join(directory, '{}.torrent'.format(i)),
+                  'wb') as handle:
+            handle.write(bencode(metainfo))
+
+
+def timed(directory):
+    start = time.perf_counter()
+    parsed = parsedir.parsedir(directory, {}, {}, set(),
+                               errfunc=lambda msg: None)[0]
+    return time.perf_counter() - start, parsed
+
+
+def main(argv):
+    ntorrents = int(argv[0]) if argv else 2000
+    nfiles = int(argv[1]) if len(argv) > 1 else 20
+    directory = tempfile.mkdtemp()
+    try:
+        write_torrents(directory, ntorrents, nfiles)
+        lazy, lazy_parsed = timed(directory)
+        lazy_parse = parsedir.parse_torrent
+        parsedir.parse_torrent = full_parse_torrent
+        try:
+            full, full_parsed = timed(directory)
+        finally:
+            parsedir.parse_torrent = lazy_parse
+    finally:
+        shutil.rmtree(directory)
+
+    assert lazy_parsed.keys() == full_parsed.keys()
+    print('{} torrents of {} files'.format(ntorrents, nfiles))
+    print('{:>8} {:>10}'.format('parse', 'seconds'))
+    print('{:>8} {:>10.3f}'.format('full', full))
+    print('{:>8} {:>10.3f}'.format('lazy', lazy))
+    print('speedup {:.2f}x'.format(full / lazy))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Compare the tracker peer store with the former per-peer dictionaries.
+
+Announces peers into many swarms, storing them as Tracker.add_data does
+now and as it did before: a dictionary per peer, per-swarm announce times
+and seed counts, and a compact address per peer in each of three peer
+list caches. Memory is that allocated to the stored peers. Peer lists are
+then drawn from each, the former way refreshing a shuffled cache of every
+listed peer whenever it runs out.
+
+Usage: bench_peerstore.py [torrents] [peers per torrent]"""
+
+import sys
+import time
+import random
+import tracemalloc
+
+from BitTornado.Tracker.PeerStore import PeerStore, Peer, ALL
+from BitTornado.Tracker.track import compact_peer_info
+
+
+class LegacyStore(object):
+    """Peer storage as kept by Tracker before the peer store"""
+    def __init__(self):
+        self.downloads = {}
+        self.times = {}
+        self.seedcount = {}
+        self.becache = {}
+        self.cached = {}
+
+    def add(self, infohash, peerid, ip, port, left, supportcrypto,
+            requirecrypto, key):
+        peers = self.downloads.setdefault(infohash, {})
+        ts = self.times.setdefault(infohash, {})
+        self.seedcount.setdefault(infohash, 0)
+        bc = self.becache.setdefault(infohash, [({}, {}) for _ in range(3)])
+        ts[peerid] = time.monotonic()
+        peer = {'ip': ip, 'port': port, 'left': left,
+                'supportcrypto': supportcrypto,
+                'requirecrypto': requirecrypto, 'key': key, 'nat': 0}
+        seed = not left
+        cp = compact_peer_info(ip, port)
+        bc[2][seed][peerid] = (cp, requirecrypto)
+        if supportcrypto:
+            bc[1][seed][peerid] = cp
+        if not requirecrypto:
+            bc[0][seed][peerid] = cp
+        self.seedcount[infohash] += seed
+        peers[peerid] = peer
+
+    def peerlist(self, infohash, rsize):
+        bc = self.becache[infohash]
+        cache = self.cached.get(infohash)
+        if not cache or len(cache) < rsize:
+            cache = self.cached[infohash] = \
+                list(bc[2][0].values()) + list(bc[2][1].values())
+            random.shuffle(cache)
+        peerdata = cache[-rsize:]
+        del cache[-rsize:]
+        return (b''.join(p[0] for p in peerdata),
+                bytes(p[1] for p in peerdata))
+
+
+class NewStore(object):
+    """Peer storage as kept by Tracker with the peer store"""
+    def __init__(self):
+        self.downloads = PeerStore()
+
+    def add(self, infohash, peerid, ip, port, left, supportcrypto,
+            requirecrypto, key):
+        peer = Peer(ip, port, left, supportcrypto, requirecrypto, key,
+                    nat=0, time=time.monotonic())
+        self.downloads.add(infohash, peerid, peer)
+        self.downloads[infohash].list(peerid, peer,
+                                      compact_peer_info(ip, port))
+
+    def peerlist(self, infohash, rsize):
+        swarm = self.downloads[infohash]
+        return swarm.compact(swarm.select(ALL, False, rsize))
+
+
+def announces(ntorrents, npeers):
+    rand = random.Random(0)
+    for i in range(ntorrents):
+        infohash = b'%020d' % i
+        for j in range(npeers):
+            supportcrypto = rand.random() < 0.7
+            yield (infohash, b'-BT0001-%012d' % (i * npeers + j),
+                   '10.{}.{}.{}'.format(j >> 16, (j >> 8) & 255, j & 255),
+                   rand.randrange(1024, 65536),
+                   0 if rand.random() < 0.3 else rand.randrange(1 << 30),
+                   int(supportcrypto),
+                   int(supportcrypto and rand.random() < 0.2),
+                   '{:08X}'.format(rand.getrandbits(32)))
+
+
+def run(klass, ntorrents, npeers):
+    peers = list(announces(ntorrents, npeers))
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    store = klass()
+    for announce in peers:
+        store.add(*announce)
+    added = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    infohashes = [b'%020d' % i for i in range(ntorrents)]
+    start = time.perf_counter()
+    for _ in range(len(peers) // 10):
+        store.peerlist(random.choice(infohashes), 50)
+    listed = time.perf_counter() - start
+    return memory, added, listed
+
+
+def main(argv):
+    ntorrents = int(argv[0]) if argv else 100
+    npeers = int(argv[1]) if len(argv) > 1 else 2000
+    total = ntorrents * npeers
+    print('{} torrents of {} peers'.format(ntorrents, npeers))
+    print('{:>8} {:>14} {:>12} {:>14}'.format('store', 'bytes/peer',
+                                              'adds/s', 'peerlists/s'))
+    for name, klass in (('legacy', LegacyStore), ('indexed', NewStore)):
+        memory, added, listed = run(klass, ntorrents, npeers)
+        print('{:>8} {:>14.0f} {:>12.0f} {:>14.0f}'.format(
+            name, memory / total, total / added, total // 10 / listed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare PieceHasher with the former slicing version.
+
+Hashes random data, fed as bytes in reads of several sizes as from a file,
+with each hasher and with bare SHA1 as the bound. Memory is the peak
+allocated while hashing.
+
+Usage: bench_piecehasher.py [megabytes] [piece kilobytes]"""
+
+import os
+import sys
+import time
+import hashlib
+import tracemalloc
+
+from BitTornado.Meta.Info import PieceHasher
+
+
+class SlicingPieceHasher(PieceHasher):
+    """PieceHasher.update as implemented before hashing in place"""
+    def update(self, data, progress=lambda x: None):
+        tofinish = self.pieceLength - self.done
+        init, remainder = data[:tofinish], data[tofinish:]
+        self._hash.update(init)
+        progress(len(init))
+        self.done += len(init)
+        if remainder:
+            toHash = len(remainder)
+            hashes = [self._hashtype(remainder[i:i + self.pieceLength])
+                      for i in range(0, toHash, self.pieceLength)]
+            progress(toHash)
+            self.done = toHash % self.pieceLength
+            self.pieces.append(self._hash.digest())
+            self._hash = hashes[-1]
+            self.pieces.extend(piece.digest() for piece in hashes[:-1])
+        if self.done == self.pieceLength:
+            self.pieces.append(self._hash.digest())
+            self.resetHash()
+
+
+def run(klass, chunks, piece_length):
+    tracemalloc.start()
+    start = time.perf_counter()
+    hasher = klass(piece_length)
+    for chunk in chunks:
+        hasher.update(chunk)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, bytes(hasher)
+
+
+def main(argv):
+    size = (int(argv[0]) if argv else 256) << 20
+    piece_length = (int(argv[1]) if len(argv) > 1 else 256) << 10
+    data = memoryview(os.urandom(size))
+
+    start = time.perf_counter()
+    hashlib.sha1(data).digest()
+    floor = time.perf_counter() - start
+    print('sha1 alone: {:.0f} MB/s'.format(size / floor / 1e6))
+
+    print('{:>8} {:>10} {:>10} {:>12}'.format('read KB', 'impl', 'MB/s',
+                                              'peak bytes'))
+    # Reads of one piece, of many pieces, and straddling piece boundaries
+    for readsize in (piece_length, 4 << 20, 3 * piece_length // 2 + 1):
+        chunks = [bytes(data[i:i + readsize])
+                  for i in range(0, size, readsize)]
+        results = {}
+        for name, klass in (('slicing', SlicingPieceHasher),
+                            ('in place', PieceHasher)):
+            elapsed, peak, pieces = run(klass, chunks, piece_length)
+            results[name] = pieces
+            print('{:>8} {:>10} {:>10.0f} {:>12}'.format(
+                readsize >> 10, name, size / elapsed / 1e6, peak))
+        if results['slicing'] != results['in place']:
+            print('{:>8} (slicing version gives wrong digests)'.format(''))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Compare PiecePicker with the former list-scanning picker.
+
+Peers with random bitfields join a torrent of which some pieces are
+already downloaded, their haves passed to the picker one by one as
+Downloader did, or as whole bitfields as it does now. Each peer in turn
+then has a piece picked for it, as SingleDownload._request_more does, and
+the piece picked is requested in full so that it is not wanted again, and
+completes a hundred picks later.
+Peers have from a handful of the pieces to most of them; a peer having few
+of the wanted pieces is where the former picker scanned longest.
+
+Usage: bench_piecepicker.py [pieces] [peers] [picks]"""
+
+import sys
+import time
+import random
+from collections import deque
+
+from BitTornado.Client.PiecePicker import PiecePicker
+from BitTornado.Types import Bitfield
+
+# Pieces picked that are downloading at once
+DOWNLOADING = 100
+
+
+class LegacyPiecePicker(object):
+    """PiecePicker as implemented before levels were kept as Bitfields,
+    without the superseeding and priority methods"""
+    def __init__(self, numpieces, rarest_first_cutoff=1,
+                 rarest_first_priority_cutoff=3, priority_step=20):
+        self.rarest_first_cutoff = rarest_first_cutoff
+        self.priority_step = priority_step
+        self.cutoff = rarest_first_priority_cutoff
+        self.numpieces = numpieces
+        self.started = set()
+        self.totalcount = 0
+        self.numhaves = [0] * numpieces
+        self.priority = [1] * numpieces
+        self.crosscount = [numpieces]
+        self.crosscount2 = [numpieces]
+        self.has = [0] * numpieces
+        self.numgot = 0
+        self.done = False
+        self.interests = [[] for _ in range(priority_step)]
+        self.level_in_interests = [priority_step] * numpieces
+        interests = list(range(numpieces))
+        random.shuffle(interests)
+        self.pos_in_interests = [0] * numpieces
+        for i in range(numpieces):
+            self.pos_in_interests[interests[i]] = i
+        self.interests.append(interests)
+
+    def got_have(self, piece):
+        self.totalcount += 1
+        numint = self.numhaves[piece]
+        self.numhaves[piece] += 1
+        self.crosscount[numint] -= 1
+        if numint + 1 == len(self.crosscount):
+            self.crosscount.append(0)
+        self.crosscount[numint + 1] += 1
+        if not self.done:
+            numintplus = numint + self.has[piece]
+            self.crosscount2[numintplus] -= 1
+            if numintplus + 1 == len(self.crosscount2):
+                self.crosscount2.append(0)
+            self.crosscount2[numintplus + 1] += 1
+            numint = self.level_in_interests[piece]
+            self.level_in_interests[piece] += 1
+        if self.has[piece] or self.priority[piece] == -1:
+            return
+        if numint == len(self.interests) - 1:
+            self.interests.append([])
+        self._shift_over(piece, self.interests[numint],
+                         self.interests[numint + 1])
+
+    def _shift_over(self, piece, l1, l2):
+        parray = self.pos_in_interests
+        p = parray[piece]
+        q = l1[-1]
+        l1[p] = q
+        parray[q] = p
+        del l1[-1]
+        newp = random.randrange(len(l2) + 1)
+        if newp == len(l2):
+            parray[piece] = len(l2)
+            l2.append(piece)
+        else:
+            old = l2[newp]
+            parray[old] = len(l2)
+            l2.append(old)
+            l2[newp] = piece
+            parray[piece] = newp
+
+    def requested(self, piece):
+        self.started.add(piece)
+
+    def complete(self, piece):
+        self.has[piece] = 1
+        self.numgot += 1
+        numhaves = self.numhaves[piece]
+        self.crosscount2[numhaves] -= 1
+        if numhaves + 1 == len(self.crosscount2):
+            self.crosscount2.append(0)
+        self.crosscount2[numhaves + 1] += 1
+        interests = self.interests[self.level_in_interests[piece]]
+        p = self.pos_in_interests[piece]
+        q = interests[-1]
+        interests[p] = q
+        self.pos_in_interests[q] = p
+        del interests[-1]
+        self.started.discard(piece)
+
+    def next(self, haves, wantfunc, complete_first=False):
+        cutoff = self.numgot < self.rarest_first_cutoff
+        complete_first = (complete_first or cutoff) and not haves.complete
+        best = None
+        bestnum = 2 ** 30
+        for i in self.started:
+            if haves[i] and wantfunc(i):
+                if self.level_in_interests[i] < bestnum:
+                    best = i
+                    bestnum = self.level_in_interests[i]
+        if best is not None:
+            if complete_first or cutoff and len(self.interests) > self.cutoff:
+                return best
+        if haves.complete:
+            r = [(0, min(bestnum, len(self.interests)))]
+        elif cutoff and len(self.interests) > self.cutoff:
+            r = [(self.cutoff, min(bestnum, len(self.interests))),
+                 (0, self.cutoff)]
+        else:
+            r = [(0, min(bestnum, len(self.interests)))]
+        for lo, hi in r:
+            for i in range(lo, hi):
+                for j in self.interests[i]:
+                    if haves[j] and wantfunc(j):
+                        return j
+        if best is not None:
+            return best
+        return None
+
+
+def make_peers(npieces, npeers):
+    peers = []
+    for _ in range(npeers):
+        have = Bitfield(npieces)
+        fraction = random.choice((0.001, 0.01, 0.1, 0.5, 0.9))
+        for piece in random.sample(range(npieces),
+                                   max(1, int(npieces * fraction))):
+            have[piece] = True
+        peers.append(have)
+    return peers
+
+
+def each_have(picker, have):
+    for piece in have.indices():
+        picker.got_have(piece)
+
+
+def run(picker_class, ingest_bitfield, npieces, peers, npicks, seed):
+    random.seed(seed)
+    picker = picker_class(npieces)
+    got = random.sample(range(npieces), npieces * 3 // 10)
+    for piece in got:
+        picker.complete(piece)
+
+    start = time.perf_counter()
+    for have in peers:
+        ingest_bitfield(picker, have)
+    ingest = time.perf_counter() - start
+
+    # Pieces not yet requested in full, and those downloading
+    unrequested = set(range(npieces)).difference(got)
+    downloading = deque()
+    start = time.perf_counter()
+    for i in range(npicks):
+        piece = picker.next(peers[i % len(peers)], unrequested.__contains__)
+        if piece is not None:
+            picker.requested(piece)
+            unrequested.discard(piece)
+            downloading.append(piece)
+        if len(downloading) > DOWNLOADING:
+            picker.complete(downloading.popleft())
+    pick = time.perf_counter() - start
+    return ingest, pick / npicks
+
+
+def main(argv):
+    npieces = int(argv[0]) if argv else 50000
+    npeers = int(argv[1]) if len(argv) > 1 else 200
+    npicks = int(argv[2]) if len(argv) > 2 else 2000
+    random.seed(0)
+    peers = make_peers(npieces, npeers)
+    print('{} pieces, {} peers, {} picks'.format(npieces, npeers, npicks))
+    print('{:>8} {:>10} {:>10}'.format('impl', 'haves ms', 'pick us'))
+    for name, picker_class, ingest_bitfield in (
+            ('legacy', LegacyPiecePicker, each_have),
+            ('bitset', PiecePicker, each_have),
+            ('bulk', PiecePicker, PiecePicker.got_bitfield)):
+        ingest, pick = run(picker_class, ingest_bitfield, npieces, peers,
+                           npicks, 1)
+        print('{:>8} {:>10.1f} {:>10.1f}'.format(name, ingest * 1000,
+                                                 pick * 1e6))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
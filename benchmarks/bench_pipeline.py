@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Compare download throughput from a distant peer by pipeline depth.
+
+A simulated seed serves requests in order over a link of the given
+bandwidth, each block arriving half a round trip after the link has sent
+it, on a clock advanced from one arrival to the next. Downloads size their
+pipelines as formerly, from their rate alone, and from the rate and the
+round trip measured. The former can settle at fifty requests, short of the
+bandwidth once a round trip needs more than fifty blocks to be in flight.
+
+Usage: bench_pipeline.py [MB/s] [seconds] [rtt_ms ...]"""
+
+import sys
+import heapq
+
+from BitTornado.Client import CurrentRateMeasure
+from BitTornado.Client import Downloader as DownloaderModule
+from BitTornado.Client.Downloader import Downloader, SingleDownload
+from BitTornado.Client.PiecePicker import PiecePicker
+from BitTornado.Types import Bitfield
+
+BLOCK = 2 ** 14
+BLOCKS = 16
+NUMPIECES = 10000
+
+
+class SimClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LegacySingleDownload(SingleDownload):
+    """SingleDownload sizing its pipeline from the rate alone, as before
+    round trips were measured"""
+    def _backlog(self, just_unchoked):
+        self.backlog = min(
+            2 + int(4 * self.measure.get_rate() / self.downloader.chunksize),
+            2 * just_unchoked + self.downloader.queue_limit())
+        if self.backlog > 50:
+            self.backlog = int(max(50, self.backlog * 0.075))
+        return self.backlog
+
+
+class Storage(object):
+    piece_length = BLOCKS * BLOCK
+    request_size = BLOCK
+
+    def __init__(self):
+        self.next = [0] * NUMPIECES
+        self.dirty = {}
+
+    def new_request(self, index):
+        begin = self.next[index]
+        self.next[index] += BLOCK
+        return begin, BLOCK
+
+    def do_I_have_requests(self, index):
+        return self.next[index] < self.piece_length
+
+    def piece_came_in(self, index, begin, piece, source=None):
+        return True
+
+    def do_I_have(self, index):
+        return False
+
+    def is_endgame(self):
+        return False
+
+    def am_I_complete(self):
+        return False
+
+
+class Link(object):
+    """Connection to a seed serving requests in order"""
+    def __init__(self, clock, bandwidth, rtt):
+        self.clock = clock
+        self.bandwidth = bandwidth
+        self.rtt = rtt
+        self.free = 0
+        self.arrivals = []
+        self.sent = 0
+
+    def get_ip(self):
+        return '10.0.0.1'
+
+    def get_readable_id(self):
+        return 'seed'
+
+    def send_interested(self):
+        pass
+
+    def send_not_interested(self):
+        pass
+
+    def send_request(self, index, begin, length):
+        start = max(self.clock() + self.rtt / 2, self.free)
+        self.free = start + length / self.bandwidth
+        self.sent += 1
+        heapq.heappush(self.arrivals, (self.free + self.rtt / 2, self.sent,
+                                       (index, begin, length)))
+
+    def send_cancel(self, index, begin, length):
+        pass
+
+
+def run(download_class, bandwidth, rtt, seconds):
+    clock = SimClock()
+    DownloaderModule.clock = CurrentRateMeasure.clock = clock
+    downloader = Downloader(Storage(), PiecePicker(NUMPIECES), 500, 20,
+                            NUMPIECES, BLOCK, lambda amount: None, 30,
+                            False, None, None)
+    link = Link(clock, bandwidth, rtt)
+    download = downloader.make_download(link)
+    download.__class__ = download_class
+    download.got_have_bitfield(Bitfield(NUMPIECES, val=True))
+    download.got_unchoke()
+    start = clock.now
+    received = 0
+    data = bytes(BLOCK)
+    while link.arrivals:
+        when, _, (index, begin, length) = heapq.heappop(link.arrivals)
+        if when > start + seconds:
+            break
+        clock.now = when
+        download.got_piece(index, begin, data[:length])
+        received += length
+    return received / seconds, download.backlog
+
+
+def main(argv):
+    bandwidth = float(argv[0]) * 1e6 if argv else 10e6
+    seconds = float(argv[1]) if len(argv) > 1 else 30
+    rtts = [float(arg) / 1000 for arg in argv[2:]] or [0.02, 0.1, 0.3]
+    print('{:.0f} MB/s link, {:.0f} s'.format(bandwidth / 1e6, seconds))
+    print('{:>7} {:>8} {:>10} {:>6}'.format('rtt ms', 'impl', 'MB/s',
+                                            'depth'))
+    for rtt in rtts:
+        for name, download_class in (('legacy', LegacySingleDownload),
+                                     ('rtt', SingleDownload)):
+            rate, depth = run(download_class, bandwidth, rtt, seconds)
+            print('{:>7.0f} {:>8} {:>10.2f} {:>6}'.format(
+                rtt * 1000, name, rate / 1e6, depth))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
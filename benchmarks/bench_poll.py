@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Compare SocketHandler poll backends over loopback connections.
+
+For each backend and connection count, a fraction of the client sockets send
+a small message each round, which the handler echoes back through
+SingleSocket.write. Reported times are per round of do_poll/handle_events.
+
+Usage: bench_poll.py [connections...]"""
+
+import sys
+import time
+import socket
+import random
+import resource
+
+from BitTornado.Network.SocketHandler import SocketHandler, SingleSocket, \
+    POLL_BACKENDS, POLLIN
+
+ROUNDS = 50
+ACTIVE = 0.1
+MESSAGE = b'x' * 64
+# select.select() cannot watch descriptors past FD_SETSIZE
+SELECT_LIMIT = 1024
+
+
+class EchoHandler(object):
+    def __init__(self):
+        self.received = 0
+
+    def data_came_in(self, s, data):
+        self.received += len(data)
+        s.write(data)
+
+    def connection_flushed(self, s):
+        pass
+
+    def connection_lost(self, s):
+        pass
+
+
+def raise_fd_limit(connections):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * connections + 64
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0] >= wanted
+
+
+def connect_pairs(handler, sockethandler, connections):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(connections)
+    clients = []
+    for _ in range(connections):
+        client = socket.create_connection(server.getsockname())
+        sock, _ = server.accept()
+        sock.setblocking(0)
+        ss = SingleSocket(sockethandler, sock, handler)
+        sockethandler.single_sockets[sock.fileno()] = ss
+        sockethandler.poll.register(sock, POLLIN)
+        clients.append(client)
+    server.close()
+    return clients
+
+
+def run(backend, connections):
+    handler = EchoHandler()
+    sockethandler = SocketHandler(300, False, 32768, backend)
+    sockethandler.set_handler(handler)
+    sockethandler.max_connects = connections
+    clients = connect_pairs(handler, sockethandler, connections)
+
+    elapsed = 0
+    nactive = max(1, int(connections * ACTIVE))
+    for _ in range(ROUNDS):
+        active = random.sample(clients, nactive)
+        for client in active:
+            client.sendall(MESSAGE)
+        target = handler.received + nactive * len(MESSAGE)
+        start = time.perf_counter()
+        while handler.received < target:
+            events = sockethandler.do_poll(1)
+            sockethandler.handle_events(events)
+            sockethandler.close_dead()
+        elapsed += time.perf_counter() - start
+        for client in active:
+            client.recv(len(MESSAGE))
+
+    sockethandler.shutdown()
+    for client in clients:
+        client.close()
+    return elapsed / ROUNDS
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [1000, 5000, 10000]
+    print('{:>8} {:>10} {:>12}'.format('conns', 'backend', 'ms/round'))
+    for connections in sizes:
+        if not raise_fd_limit(connections):
+            print('{:>8} skipped: file descriptor limit too low'.format(
+                connections))
+            continue
+        for backend in sorted(POLL_BACKENDS):
+            if backend == 'select' and 2 * connections > SELECT_LIMIT:
+                print('{:>8} {:>10} {:>12}'.format(connections, backend,
+                                                   'n/a'))
+                continue
+            result = run(backend, connections)
+            print('{:>8} {:>10} {:>12.3f}'.format(connections, backend,
+                                                  result * 1000))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
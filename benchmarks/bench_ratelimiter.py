@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Compare upload sharing between torrents under a global upload limit.
+
+Torrents with different numbers of peers, each peer always wanting more,
+upload through one limiter on a simulated clock, with the former limiter
+sending to all connections in turn, and with RateLimiter sending to each
+torrent's class in turn. The former shares the limit between torrents in
+proportion to their peers. Each also reports the time taken per unit sent,
+measured with the simulated clock standing in for the real one.
+
+Usage: bench_ratelimiter.py [kB/s] [seconds] [peers ...]"""
+
+import sys
+import time
+import heapq
+
+from BitTornado.Client import RateLimiter as RateLimiterModule
+from BitTornado.Client.RateLimiter import RateLimiter
+
+UNIT = 1380
+MAX_RATE = 10e10
+
+
+class SimClock(object):
+    """Clock advanced from one task to the next, by at least its
+    resolution, as limiters rescheduling with no time passed would spin"""
+    resolution = 1e-6
+
+    def __init__(self):
+        self.now = 1000.0
+        self.tasks = []
+        self.count = 0
+
+    def __call__(self):
+        return self.now
+
+    def sched(self, func, delay=0):
+        self.count += 1
+        heapq.heappush(self.tasks, (self.now + max(delay, self.resolution),
+                                    self.count, func))
+
+    def run(self, until):
+        while self.tasks and self.tasks[0][0] <= until:
+            self.now, _, func = heapq.heappop(self.tasks)
+            func()
+        self.now = until
+
+
+class LegacyRateLimiter(object):
+    """RateLimiter as implemented before rate classes, sending to all
+    connections in turn, without automatic adjustment"""
+    def __init__(self, sched, unitsize, clock):
+        self.sched = sched
+        self.clock = clock
+        self.last = None
+        self.unitsize = unitsize
+        self.upload_rate = MAX_RATE * 1000
+
+    def set_upload_rate(self, rate):
+        if not rate:
+            rate = MAX_RATE
+        self.upload_rate = rate * 1000
+        self.lasttime = self.clock()
+        self.bytes_sent = 0
+
+    def queue(self, conn):
+        assert conn.next_upload is None
+        if self.last is None:
+            self.last = conn
+            conn.next_upload = conn
+            self.try_send(True)
+        else:
+            conn.next_upload = self.last.next_upload
+            self.last.next_upload = conn
+            self.last = conn
+
+    def try_send(self, check_time=False):
+        t = self.clock()
+        self.bytes_sent -= (t - self.lasttime) * self.upload_rate
+        self.lasttime = t
+        if check_time:
+            self.bytes_sent = max(self.bytes_sent, 0)
+        cur = self.last.next_upload
+        while self.bytes_sent <= 0:
+            nbytes = cur.send_partial(self.unitsize)
+            self.bytes_sent += nbytes
+            if nbytes == 0 or cur.backlogged():
+                if self.last is cur:
+                    self.last = None
+                    cur.next_upload = None
+                    break
+                else:
+                    self.last.next_upload = cur.next_upload
+                    cur.next_upload = None
+                    cur = self.last.next_upload
+            else:
+                self.last = cur
+                cur = cur.next_upload
+        else:
+            self.sched(self.try_send, self.bytes_sent / self.upload_rate)
+
+
+class Connection(object):
+    """Peer always wanting more"""
+    def __init__(self, limiter):
+        self.next_upload = None
+        self.queued = False
+        if hasattr(limiter, 'peer_bucket'):
+            self.upload_bucket = limiter.peer_bucket(0)
+        self.sent = 0
+
+    def send_partial(self, nbytes):
+        self.sent += nbytes
+        return nbytes
+
+    def backlogged(self):
+        return False
+
+
+def run(legacy, rate, seconds, peers):
+    clock = SimClock()
+    RateLimiterModule.clock = clock
+    if legacy:
+        limiter = LegacyRateLimiter(clock.sched, UNIT, clock)
+    else:
+        limiter = RateLimiter(clock.sched, UNIT)
+    limiter.set_upload_rate(rate)
+    torrents = []
+    for npeers in peers:
+        queue = limiter if legacy else limiter.add_class()
+        torrents.append([Connection(queue) for _ in range(npeers)])
+        for conn in torrents[-1]:
+            queue.queue(conn)
+    start = time.perf_counter()
+    clock.run(clock.now + seconds)
+    elapsed = time.perf_counter() - start
+    sent = [sum(conn.sent for conn in conns) for conns in torrents]
+    return [nbytes / seconds for nbytes in sent], \
+        elapsed / (sum(sent) / UNIT)
+
+
+def main(argv):
+    rate = float(argv[0]) if argv else 1000
+    seconds = float(argv[1]) if len(argv) > 1 else 30
+    peers = [int(arg) for arg in argv[2:]] or [1, 5, 50]
+    print('{:.0f} kB/s limit, {:.0f} s, torrents of {} peers'.format(
+        rate, seconds, ', '.join(str(npeers) for npeers in peers)))
+    print('{:>8} {:>30} {:>8}'.format('impl', 'kB/s by torrent', 'us/unit'))
+    for name, legacy in (('legacy', True), ('classes', False)):
+        rates, cost = run(legacy, rate, seconds, peers)
+        print('{:>8} {:>30} {:>8.2f}'.format(
+            name, ' '.join('{:.0f}'.format(r / 1000) for r in rates),
+            cost * 1e6))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Load trackers of one and several shards with UDP announces.
+
+Starts bttrack.py with each number of shards given, on local ports, and
+has simulated clients announce over UDP in rounds, every client keeping
+one request in flight, across as many torrents as clients. Shards only
+add throughput with a core each; on fewer cores the cost of forwarding
+requests between processes is measured instead.
+
+Usage: bench_shards.py [clients] [announces] [shards ...]"""
+
+import os
+import sys
+import time
+import socket
+import select
+import struct
+import shutil
+import signal
+import tempfile
+import subprocess
+
+from BitTornado.Tracker.UDPHandler import PROTOCOL_ID, CONNECT, ANNOUNCE
+
+BTTRACK = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bttrack.py')
+
+
+def free_port():
+    with socket.socket(type=socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_tracker(directory, nshards):
+    port = free_port()
+    tracker = subprocess.Popen(
+        [sys.executable, BTTRACK, '--port', str(free_port()),
+         '--udp_port', str(port), '--bind', '127.0.0.1',
+         '--dfile', os.path.join(directory, 'dfile'), '--nat_check', '0',
+         '--shards', str(nshards), '--logfile', os.devnull],
+        stdout=subprocess.DEVNULL)
+    return tracker, ('127.0.0.1', port)
+
+
+def connect(clients, addr):
+    """Obtain a connection ID for each client, waiting for the tracker"""
+    connids = {}
+    deadline = time.monotonic() + 10
+    for i, client in enumerate(clients):
+        client.connect(addr)
+        while client not in connids:
+            if time.monotonic() > deadline:
+                raise RuntimeError('tracker did not start')
+            client.send(struct.pack('>QII', PROTOCOL_ID, CONNECT, i))
+            if select.select([client], [], [], 0.2)[0]:
+                try:
+                    connids[client] = \
+                        struct.unpack('>IIQ', client.recv(16))[2]
+                except ConnectionRefusedError:
+                    time.sleep(0.2)
+    return connids
+
+
+def udp_load(addr, nclients, nannounces):
+    clients = [socket.socket(type=socket.SOCK_DGRAM)
+               for _ in range(nclients)]
+    connids = connect(clients, addr)
+    sent = done = 0
+    start = time.perf_counter()
+    pending = set()
+    while done < nannounces:
+        for i, client in enumerate(clients):
+            if client not in pending and sent < nannounces:
+                client.send(struct.pack(
+                    '>QII20s20sQqQIIIiH', connids[client], ANNOUNCE, sent,
+                    b'%020d' % i, b'%020d' % sent, 0, (sent % 3) * 1000, 0,
+                    0, 0, sent, 50, 6881 + sent % 1000))
+                pending.add(client)
+                sent += 1
+        readable, _, _ = select.select(list(pending), [], [], 5)
+        if not readable:
+            raise RuntimeError('UDP requests timed out')
+        for client in readable:
+            client.recv(2048)
+            pending.discard(client)
+            done += 1
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return nannounces / elapsed
+
+
+def main(argv):
+    nclients = int(argv[0]) if argv else 50
+    nannounces = int(argv[1]) if len(argv) > 1 else 20000
+    shards = [int(arg) for arg in argv[2:]] or [1, 2, 4]
+    print('{} clients, {} announces, {} cores'.format(
+        nclients, nannounces, os.cpu_count()))
+    print('{:>6} {:>14}'.format('shards', 'announces/s'))
+    for nshards in shards:
+        directory = tempfile.mkdtemp()
+        tracker, addr = start_tracker(directory, nshards)
+        try:
+            rate = udp_load(addr, nclients, nannounces)
+            print('{:>6} {:>14.0f}'.format(nshards, rate))
+        finally:
+            tracker.send_signal(signal.SIGINT)
+            tracker.wait()
+            shutil.rmtree(directory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Load the tracker with simulated clients announcing over UDP and HTTP.
+
+Runs a tracker on a RawServer in a thread, serving HTTP and BEP 15 UDP
+requests on local ports. Simulated clients each obtain a connection ID,
+then announce a peer over UDP in rounds, every client keeping one request
+in flight; the same announces are then made over HTTP, a connection per
+request, as clients make them. Bytes are those of requests and responses,
+without IP, UDP or TCP headers.
+
+Usage: bench_udp_tracker.py [clients] [announces]"""
+
+import os
+import sys
+import time
+import socket
+import select
+import struct
+import shutil
+import tempfile
+import threading
+import urllib.parse
+
+from BitTornado.Network.RawServer import RawServer
+from BitTornado.Tracker.HTTPHandler import HTTPHandler
+from BitTornado.Tracker.UDPHandler import UDPHandler, PROTOCOL_ID, \
+    CONNECT, ANNOUNCE
+from BitTornado.Tracker.track import Tracker, defaults
+
+NTORRENTS = 10
+
+
+class QuietHTTPHandler(HTTPHandler):
+    """HTTPHandler without the request log, which UDP requests lack"""
+    def log(self, *args):
+        pass
+
+
+def start_tracker(directory):
+    config = {key: value for key, value, _ in defaults}
+    config.update(dfile=os.path.join(directory, 'dfile'), nat_check=0)
+    doneflag = threading.Event()
+    rawserver = RawServer(doneflag, 60, 300, ipv6_enable=False)
+    tracker = Tracker(config, rawserver)
+    rawserver.bind(0, '127.0.0.1', reuse=True)
+    rawserver.bind_udp(0, UDPHandler(tracker), '127.0.0.1')
+    listener, = rawserver.sockethandler.servers.values()
+    dsock, = rawserver.sockethandler.datagrams.values()
+    thread = threading.Thread(target=rawserver.listen_forever,
+                              args=(QuietHTTPHandler(tracker.get, 60),))
+    thread.start()
+    return doneflag, thread, listener.getsockname(), \
+        dsock.socket.getsockname()
+
+
+def peer(i):
+    return b'%020d' % (i % NTORRENTS), b'%020d' % i, (i % 3) * 1000
+
+
+def udp_load(addr, nclients, nannounces):
+    clients = [socket.socket(type=socket.SOCK_DGRAM)
+               for _ in range(nclients)]
+    connids = {}
+    for i, client in enumerate(clients):
+        client.connect(addr)
+        client.send(struct.pack('>QII', PROTOCOL_ID, CONNECT, i))
+        connids[client] = struct.unpack('>IIQ', client.recv(16))[2]
+
+    nbytes = sent = done = 0
+    start = time.perf_counter()
+    pending = set()
+    while done < nannounces:
+        for client in clients:
+            if client not in pending and sent < nannounces:
+                infohash, peerid, left = peer(sent)
+                request = struct.pack(
+                    '>QII20s20sQqQIIIiH', connids[client], ANNOUNCE, sent,
+                    infohash, peerid, 0, left, 0, 0, 0, sent, 50,
+                    6881 + sent % 1000)
+                client.send(request)
+                nbytes += len(request)
+                pending.add(client)
+                sent += 1
+        readable, _, _ = select.select(list(pending), [], [], 5)
+        if not readable:
+            raise RuntimeError('UDP requests timed out')
+        for client in readable:
+            nbytes += len(client.recv(2048))
+            pending.discard(client)
+            done += 1
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return nannounces / elapsed, nbytes / nannounces
+
+
+def http_load(addr, nannounces):
+    nbytes = 0
+    start = time.perf_counter()
+    for i in range(nannounces):
+        infohash, peerid, left = peer(i)
+        query = urllib.parse.urlencode({
+            'info_hash': infohash, 'peer_id': peerid, 'left': left,
+            'port': 6881 + i % 1000, 'compact': 1, 'numwant': 50,
+            'uploaded': 0, 'downloaded': 0})
+        request = 'GET /announce?{} HTTP/1.0\r\n\r\n'.format(query).encode()
+        with socket.create_connection(addr) as conn:
+            conn.sendall(request)
+            nbytes += len(request)
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                nbytes += len(data)
+    elapsed = time.perf_counter() - start
+    return nannounces / elapsed, nbytes / nannounces
+
+
+def main(argv):
+    nclients = int(argv[0]) if argv else 50
+    nannounces = int(argv[1]) if len(argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    doneflag, thread, http_addr, udp_addr = start_tracker(directory)
+    try:
+        print('{} clients, {} announces over {} torrents'.format(
+            nclients, nannounces, NTORRENTS))
+        print('{:>8} {:>14} {:>16}'.format('protocol', 'announces/s',
+                                           'bytes/announce'))
+        # Peers added over UDP are announced again over HTTP
+        for name, load in (('udp', lambda: udp_load(udp_addr, nclients,
+                                                    nannounces)),
+                           ('http', lambda: http_load(http_addr,
+                                                      nannounces))):
+            rate, size = load()
+            print('{:>8} {:>14.0f} {:>16.0f}'.format(name, rate, size))
+    finally:
+        doneflag.set()
+        thread.join()
+        shutil.rmtree(directory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
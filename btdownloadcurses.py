@@ -318,7 +318,7 @@ def run(scrwin, errlist, params):
             rawserver = RawServer(
                 doneflag, config['timeout_check_interval'], config['timeout'],
                 ipv6_enable=config['ipv6_enabled'], failfunc=d.failed,
-                errorfunc=d.error)
+                errorfunc=d.error, poll_backend=config['poll_backend'])
 
             upnp_type = UPnP_test(config['upnp_nat_access'])
             while True:
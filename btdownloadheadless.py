@@ -153,7 +153,7 @@ def run(params):
         rawserver = RawServer(
             doneflag, config['timeout_check_interval'], config['timeout'],
             ipv6_enable=config['ipv6_enabled'], failfunc=h.failed,
-            errorfunc=disp_exception)
+            errorfunc=disp_exception, poll_backend=config['poll_backend'])
         upnp_type = UPnP_test(config['upnp_nat_access'])
         while True:
             try: